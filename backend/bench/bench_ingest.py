@@ -0,0 +1,120 @@
+# bench/bench_ingest.py — per-item vs batched recently-played ingest (offline, stubbed Spotify)
+#
+#   python bench/bench_ingest.py [--items 50] [--latency-ms 40] [--runs 3]
+#
+# Reports Spotify API calls, SQLite commits and wall time for the legacy
+# per-item loop and for logger_recent.log_recently_played.
+from __future__ import annotations
+import argparse, json, random, sqlite3, sys, tempfile, time
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import logger_recent  # noqa: E402
+
+
+class StubSpotify:
+    """Serves a generated recently-played page; counts calls, sleeps `latency` per call."""
+
+    def __init__(self, n_items: int = 50, latency: float = 0.04, seed: int = 7):
+        rng = random.Random(seed)
+        now = datetime.now(timezone.utc)
+        self.latency = latency
+        self.calls: dict[str, int] = {}
+        self.items = []
+        for i in range(n_items):
+            artist_ids = [f"artist{rng.randint(0, 60)}" for _ in range(rng.choice([1, 1, 2, 3]))]
+            tid = f"track{rng.randint(0, 400)}"
+            self.items.append({
+                "played_at": (now - timedelta(minutes=4 * i)).isoformat().replace("+00:00", "Z"),
+                "context": {"type": rng.choice(["album", "playlist", "artist"])},
+                "track": {
+                    "id": tid, "name": f"Song {tid}", "duration_ms": 180000, "popularity": rng.randint(0, 100),
+                    "album": {"id": f"album{rng.randint(0, 150)}", "name": "Album", "release_date": "2023-05-01"},
+                    "artists": [{"id": a, "name": a} for a in artist_ids],
+                },
+            })
+
+    def _hit(self, name: str):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        time.sleep(self.latency)
+
+    def current_user_recently_played(self, limit=50, after=None, **_):
+        self._hit("recently_played")
+        items = self.items
+        if after is not None:
+            items = [it for it in items if logger_recent._played_at_ms(it["played_at"]) > after]
+        return {"items": items[:limit]}
+
+    def artists(self, ids):
+        self._hit("artists")
+        return {"artists": [{"id": a, "name": a, "popularity": 50, "followers": {"total": 1000},
+                             "genres": ["rap"]} for a in ids]}
+
+    def current_user_saved_tracks_contains(self, ids):
+        self._hit("saved_tracks_contains")
+        return [i.endswith(("1", "3")) for i in ids]
+
+
+def legacy_log_recently_played(conn, sp) -> dict:
+    """The pre-batching loop: one artists call per item, one commit per upsert."""
+    items = sp.current_user_recently_played(limit=50).get("items", []) or []
+    new_track_ids, inserted = set(), 0
+    for it in items:
+        t = it.get("track") or {}
+        if not t.get("id"):
+            continue
+        logger_recent.upsert_tracks(conn, [t]); conn.commit()
+        logger_recent.upsert_albums(conn, [t["album"]]); conn.commit()
+        artist_ids = [a["id"] for a in t.get("artists", []) if a.get("id")]
+        if artist_ids:
+            for a in sp.artists(artist_ids)["artists"]:
+                logger_recent.upsert_artists(conn, [a]); conn.commit()
+            for aid in artist_ids:
+                logger_recent.upsert_track_artists(conn, [(t["id"], aid)]); conn.commit()
+        inserted += logger_recent.insert_plays(
+            conn, [(logger_recent._norm_played_at(it["played_at"]), t["id"], (it.get("context") or {}).get("type"))])
+        new_track_ids.add(t["id"])
+    ids = list(new_track_ids)
+    for i in range(0, len(ids), 50):
+        batch = ids[i:i+50]
+        for tid, flag in zip(batch, sp.current_user_saved_tracks_contains(batch)):
+            conn.execute("UPDATE tracks SET is_saved=? WHERE id=?", (1 if flag else 0, tid))
+        conn.commit()
+    return {"fetched": len(items), "inserted": inserted}
+
+
+def run_once(fn, n_items: int, latency: float) -> dict:
+    sp = StubSpotify(n_items, latency)
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(Path(tmp) / "bench.db")
+        logger_recent.db_init(conn)
+        commits = [0]
+        conn.set_trace_callback(lambda sql: commits.__setitem__(0, commits[0] + (sql.strip().upper() == "COMMIT")))
+        t0 = time.perf_counter()
+        stats = fn(conn, sp)
+        wall = time.perf_counter() - t0
+        conn.close()
+    return {"wall_s": round(wall, 4), "api_calls": sum(sp.calls.values()), "calls": sp.calls,
+            "commits": commits[0], "inserted": stats["inserted"]}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="per-item vs batched ingest benchmark")
+    ap.add_argument("--items", type=int, default=50)
+    ap.add_argument("--latency-ms", type=float, default=40.0, help="simulated Spotify round trip")
+    ap.add_argument("--runs", type=int, default=3)
+    args = ap.parse_args()
+    latency = args.latency_ms / 1000.0
+
+    report = {}
+    for label, fn in (("before", legacy_log_recently_played), ("after", logger_recent.log_recently_played)):
+        runs = [run_once(fn, args.items, latency) for _ in range(args.runs)]
+        best = min(runs, key=lambda r: r["wall_s"])
+        report[label] = best
+    report["speedup"] = round(report["before"]["wall_s"] / max(report["after"]["wall_s"], 1e-9), 1)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
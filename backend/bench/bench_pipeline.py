@@ -0,0 +1,211 @@
+# bench/bench_pipeline.py — latency / peak memory / throughput of each lineup stage
+#
+#   python bench/bench_pipeline.py [--sizes 10k,100k,1m] [--dir /tmp/lineup-bench] [--runs 3]
+#   (10m is opt-in: the baseline has it, the default --sizes leave it out)
+#   python bench/bench_pipeline.py --sizes 10k,100k,1m,10m --out bench/baseline.json   # refresh the baseline
+#   python bench/bench_pipeline.py --compare bench/baseline.json         # exit 1 on regressions
+#
+# Shards come from gen_synthetic.py (generated once into --dir and reused).
+# Spotify is an offline stub, so numbers are pure local cost. Stages:
+#   fetch_current_df  30-day frame + image fallback (rows/s = plays in the window)
+#   fetch_current_store  its LINEUP_COLUMNS memory-mapped from featurestore.py (only with pyarrow)
+#   select_lineup     unique-artist top 9 from that frame (rows/s = frame rows)
+#   build_lineup      both of the above plus payload assembly
+#   history_import    legacy history.json -> lineup_history (rows/s = snapshots)
+#   save_history      append SAVE_BATCH changed snapshots (rows/s = snapshots)
+#   read_history      page through the whole history, 100 per page (rows/s = snapshots)
+# Latency is the median of --runs (min_ms is the fastest); peak_mb is a separate
+# tracemalloc'd run. One-time work (history compaction) happens before timing.
+# --compare flags a stage when its median is > --tolerance slower and > MIN_DELTA_MS slower,
+# and its fastest run is > --tolerance slower as well.
+from __future__ import annotations
+import argparse, json, os, platform, shutil, sqlite3, statistics, sys, tempfile, time, tracemalloc
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+_TMP = Path(tempfile.mkdtemp(prefix="lineup-bench-"))
+os.environ.setdefault("IMAGE_CACHE_PATH", str(_TMP / "image_cache.db"))  # before lineup_core import
+os.environ["FEATURE_STORE_DIR"] = str(_TMP / "features")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+import featurestore  # noqa: E402
+import history_store  # noqa: E402
+import lineup_core  # noqa: E402
+import storage  # noqa: E402
+from gen_synthetic import generate  # noqa: E402
+
+SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000, "10m": 10_000_000}
+HISTORY_SNAPSHOTS = 5000
+SAVE_BATCH = 200
+MIN_DELTA_MS = 2.0       # ignore slowdowns smaller than this (timer noise on few-ms stages)
+DEFAULT_TOLERANCE = 0.5  # --compare flags stages more than 50% slower than the baseline
+
+
+class OfflineSpotify:
+    """Answers the image-fallback calls lineup_core makes, without a network."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def tracks(self, ids):
+        self.calls += 1
+        return {"tracks": [{"id": i, "album": {"images": [{"url": f"https://img.example/{i}"}]}} for i in ids]}
+
+    def artists(self, ids):
+        self.calls += 1
+        return {"artists": [{"id": i, "images": [{"url": f"https://img.example/{i}"}]} for i in ids]}
+
+
+def measure(fn, runs: int) -> tuple[list[float], float, object]:
+    """(per-run ms, tracemalloc peak MB, last result)."""
+    times, result = [], None
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - t0) * 1000)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return times, peak / 2**20, result
+
+
+def stage(times: list[float], peak_mb: float, rows: int) -> dict:
+    ms = statistics.median(times)
+    return {"ms": round(ms, 2), "min_ms": round(min(times), 2), "peak_mb": round(peak_mb, 2), "rows": rows,
+            "rows_per_s": round(rows / (ms / 1000)) if ms else None}
+
+
+def bench_size(label: str, plays: int, data_dir: Path, runs: int) -> dict:
+    src = data_dir / f"plays_{label}.db"
+    if not src.exists() or not Path(f"{src}.history.json").exists():
+        print(f"[bench] generating {src} ...", file=sys.stderr)
+        generate(src, plays, history=HISTORY_SNAPSHOTS)
+    db = _TMP / src.name  # work on a copy: image fallback and history writes modify it
+    shutil.copy(src, db)
+    sp = OfflineSpotify()
+    out = {"plays": plays, "stages": {}}
+
+    times, peak, df = measure(lambda: lineup_core.fetch_current_df(db_path=db, sp=sp, feature_store=False), runs)
+    with sqlite3.connect(db) as conn:
+        window_plays = conn.execute("SELECT COALESCE(SUM(plays), 0) FROM track_daily_plays WHERE day >= ?",
+                                    (lineup_core._day_str(datetime.now(timezone.utc) - timedelta(days=29)),)
+                                    ).fetchone()[0]
+    out["stages"]["fetch_current_df"] = stage(times, peak, window_plays)
+    out["frame_rows"] = len(df)
+
+    if featurestore.available():
+        featurestore.refresh(db)
+        times, peak, _ = measure(lambda: lineup_core.fetch_current_df(db_path=db, sp=sp, feature_store=True,
+                                                                     columns=lineup_core.LINEUP_COLUMNS), runs)
+        out["stages"]["fetch_current_store"] = stage(times, peak, window_plays)
+
+    times, peak, _ = measure(lambda: lineup_core.select_lineup(df, top_n=9), runs)
+    out["stages"]["select_lineup"] = stage(times, peak, len(df))
+
+    times, peak, snap = measure(lambda: lineup_core.build_lineup("current", db_path=db, sp=sp), runs)
+    out["stages"]["build_lineup"] = stage(times, peak, window_plays)
+
+    hist_json = Path(f"{src}.history.json")
+    counter = iter(range(10**9))
+
+    def import_history():
+        conn = storage.connect(_TMP / f"hist_{label}_{next(counter)}.db")
+        try:
+            return history_store.import_json(conn, hist_json)
+        finally:
+            conn.close()
+    times, peak, n = measure(import_history, 1)
+    out["stages"]["history_import"] = stage(times, peak, n)
+
+    # save/read against the shard with the imported history; init (and its one-off
+    # compaction of pre-dedup rows) runs here, not inside the first timed save
+    with storage.connection(db) as conn:
+        history_store.import_json(conn, hist_json)
+        history_store.init(conn, legacy_json=None)
+    def save_batch():
+        # each snapshot differs from the previous one in one slot, so rows are delta-encoded, not collapsed
+        for i in range(SAVE_BATCH):
+            lineup = [dict(p) for p in snap["lineup"]]
+            lineup[i % len(lineup)]["score"] = next(counter)
+            lineup_core.save_history({**snap, "lineup": lineup}, db)
+    times, peak, _ = measure(save_batch, runs)
+    out["stages"]["save_history"] = stage(times, peak, SAVE_BATCH)
+
+    def read_all():
+        cursor, total = None, 0
+        while True:
+            page = lineup_core.read_history(mode="current", limit=100, cursor=cursor, db_path=db)
+            total += len(page["history"])
+            cursor = page["next_cursor"]
+            if not cursor:
+                return total
+    times, peak, n = measure(read_all, runs)
+    out["stages"]["read_history"] = stage(times, peak, n)
+    out["spotify_calls"] = sp.calls
+    storage.close_thread_connections()
+    return out
+
+
+def environment() -> dict:
+    return {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "sqlite": sqlite3.sqlite_version, "machine": platform.machine(), "system": platform.system()}
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for size, res in current["sizes"].items():
+        base = baseline.get("sizes", {}).get(size)
+        if not base:
+            continue
+        for name, st in res["stages"].items():
+            ref = base["stages"].get(name)
+            if not ref or not ref["ms"]:
+                continue
+            ratio = st["ms"] / ref["ms"]
+            slower = ratio > 1 + tolerance and st["ms"] - ref["ms"] > MIN_DELTA_MS
+            if slower and ref.get("min_ms") and "min_ms" in st:
+                # a busy machine inflates the median; a real slowdown moves the fastest run too
+                slower = st["min_ms"] / ref["min_ms"] > 1 + tolerance
+            flag = "REGRESSION" if slower else ""
+            print(f"{size:>5} {name:<17} {ref['ms']:>10.2f} -> {st['ms']:>10.2f} ms  x{ratio:5.2f} {flag}")
+            if flag:
+                regressions.append(f"{size}/{name}")
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(description="lineup pipeline benchmarks (offline)")
+    ap.add_argument("--sizes", default="10k,100k,1m", help=f"comma list of {','.join(SIZES)}")
+    ap.add_argument("--dir", type=Path, default=Path(tempfile.gettempdir()) / "lineup-bench",
+                    help="where generated shards are cached")
+    ap.add_argument("--runs", type=int, default=5, help="timed runs per stage (median is reported)")
+    ap.add_argument("--out", type=Path, help="write results JSON here (e.g. bench/baseline.json)")
+    ap.add_argument("--compare", type=Path, help="baseline JSON to compare against")
+    ap.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = ap.parse_args()
+
+    results = {"env": environment(), "runs": args.runs, "sizes": {}}
+    try:
+        for label in args.sizes.split(","):
+            results["sizes"][label] = bench_size(label, SIZES[label], args.dir, args.runs)
+            print(f"[bench] {label} done", file=sys.stderr)
+    finally:
+        shutil.rmtree(_TMP, ignore_errors=True)
+
+    if args.out:
+        args.out.write_text(json.dumps(results, indent=2) + "\n", encoding="utf-8")
+    if args.compare:
+        regressions = compare(results, json.loads(args.compare.read_text(encoding="utf-8")), args.tolerance)
+        if regressions:
+            print(f"regressions: {', '.join(regressions)}")
+            raise SystemExit(1)
+    elif not args.out:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
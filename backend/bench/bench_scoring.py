@@ -0,0 +1,108 @@
+# bench/bench_scoring.py — pandas HIv2 (pre-scoring.py) vs the NumPy scoring engine
+#
+#   python bench/bench_scoring.py [--tracks 300] [--users 50] [--runs 5]
+#
+# Checks that scoring.py reproduces the legacy HIv2 values, then times one
+# user, many users one at a time, and many users x profiles in one batch.
+from __future__ import annotations
+import argparse, json, sys, time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import scoring  # noqa: E402
+
+
+def synthetic_frame(n: int, seed: int) -> pd.DataFrame:
+    """A fetch_current_df-shaped frame (the columns scoring reads)."""
+    rng = np.random.default_rng(seed)
+    plays_7d = rng.poisson(2, n)
+    plays_prev7d = rng.poisson(2, n)
+    dsr = rng.integers(1, 8000, n).astype(float)
+    dsr[rng.random(n) < 0.05] = np.nan  # unknown release dates
+    return pd.DataFrame({
+        "plays_7d": plays_7d,
+        "plays_prev7d": plays_prev7d,
+        "plays_30d": plays_7d + plays_prev7d + rng.poisson(3, n),
+        "distinct_days": rng.integers(1, 30, n),
+        "contexts_n": rng.integers(0, 4, n),
+        "popularity": rng.integers(0, 100, n).astype(float),
+        "artist_pop": rng.uniform(0, 100, n),
+        "artist_followers": rng.lognormal(12, 2, n),
+        "is_saved": rng.integers(0, 2, n).astype(float),
+        "days_since_release": dsr,
+    })
+
+
+def _z(s: pd.Series) -> pd.Series:
+    s = s.astype(float)
+    mu, sd = s.mean(), s.std()
+    if sd == 0 or np.isnan(sd):
+        sd = 1.0
+    return (s - mu) / sd
+
+
+def legacy_hiv2(df: pd.DataFrame) -> pd.Series:
+    """The column-by-column HIv2 fetch_current_df used to compute."""
+    df = df.copy()
+    df["artist_followers_log"] = np.log1p(df["artist_followers"].fillna(0))
+    df["z_plays30"] = _z(df["plays_30d"])
+    df["z_momentum"] = _z(df["plays_7d"] - df["plays_prev7d"])
+    df["z_popularity"] = _z(df["popularity"].fillna(0))
+    df["z_clout"] = 0.5 * _z(df["artist_pop"].fillna(0)) + 0.5 * _z(df["artist_followers_log"])
+    df["z_affinity"] = _z(df["is_saved"].fillna(0))
+    df["z_diversity"] = 0.5 * _z(df["distinct_days"]) + 0.5 * _z(df["contexts_n"])
+    dsr = df["days_since_release"].fillna(df["days_since_release"].median())
+    df["z_recency"] = -(dsr - dsr.mean()) / (dsr.std() or 1.0)
+    w = {"z_plays30": 0.35, "z_momentum": 0.20, "z_popularity": 0.15, "z_clout": 0.10,
+         "z_recency": 0.10, "z_affinity": 0.07, "z_diversity": 0.03}
+    return sum(w[k] * df[k] for k in w)
+
+
+def best_of(fn, runs: int) -> float:
+    best = float("inf")
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return round(best * 1000, 3)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--tracks", type=int, default=300, help="tracks per user")
+    ap.add_argument("--users", type=int, default=50)
+    ap.add_argument("--runs", type=int, default=5)
+    args = ap.parse_args()
+
+    frames = [synthetic_frame(args.tracks, seed) for seed in range(args.users)]
+    profiles = ["hiv2-current@1", "hiv2-alltime@1"]
+
+    batch = scoring.score_many(frames, profiles)
+    max_diff = max(float(np.max(np.abs(legacy_hiv2(df).to_numpy() - out[:, 0]))) for df, out in zip(frames, batch))
+    assert max_diff < 1e-9, f"scores diverge from legacy HIv2 (max |diff| {max_diff})"
+
+    one = frames[0]
+    raws = [scoring.raw_matrix(df) for df in frames]
+    report = {
+        "tracks_per_user": args.tracks,
+        "users": args.users,
+        "max_abs_diff_vs_legacy": max_diff,
+        "ms": {
+            "legacy_1_user": best_of(lambda: legacy_hiv2(one), args.runs),
+            "engine_1_user": best_of(lambda: scoring.score_many([one], profiles[:1]), args.runs),
+            "legacy_users_loop": best_of(lambda: [legacy_hiv2(df) for df in frames], args.runs),
+            "engine_users_batch": best_of(lambda: scoring.score_many(frames, profiles[:1]), args.runs),
+            "engine_users_x_profiles_batch": best_of(lambda: scoring.score_many(frames, profiles), args.runs),
+            # frame -> matrix conversion excluded: the kernel alone
+            "kernel_1_user": best_of(lambda: scoring.score_matrices(raws[:1], profiles[:1]), args.runs),
+            "kernel_users_x_profiles_batch": best_of(lambda: scoring.score_matrices(raws, profiles), args.runs),
+        },
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
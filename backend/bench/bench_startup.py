@@ -0,0 +1,114 @@
+# bench/bench_startup.py — cold-start cost of the API: import time, time to /health and to warm
+#
+#   python bench/bench_startup.py [--runs 5] [--budget-ms 900] [--top 12] [--no-server]
+#
+# 1. `python -X importtime -c "import main"` (best of --runs): total import
+#    time, the slowest top-level imports, and whether any module in
+#    FORBIDDEN was loaded. main.py promises those stay out of its import path.
+# 2. Spawns uvicorn and polls: time until /health answers, and until
+#    /healthz reports the background warm-up ready.
+# Exits 1 when the import exceeds --budget-ms or a forbidden module is imported.
+from __future__ import annotations
+import argparse, json, os, re, socket, subprocess, sys, time, urllib.request
+from pathlib import Path
+
+BACKEND = Path(__file__).resolve().parents[1]
+FORBIDDEN = ("pandas", "numpy", "spotipy", "requests", "lineup_core", "logger_recent")
+IMPORT_BUDGET_MS = 900.0  # fastapi alone is most of this; see the report's "top" list
+SERVER_TIMEOUT_S = 60
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_profile(module: str = "main") -> dict:
+    """One fresh interpreter importing `module` under -X importtime."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=BACKEND,
+                          capture_output=True, text=True, env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"})
+    if proc.returncode:
+        raise SystemExit(f"import {module} failed:\n{proc.stderr[-2000:]}")
+    rows = []
+    for line in proc.stderr.splitlines():
+        m = _LINE.match(line)
+        if m:
+            rows.append({"module": m.group(4), "self_us": int(m.group(1)), "cumulative_us": int(m.group(2)),
+                         "depth": len(m.group(3)) // 2})
+    at = next(i for i, r in enumerate(rows) if r["module"] == module and r["depth"] == 0)
+    children = []  # importtime lists a module's imports right before it
+    for r in reversed(rows[:at]):
+        if r["depth"] == 0:
+            break
+        if r["depth"] == 1:
+            children.append(r)
+    return {"total_ms": rows[at]["cumulative_us"] / 1000, "children": children,
+            "modules": {r["module"] for r in rows}}
+
+
+def _get(url: str) -> dict | None:
+    try:
+        with urllib.request.urlopen(url, timeout=1) as resp:
+            return json.loads(resp.read())
+    except Exception:
+        return None
+
+
+def server_start() -> dict:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+                            cwd=BACKEND, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    out = {"health_ms": None, "ready_ms": None}
+    try:
+        while time.perf_counter() - t0 < SERVER_TIMEOUT_S and proc.poll() is None:
+            if out["health_ms"] is None and _get(f"http://127.0.0.1:{port}/health"):
+                out["health_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+            if out["health_ms"] is not None:
+                body = _get(f"http://127.0.0.1:{port}/healthz")
+                if body and (body.get("ready") or body.get("warmup_error")):
+                    out["ready_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+                    out["warmup_s"] = body.get("warmup_s")
+                    out["warmup_error"] = body.get("warmup_error")
+                    break
+            time.sleep(0.02)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description="API cold-start benchmark")
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    ap.add_argument("--top", type=int, default=12, help="slowest direct imports of main to list")
+    ap.add_argument("--no-server", action="store_true", help="skip the uvicorn start-up timing")
+    args = ap.parse_args()
+
+    profiles = [import_profile() for _ in range(args.runs)]
+    best = min(profiles, key=lambda p: p["total_ms"])
+    direct = sorted(best["children"], key=lambda r: -r["cumulative_us"])
+    forbidden = sorted(m for m in FORBIDDEN if any(p["modules"] & {m} for p in profiles))
+    report = {
+        "import_main_ms": round(best["total_ms"], 1),
+        "import_main_ms_runs": [round(p["total_ms"], 1) for p in profiles],
+        "budget_ms": args.budget_ms,
+        "modules_loaded": len(best["modules"]),
+        "forbidden_loaded": forbidden,
+        "top": [{"module": r["module"], "ms": round(r["cumulative_us"] / 1000, 1)} for r in direct[:args.top]],
+    }
+    if not args.no_server:
+        report["server"] = [server_start() for _ in range(min(args.runs, 3))]
+    print(json.dumps(report, indent=2))
+
+    failures = []
+    if report["import_main_ms"] > args.budget_ms:
+        failures.append(f"import main took {report['import_main_ms']} ms (budget {args.budget_ms} ms)")
+    if forbidden:
+        failures.append(f"import main loaded {', '.join(forbidden)}")
+    if failures:
+        print("FAIL: " + "; ".join(failures), file=sys.stderr)
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# bench/gen_synthetic.py — synthetic data.db files for the pipeline benchmarks
+#
+#   python bench/gen_synthetic.py --plays 1000000 --out /tmp/lineup-bench/plays_1m.db [--history 5000]
+#
+# Builds a fully migrated shard (storage.MIGRATIONS) with:
+#   - plays spread over clamp(plays/100, 60, 3650) days ending now, track
+#     choice Zipf-like (a few tracks dominate, a long tail barely plays)
+#   - tracks ~ plays/20 (500..200k), albums ~ tracks/8, artists ~ tracks/5,
+#     1-3 artists per track and collab-style names ("A feat. B", "X & Y", ...)
+#   - ~10% of albums/artists without an image_url, so the fallback path runs
+# plus <out>.history.json: a legacy-format lineup history with --history snapshots.
+from __future__ import annotations
+import argparse, json, sys, time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import storage  # noqa: E402
+
+CONTEXTS = np.array(["album", "playlist", "artist", None], dtype=object)
+_SEPARATORS = [" feat. ", " & ", ", ", " x ", " and ", " with "]
+INSERT_CHUNK = 200_000
+
+
+def cardinalities(plays: int) -> dict:
+    tracks = int(min(200_000, max(500, plays // 20)))
+    return {"tracks": tracks, "albums": max(50, tracks // 8), "artists": max(100, tracks // 5),
+            "days": int(min(3650, max(60, plays // 100)))}
+
+
+def _artist_names(rng, n: int) -> list[str]:
+    names = []
+    for i in range(n):
+        r = rng.random()
+        if r < 0.08:    # names that themselves contain collab separators
+            names.append(f"Artist {i}{rng.choice(_SEPARATORS)}Guest {rng.integers(0, n)}")
+        elif r < 0.12:
+            names.append(f"The {i} Band, The")
+        else:
+            names.append(f"Artist {i}")
+    return names
+
+
+def generate(out: Path, plays: int, history: int = 0, seed: int = 7) -> dict:
+    t0 = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    card = cardinalities(plays)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    for suffix in ("", "-wal", "-shm"):
+        Path(f"{out}{suffix}").unlink(missing_ok=True)
+
+    conn = storage.connect(out)
+    n_tr, n_al, n_ar = card["tracks"], card["albums"], card["artists"]
+
+    artist_names = _artist_names(rng, n_ar)
+    artists = [(f"ar{i:06d}", artist_names[i], int(rng.integers(0, 100)), int(rng.lognormal(10, 2.5)), "[]",
+                None if rng.random() < 0.1 else f"https://img.example/ar{i}") for i in range(n_ar)]
+    albums = [(f"al{i:06d}", f"Album {i}",
+               (datetime(1970, 1, 1) + timedelta(days=int(rng.integers(0, 20000)))).strftime("%Y-%m-%d"),
+               None if rng.random() < 0.1 else f"https://img.example/al{i}") for i in range(n_al)]
+    tracks = [(f"tr{i:07d}", f"Track {i}", int(rng.integers(90_000, 400_000)), int(rng.integers(0, 100)),
+               f"al{int(rng.integers(0, n_al)):06d}", int(rng.random() < 0.3)) for i in range(n_tr)]
+    track_artists = []
+    for i in range(n_tr):
+        for a in dict.fromkeys(rng.integers(0, n_ar, rng.choice([1, 1, 1, 2, 3]))):  # primary first
+            track_artists.append((f"tr{i:07d}", f"ar{int(a):06d}"))
+
+    # Zipf-like popularity over tracks, timestamps uniform over the span
+    weights = 1.0 / np.arange(1, n_tr + 1) ** 1.07
+    track_idx = rng.choice(n_tr, size=plays, p=weights / weights.sum())
+    now = np.datetime64(datetime.now(timezone.utc).replace(tzinfo=None), "us")
+    offsets = np.sort(rng.integers(0, card["days"] * 86_400_000_000, plays))[::-1]
+    stamps = np.unique(now - offsets.astype("timedelta64[us]"))  # played_at is the key
+    ctx = CONTEXTS[rng.integers(0, len(CONTEXTS), len(stamps))]
+
+    # bulk load without the per-row trigger / secondary indexes, then rebuild them
+    ddl = conn.execute("""SELECT name, sql FROM sqlite_master WHERE tbl_name='plays'
+                          AND type IN ('index', 'trigger') AND sql IS NOT NULL""").fetchall()
+    with conn:
+        for name, sql in ddl:
+            conn.execute(f"DROP {'TRIGGER' if sql.upper().startswith('CREATE TRIGGER') else 'INDEX'} {name}")
+        conn.executemany("INSERT INTO artists VALUES(?,?,?,?,?,?)", artists)
+        conn.executemany("INSERT INTO albums VALUES(?,?,?,?)", albums)
+        conn.executemany("INSERT INTO tracks VALUES(?,?,?,?,?,?)", tracks)
+        conn.executemany("INSERT INTO track_artists VALUES(?,?)", track_artists)
+    for i in range(0, len(stamps), INSERT_CHUNK):
+        s = np.datetime_as_string(stamps[i:i + INSERT_CHUNK], unit="us")
+        with conn:
+            conn.executemany("INSERT INTO plays(played_at, track_id, context) VALUES(?,?,?)",
+                             ((p + "Z", f"tr{t:07d}", c) for p, t, c in
+                              zip(s, track_idx[i:i + INSERT_CHUNK], ctx[i:i + INSERT_CHUNK])))
+    with conn:
+        for _, sql in ddl:
+            conn.execute(sql)
+        storage.backfill_daily_rollup(conn)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+    hist_path = Path(f"{out}.history.json")
+    if history:
+        _write_history(hist_path, history, n_tr, artist_names, rng)
+    return {"db": str(out), "plays": int(len(stamps)), **card, "history_snapshots": history,
+            "seconds": round(time.perf_counter() - t0, 1)}
+
+
+def _write_history(path: Path, n: int, n_tracks: int, artist_names: list[str], rng) -> None:
+    """Legacy history.json: daily snapshots where ~1-3 of 9 slots change per day."""
+    positions = ["CF", "SS", "RF", "1B", "2B", "3B", "C", "LF", "P"]
+    start = datetime.now(timezone.utc) - timedelta(days=n)
+    current = [int(x) for x in rng.choice(n_tracks, 9, replace=False)]
+    with open(path, "w", encoding="utf-8") as fh:
+        fh.write("[")
+        for d in range(n):
+            for _ in range(int(rng.integers(0, 4))):
+                current[int(rng.integers(0, 9))] = int(rng.integers(0, n_tracks))
+            snap = {
+                "mode": "current", "title": "CURRENT (30-Day Trend)",
+                "date": (start + timedelta(days=d)).isoformat(),
+                "lineup": [{"track": f"Track {t}", "title": f"Track {t}",
+                            "artist": artist_names[t % len(artist_names)], "position": positions[k],
+                            "score": round(float(rng.normal(1.0, 0.3)), 6), "popularity": t % 100,
+                            "track_id": f"tr{t:07d}", "album_cover": None, "artist_image": None}
+                           for k, t in enumerate(current)],
+                "team_profile": None, "star_player": None,
+            }
+            fh.write(("," if d else "") + json.dumps(snap))
+        fh.write("]")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="generate a synthetic lineup shard")
+    ap.add_argument("--plays", type=int, required=True)
+    ap.add_argument("--out", type=Path, required=True)
+    ap.add_argument("--history", type=int, default=0, help="snapshots in <out>.history.json")
+    ap.add_argument("--seed", type=int, default=7)
+    args = ap.parse_args()
+    print(json.dumps(generate(args.out, args.plays, args.history, args.seed), indent=2))
+
+
+if __name__ == "__main__":
+    main()
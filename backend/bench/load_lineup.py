@@ -0,0 +1,162 @@
+# bench/load_lineup.py — N concurrent simulated users against /lineup/current, offline
+#
+#   python bench/load_lineup.py --users 20 --duration 30                  # spawns its own server
+#   python bench/load_lineup.py --users 50 --latency-ms 150 --rate-429 0.02 --swr
+#   python bench/load_lineup.py --url http://localhost:8000 --users 10    # an already-running server
+#
+# The spawned server runs with FAKE_SPOTIFY=1 (see fake_spotify.py) and
+# throwaway shard / token-cache / image-cache directories; every simulated
+# user gets a fake token cache and a uid cookie. With --url the server must
+# already be set up that way (same SPOTIPY_CACHE_DIR for the token files).
+# Each user requests the lineup in a loop (optionally with --think-ms between
+# requests). Reports throughput, status counts and latency percentiles, with
+# each user's first (cold: ingest + build) request also reported separately.
+from __future__ import annotations
+import argparse, json, os, shutil, socket, subprocess, sys, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import requests
+
+BACKEND = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(BACKEND))
+import fake_spotify  # noqa: E402
+
+STARTUP_TIMEOUT_S = 60
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawn_server(args, workdir: Path) -> tuple[subprocess.Popen, str]:
+    port = args.port or _free_port()
+    env = {**os.environ,
+           "FAKE_SPOTIFY": "1",
+           "SPOTIPY_CACHE_DIR": str(workdir),
+           "DATA_SHARD_DIR": str(workdir / "shards"),
+           "IMAGE_CACHE_PATH": str(workdir / "image_cache.db"),
+           "FAKE_SPOTIFY_LATENCY_MS": str(args.latency_ms),
+           "FAKE_SPOTIFY_JITTER_MS": str(args.jitter_ms),
+           "FAKE_SPOTIFY_ERROR_RATE": str(args.error_rate),
+           "FAKE_SPOTIFY_429_RATE": str(args.rate_429),
+           "FAKE_SPOTIFY_MAX_RPS": str(args.max_rps)}
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+                             "--log-level", "warning"], cwd=BACKEND, env=env,
+                            stdout=subprocess.DEVNULL if not args.server_log else None,
+                            stderr=subprocess.STDOUT if not args.server_log else None)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + STARTUP_TIMEOUT_S
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"server exited during startup (code {proc.returncode})")
+        try:
+            if requests.get(f"{url}/health", timeout=1).ok:
+                return proc, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit("server did not come up")
+
+
+def run_user(i: int, url: str, args, stop_at: float, samples: list, lock: threading.Lock) -> None:
+    s = requests.Session()
+    s.cookies.set("uid", f"{args.uid_prefix}{i:04d}")
+    params = {"swr": "1"} if args.swr else {}
+    first = True
+    while time.monotonic() < stop_at:
+        t0 = time.perf_counter()
+        try:
+            status = s.get(f"{url}{args.path}", params=params, timeout=args.timeout).status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        ms = (time.perf_counter() - t0) * 1000
+        with lock:
+            samples.append((ms, status, first))
+        first = False
+        if args.think_ms:
+            time.sleep(args.think_ms / 1000)
+
+
+def summarize(samples: list, elapsed: float) -> dict:
+    def pct(values: list[float]) -> dict:
+        if not values:
+            return {}
+        a = np.asarray(values)
+        return {"n": len(a), "mean": round(float(a.mean()), 1),
+                **{f"p{q}": round(float(np.percentile(a, q)), 1) for q in (50, 90, 95, 99)},
+                "max": round(float(a.max()), 1)}
+    statuses: dict[str, int] = {}
+    for _, status, _ in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ok = [ms for ms, status, _ in samples if status in (200, 304)]
+    return {
+        "requests": len(samples),
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(samples) / elapsed, 1) if elapsed else None,
+        "status": statuses,
+        "latency_ms": pct(ok),
+        "cold_latency_ms": pct([ms for ms, status, first in samples if first and status in (200, 304)]),
+        "warm_latency_ms": pct([ms for ms, status, first in samples if not first and status in (200, 304)]),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="concurrent lineup load test against a fake Spotify")
+    ap.add_argument("--users", type=int, default=20)
+    ap.add_argument("--duration", type=float, default=30, help="seconds of load")
+    ap.add_argument("--think-ms", type=float, default=0, help="pause between a user's requests")
+    ap.add_argument("--path", default="/lineup/current")
+    ap.add_argument("--swr", action="store_true", help="request with ?swr=1")
+    ap.add_argument("--timeout", type=float, default=120)
+    ap.add_argument("--uid-prefix", default="loaduser-")
+    ap.add_argument("--url", help="use a running server instead of spawning one")
+    ap.add_argument("--port", type=int)
+    ap.add_argument("--server-log", action="store_true", help="show the spawned server's output")
+    ap.add_argument("--cache-dir", type=Path, help="token cache dir of the --url server (SPOTIPY_CACHE_DIR)")
+    # fake Spotify knobs (spawned server only)
+    ap.add_argument("--latency-ms", type=float, default=80)
+    ap.add_argument("--jitter-ms", type=float, default=30)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--rate-429", type=float, default=0.0)
+    ap.add_argument("--max-rps", type=float, default=0.0)
+    args = ap.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="lineup-load-"))
+    token_dir = args.cache_dir if args.url else workdir
+    if args.url and not token_dir:
+        ap.error("--url needs --cache-dir (the server's SPOTIPY_CACHE_DIR)")
+    for i in range(args.users):
+        uid = f"{args.uid_prefix}{i:04d}"
+        fake_spotify.write_token_cache(uid, Path(token_dir) / f".spotipy-cache-{uid}")
+
+    proc = None
+    try:
+        if args.url:
+            url = args.url.rstrip("/")
+        else:
+            proc, url = spawn_server(args, workdir)
+        samples: list = []
+        lock = threading.Lock()
+        t0 = time.monotonic()
+        stop_at = t0 + args.duration
+        with ThreadPoolExecutor(max_workers=args.users) as pool:
+            for i in range(args.users):
+                pool.submit(run_user, i, url, args, stop_at, samples, lock)
+        report = {"users": args.users, "path": args.path, "swr": args.swr,
+                  "fake_spotify": {k: getattr(args, k) for k in
+                                   ("latency_ms", "jitter_ms", "error_rate", "rate_429", "max_rps")},
+                  **summarize(samples, time.monotonic() - t0)}
+        print(json.dumps(report, indent=2))
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait(timeout=10)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
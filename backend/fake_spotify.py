@@ -0,0 +1,363 @@
+# fake_spotify.py — offline stand-in for the Spotify Web API, mounted as a requests transport
+#
+#   FAKE_SPOTIFY=1 uvicorn main:app            # every Spotify call is answered locally
+#   python fake_spotify.py token --uid alice   # write a token cache so alice counts as logged in
+#   python fake_spotify.py record --uid UID --out fixtures.json   # capture real responses once
+#
+# spotify_clients.shared_session() mounts FakeSpotifyAdapter on api.spotify.com
+# and accounts.spotify.com when FAKE_SPOTIFY=1, so spotipy, the OAuth flow and
+# every caller keep their real code paths; only the socket is replaced.
+#
+# Users are identified by their bearer token ("fake:<uid>"). /callback?code=<uid>
+# completes a fake login for <uid>. Each user has an endless, deterministic
+# listening history (one play every PLAY_SPACING_S, Zipf-ish over a generated
+# catalog), so repeated ingests keep finding new plays. Responses come from
+# FAKE_SPOTIFY_FIXTURES (recorded JSON) when it has them, otherwise they are
+# generated. Latency, 5xx errors, random 429s and an app-wide requests/second
+# cap (429 + Retry-After once exceeded) are configurable via env.
+from __future__ import annotations
+import hashlib, json, os, random, threading, time
+from collections import Counter, deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+API_PREFIX = "https://api.spotify.com"
+ACCOUNTS_PREFIX = "https://accounts.spotify.com"
+TOKEN_PREFIX = "fake:"
+PLAY_SPACING_S = 210           # one generated play every 3.5 minutes, per user
+HISTORY_START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+_CONTEXTS = ("album", "playlist", "artist", None)
+
+
+@dataclass
+class FakeConfig:
+    latency_ms: float = float(os.getenv("FAKE_SPOTIFY_LATENCY_MS", "80"))
+    jitter_ms: float = float(os.getenv("FAKE_SPOTIFY_JITTER_MS", "30"))
+    error_rate: float = float(os.getenv("FAKE_SPOTIFY_ERROR_RATE", "0"))      # fraction answered 503
+    rate_429: float = float(os.getenv("FAKE_SPOTIFY_429_RATE", "0"))          # fraction answered 429
+    max_rps: float = float(os.getenv("FAKE_SPOTIFY_MAX_RPS", "0"))            # app-wide cap, 0 = none
+    retry_after_s: int = int(os.getenv("FAKE_SPOTIFY_RETRY_AFTER_S", "2"))
+    tracks: int = int(os.getenv("FAKE_SPOTIFY_TRACKS", "5000"))
+    fixtures: str | None = os.getenv("FAKE_SPOTIFY_FIXTURES")
+    seed: int = int(os.getenv("FAKE_SPOTIFY_SEED", "7"))
+
+
+# ---------- generated catalog ----------
+def _h(*parts) -> int:
+    return int.from_bytes(hashlib.blake2b("|".join(map(str, parts)).encode(), digest_size=8).digest(), "big")
+
+
+@dataclass
+class Catalog:
+    """Deterministic tracks/albums/artists, built on demand from their index."""
+    n_tracks: int = 5000
+    seed: int = 7
+
+    @property
+    def n_albums(self) -> int:
+        return max(10, self.n_tracks // 8)
+
+    @property
+    def n_artists(self) -> int:
+        return max(10, self.n_tracks // 5)
+
+    def artist(self, i: int, full: bool = True) -> dict:
+        a = {"id": f"fkar{i:06d}", "name": f"Fake Artist {i}", "type": "artist", "uri": f"spotify:artist:fkar{i:06d}"}
+        if full:
+            h = _h(self.seed, "ar", i)
+            a.update(popularity=h % 100, followers={"total": h % 5_000_000}, genres=["fake"],
+                     images=[] if h % 10 == 0 else [{"url": f"https://img.fake/ar/{i}", "height": 640, "width": 640}])
+        return a
+
+    def album(self, i: int) -> dict:
+        h = _h(self.seed, "al", i)
+        return {"id": f"fkal{i:06d}", "name": f"Fake Album {i}", "type": "album",
+                "release_date": f"{1970 + h % 55}-{1 + h % 12:02d}-{1 + h % 28:02d}",
+                "images": [] if h % 10 == 0 else [{"url": f"https://img.fake/al/{i}", "height": 640, "width": 640}]}
+
+    def track(self, i: int) -> dict:
+        h = _h(self.seed, "tr", i)
+        artists = [self.artist(h % self.n_artists, full=False)]
+        if h % 7 == 0:  # a feature
+            artists.append(self.artist((h >> 16) % self.n_artists, full=False))
+        return {"id": f"fktr{i:07d}", "name": f"Fake Track {i}", "type": "track", "uri": f"spotify:track:fktr{i:07d}",
+                "duration_ms": 90_000 + h % 300_000, "popularity": (h >> 8) % 100,
+                "album": self.album(i % self.n_albums), "artists": artists}
+
+    @staticmethod
+    def index(spotify_id: str, prefix: str) -> int | None:
+        if spotify_id.startswith(prefix) and spotify_id[len(prefix):].isdigit():
+            return int(spotify_id[len(prefix):])
+        return None
+
+    # ---- per-user listening ----
+    def play(self, uid: str, n: int) -> dict:
+        """The n-th play of uid's endless history."""
+        h = _h(self.seed, uid, n)
+        u = (h % 1_000_000) / 1_000_000
+        track = int(self.n_tracks * u ** 3)  # skewed: low indexes dominate, each user slightly differently
+        track = (track + _h(uid) % 97) % self.n_tracks
+        ts = HISTORY_START.timestamp() + n * PLAY_SPACING_S + h % 60
+        ctx = _CONTEXTS[h % len(_CONTEXTS)]
+        return {"track": self.track(track),
+                "played_at": datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+                "context": {"type": ctx, "uri": f"spotify:{ctx}:x"} if ctx else None,
+                "_ms": int(ts * 1000)}
+
+    def plays_before(self, uid: str, before_ms: int, limit: int) -> list[dict]:
+        last = int((before_ms / 1000 - HISTORY_START.timestamp()) // PLAY_SPACING_S)
+        out = [p for p in (self.play(uid, n) for n in range(last, max(-1, last - limit - 1), -1)) if p["_ms"] < before_ms]
+        return out[:limit]
+
+    def plays_after(self, uid: str, after_ms: int, limit: int, now_ms: int) -> tuple[list[dict], bool]:
+        """Oldest `limit` plays after after_ms (returned newest first) and whether more exist."""
+        n = max(0, int((after_ms / 1000 - HISTORY_START.timestamp()) // PLAY_SPACING_S))
+        out = []
+        while len(out) <= limit:
+            p = self.play(uid, n)
+            if p["_ms"] > now_ms:
+                break
+            if p["_ms"] > after_ms:
+                out.append(p)
+            n += 1
+        return out[:limit][::-1], len(out) > limit
+
+    def top_tracks(self, uid: str, time_range: str, limit: int, offset: int) -> list[dict]:
+        rng = random.Random(_h(self.seed, uid, time_range))
+        picks = list(dict.fromkeys(int(self.n_tracks * rng.random() ** 3) for _ in range(200)))
+        return [self.track(i) for i in picks[offset:offset + limit]]
+
+    def is_saved(self, uid: str, track_id: str) -> bool:
+        return _h(self.seed, uid, "saved", track_id) % 10 < 3
+
+
+# ---------- transport ----------
+class FakeSpotifyAdapter(BaseAdapter):
+    """requests adapter that answers Spotify API/accounts URLs without a network."""
+
+    def __init__(self, config: FakeConfig | None = None):
+        super().__init__()
+        self.config = config or FakeConfig()
+        self.catalog = Catalog(self.config.tracks, self.config.seed)
+        self.fixtures = self._load_fixtures(self.config.fixtures)
+        self._rng = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+        self._window: deque[float] = deque()   # request times within the last second
+        self.counts: Counter = Counter()
+
+    @staticmethod
+    def _load_fixtures(path: str | None) -> dict:
+        if not path:
+            return {}
+        try:
+            return json.loads(Path(path).read_text(encoding="utf-8"))
+        except Exception as e:
+            print(f"[WARN] fake spotify fixtures ignored ({path}): {e}")
+            return {}
+
+    def close(self):
+        pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.counts)
+
+    # ---- injection ----
+    def _inject(self) -> tuple[int, dict] | None:
+        cfg = self.config
+        with self._lock:
+            now = time.monotonic()
+            r = self._rng.random()
+            if cfg.max_rps:
+                while self._window and now - self._window[0] > 1.0:
+                    self._window.popleft()
+                if len(self._window) >= cfg.max_rps:
+                    self.counts["injected_429"] += 1
+                    return 429, {"Retry-After": str(cfg.retry_after_s)}
+                self._window.append(now)
+            if r < cfg.rate_429:
+                self.counts["injected_429"] += 1
+                return 429, {"Retry-After": str(cfg.retry_after_s)}
+            if r < cfg.rate_429 + cfg.error_rate:
+                self.counts["injected_5xx"] += 1
+                return 503, {}
+            delay = max(0.0, self._rng.gauss(cfg.latency_ms, cfg.jitter_ms)) / 1000
+        if delay:
+            time.sleep(delay)
+        return None
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        parts = urlsplit(request.url)
+        path = parts.path.rstrip("/")  # spotipy asks for e.g. /v1/artists/?ids=...
+        query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        self.counts[f"{request.method} {path}"] += 1
+        injected = self._inject()
+        if injected:
+            status, headers = injected
+            body = {"error": {"status": status, "message": "API rate limit exceeded" if status == 429
+                              else "Service unavailable"}}
+            return self._response(request, status, body, headers)
+        try:
+            if request.url.startswith(ACCOUNTS_PREFIX):
+                status, body = self._token(request)
+            else:
+                status, body = self._api(request, path, query)
+        except Exception as e:  # a bug in the fake should look like a server error, not hang the caller
+            status, body = 500, {"error": {"status": 500, "message": f"{type(e).__name__}: {e}"}}
+        return self._response(request, status, body)
+
+    @staticmethod
+    def _response(request, status: int, body, headers: dict | None = None) -> requests.Response:
+        resp = requests.Response()
+        resp.status_code = status
+        resp.reason = requests.status_codes._codes.get(status, ("",))[0].upper().replace("_", " ")
+        resp._content = b"" if body is None else json.dumps(body).encode()
+        resp.headers = CaseInsensitiveDict({"Content-Type": "application/json", **(headers or {})})
+        resp.encoding = "utf-8"
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    # ---- accounts.spotify.com ----
+    def _token(self, request) -> tuple[int, dict]:
+        form = {k: v[-1] for k, v in parse_qs(request.body if isinstance(request.body, str)
+                                              else (request.body or b"").decode()).items()}
+        if form.get("grant_type") == "authorization_code":
+            uid = form.get("code") or "fake-user"       # /callback?code=<uid> logs in as <uid>
+        elif form.get("grant_type") == "refresh_token":
+            uid = (form.get("refresh_token") or "").removeprefix(TOKEN_PREFIX) or "fake-user"
+        else:
+            return 400, {"error": "unsupported_grant_type"}
+        return 200, token_info(uid, with_expiry=False)
+
+    # ---- api.spotify.com ----
+    def _api(self, request, path: str, query: dict) -> tuple[int, dict | list | None]:
+        auth = request.headers.get("Authorization", "")
+        if not auth.startswith(f"Bearer {TOKEN_PREFIX}"):
+            return 401, {"error": {"status": 401, "message": "Invalid access token"}}
+        uid = auth.removeprefix(f"Bearer {TOKEN_PREFIX}")
+
+        recorded = self.fixtures.get("responses", {})
+        key = f"{path}?{urlsplit(request.url).query}" if query else path
+        if key in recorded or path in recorded:
+            return 200, recorded.get(key, recorded.get(path))
+
+        limit = int(query.get("limit", 20))
+        if path == "/v1/me":
+            return 200, {"id": uid, "display_name": uid, "type": "user", "uri": f"spotify:user:{uid}"}
+        if path == "/v1/me/player/recently-played":
+            return 200, self._recently_played(uid, query, min(limit, 50))
+        if path == "/v1/me/top/tracks":
+            items = self.catalog.top_tracks(uid, query.get("time_range", "medium_term"), min(limit, 50),
+                                            int(query.get("offset", 0)))
+            return 200, {"items": items, "total": 200, "limit": limit, "next": None}
+        if path == "/v1/me/tracks/contains":
+            return 200, [self.catalog.is_saved(uid, i) for i in query.get("ids", "").split(",") if i]
+        if path == "/v1/tracks":
+            return 200, {"tracks": [self._lookup("tracks", i) for i in query.get("ids", "").split(",") if i]}
+        if path == "/v1/artists":
+            return 200, {"artists": [self._lookup("artists", i) for i in query.get("ids", "").split(",") if i]}
+        return 404, {"error": {"status": 404, "message": f"fake spotify: no handler for {path}"}}
+
+    def _lookup(self, kind: str, spotify_id: str) -> dict | None:
+        if spotify_id in self.fixtures.get(kind, {}):
+            return self.fixtures[kind][spotify_id]
+        if kind == "tracks":
+            i = Catalog.index(spotify_id, "fktr")
+            return self.catalog.track(i) if i is not None and i < self.catalog.n_tracks else None
+        i = Catalog.index(spotify_id, "fkar")
+        return self.catalog.artist(i) if i is not None and i < self.catalog.n_artists else None
+
+    def _recently_played(self, uid: str, query: dict, limit: int) -> dict:
+        now_ms = int(time.time() * 1000)
+        if query.get("after"):
+            items, more = self.catalog.plays_after(uid, int(query["after"]), limit, now_ms)
+        else:
+            items = self.catalog.plays_before(uid, int(query.get("before") or now_ms), limit)
+            more = bool(items)
+        cursors = {"after": str(items[0]["_ms"]), "before": str(items[-1]["_ms"])} if items else None
+        nxt = None
+        if more and cursors:
+            nxt = (f"{API_PREFIX}/v1/me/player/recently-played?limit={limit}&"
+                   + (f"after={cursors['after']}" if query.get("after") else f"before={cursors['before']}"))
+        for p in items:
+            p.pop("_ms", None)
+        return {"items": items, "next": nxt, "cursors": cursors, "limit": limit}
+
+
+# ---------- wiring ----------
+_adapter: FakeSpotifyAdapter | None = None
+
+
+def install(session: requests.Session, config: FakeConfig | None = None) -> FakeSpotifyAdapter:
+    """Route this session's Spotify traffic to one process-wide fake."""
+    global _adapter
+    if _adapter is None or config is not None:
+        _adapter = FakeSpotifyAdapter(config)
+    session.mount(API_PREFIX, _adapter)
+    session.mount(ACCOUNTS_PREFIX, _adapter)
+    return _adapter
+
+
+def adapter() -> FakeSpotifyAdapter | None:
+    return _adapter
+
+
+def token_info(uid: str, with_expiry: bool = True) -> dict:
+    scope = os.getenv("SPOTIPY_SCOPE", "user-read-recently-played user-library-read user-top-read")
+    info = {"access_token": f"{TOKEN_PREFIX}{uid}", "token_type": "Bearer", "expires_in": 3600,
+            "refresh_token": f"{TOKEN_PREFIX}{uid}", "scope": scope}
+    if with_expiry:
+        info["expires_at"] = int(time.time()) + 10 * 365 * 86400
+    return info
+
+
+def write_token_cache(uid: str, cache_path: str | Path) -> Path:
+    """A spotipy token cache that makes `uid` a logged-in user of the fake."""
+    path = Path(cache_path)
+    path.write_text(json.dumps(token_info(uid)), encoding="utf-8")
+    return path
+
+
+def record(uid: str | None, out: Path) -> dict:
+    """Capture the real API responses the app uses for one logged-in user, as fixtures."""
+    import spotify_clients
+    sp = spotify_clients.get_client(uid)
+    responses = {"/v1/me": sp.me(),
+                 "/v1/me/player/recently-played": sp.current_user_recently_played(limit=50)}
+    for time_range in ("short_term", "medium_term", "long_term"):
+        responses[f"/v1/me/top/tracks?limit=50&time_range={time_range}"] = \
+            sp.current_user_top_tracks(limit=50, time_range=time_range)
+    tracks = {t["id"]: t for r in responses.values() if isinstance(r, dict)
+              for t in ((it.get("track") or it) for it in r.get("items", [])) if t and t.get("id")}
+    artist_ids = list(dict.fromkeys(a["id"] for t in tracks.values() for a in t.get("artists", []) if a.get("id")))
+    artists = {}
+    for i in range(0, len(artist_ids), 50):
+        artists.update({a["id"]: a for a in sp.artists(artist_ids[i:i + 50]).get("artists") or [] if a})
+    fixtures = {"recorded_at": datetime.now(timezone.utc).isoformat(), "responses": responses,
+                "tracks": tracks, "artists": artists}
+    out.write_text(json.dumps(fixtures), encoding="utf-8")
+    return {"out": str(out), "responses": len(responses), "tracks": len(tracks), "artists": len(artists)}
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="offline Spotify API stand-in")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    tok = sub.add_parser("token", help="write a fake token cache for a uid")
+    tok.add_argument("--uid", required=True)
+    rec = sub.add_parser("record", help="record real responses into a fixtures file")
+    rec.add_argument("--uid")
+    rec.add_argument("--out", type=Path, required=True)
+    args = ap.parse_args()
+    if args.cmd == "token":
+        import spotify_clients
+        print(write_token_cache(args.uid, spotify_clients.cache_path_for(args.uid)))
+    else:
+        print(json.dumps(record(args.uid, args.out), indent=2))
@@ -0,0 +1,268 @@
+# featurestore.py — columnar copy of a shard: day-partitioned Parquet plays + an Arrow feature file
+#
+#   python featurestore.py refresh --uid UID          # changed days + features (incremental)
+#   python featurestore.py refresh --all              # every shard and data.db
+#   python featurestore.py refresh --db PATH --full   # rewrite every partition
+#
+# One directory per shard under FEATURE_STORE_DIR:
+#   <shard>/plays/day=YYYY-MM-DD/part-0.parquet   raw plays, hive-partitioned by UTC day
+#   <shard>/features.arrow                         30-day per-track feature frame
+#   <shard>/manifest.json                          plays per exported day
+#
+# Partitions are append-mostly. track_daily_plays (kept in sync by a trigger)
+# gives the plays per day, and a refresh rewrites only the days whose count
+# differs from the manifest: today and any new days, or older days an export
+# import back-filled. Offline analysis reads them with pandas.read_parquet /
+# pyarrow.dataset without touching the database.
+#
+# features.arrow is the scored frame fetch_current_df builds (windowed counts,
+# artist clout inputs, release age, saved flag, contexts, z_<feature> columns)
+# as an uncompressed Arrow IPC file tagged with lineup_core.data_version().
+# With FEATURE_STORE=1 the scoring path memory-maps it while the tag matches,
+# reads only the columns the lineup uses and skips rescoring (the tag includes
+# the UTC day, so release ages are still current). It only queries SQLite when
+# the tag doesn't match, writing the new frame back.
+# pyarrow is optional and imported on first use; without it the store is off.
+from __future__ import annotations
+import importlib.util, json, os, sqlite3, threading, time
+from datetime import date, timedelta
+from pathlib import Path
+
+import pandas as pd
+
+import metrics
+import storage
+
+BASE_DIR = Path(__file__).resolve().parent
+STORE_DIR = Path(os.getenv("FEATURE_STORE_DIR") or BASE_DIR / "features")
+ENABLED = os.getenv("FEATURE_STORE", "0") == "1"
+FEATURES_FILE = "features.arrow"
+MANIFEST_FILE = "manifest.json"
+
+
+def available() -> bool:
+    """pyarrow is installed (it is an optional dependency)."""
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def enabled() -> bool:
+    return ENABLED and available()
+
+
+def store_dir(db_path: Path | str) -> Path:
+    """Feature store directory of one shard (data.db -> features/data)."""
+    return STORE_DIR / Path(db_path).stem
+
+
+def _tmp_for(dest: Path) -> Path:
+    """Per-writer temp name; dot files are skipped by dataset readers."""
+    return dest.with_name(f".{dest.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+
+
+def _replace(tmp: Path, dest: Path) -> None:
+    """Atomic swap; readers that still map the old file keep its inode."""
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(tmp, dest)
+
+
+# ---------- manifest ----------
+def read_manifest(db_path: Path | str) -> dict:
+    try:
+        return json.loads((store_dir(db_path) / MANIFEST_FILE).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {"days": {}}
+
+
+def _write_manifest(db_path: Path | str, manifest: dict) -> None:
+    path = store_dir(db_path) / MANIFEST_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = _tmp_for(path)
+    tmp.write_text(json.dumps(manifest, indent=1, sort_keys=True), encoding="utf-8")
+    _replace(tmp, path)
+
+
+# ---------- plays partitions ----------
+def _day_counts(conn) -> dict[str, int]:
+    return dict(conn.execute("SELECT day, SUM(plays) FROM track_daily_plays GROUP BY day"))
+
+
+def _next_day(day: str) -> str:
+    return (date.fromisoformat(day) + timedelta(days=1)).isoformat()
+
+
+def export_plays(db_path: Path | str, full: bool = False) -> dict:
+    """Write the Parquet partitions of days that are new or changed since the last export."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    db_path = Path(db_path)
+    manifest = read_manifest(db_path)
+    done = {} if full else manifest.get("days", {})
+    root = store_dir(db_path) / "plays"
+    written = rows = 0
+    with metrics.span("features.plays"):
+        with storage.connection(db_path) as conn:
+            counts = _day_counts(conn)
+            for day in sorted(d for d, n in counts.items() if done.get(d) != n):
+                # played_at is canonical UTC ISO, so a day is a PK range scan
+                batch = conn.execute("""SELECT played_at, track_id, context FROM plays
+                                        WHERE played_at >= ? AND played_at < ? ORDER BY played_at""",
+                                     (day, _next_day(day))).fetchall()
+                table = pa.table({
+                    "played_at": pa.array([r[0] for r in batch], pa.string()),
+                    "track_id": pa.array([r[1] for r in batch], pa.string()),
+                    "context": pa.array([r[2] for r in batch], pa.string()),
+                })
+                dest = root / f"day={day}" / "part-0.parquet"
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                tmp = _tmp_for(dest)
+                pq.write_table(table, str(tmp), compression="zstd")
+                _replace(tmp, dest)
+                done[day] = counts[day]
+                written += 1
+                rows += len(batch)
+    manifest.update(days=done, exported_at=time.time())
+    _write_manifest(db_path, manifest)
+    return {"days_written": written, "rows_written": rows, "days_total": len(counts)}
+
+
+def read_plays(db_path: Path | str, since: str | None = None, until: str | None = None) -> pd.DataFrame:
+    """Exported plays (played_at, track_id, context, day) for days in [since, until)."""
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    root = store_dir(db_path) / "plays"
+    if not root.exists():
+        return pd.DataFrame(columns=["played_at", "track_id", "context", "day"])
+    dataset = ds.dataset(root, format="parquet",
+                         partitioning=ds.partitioning(pa.schema([("day", pa.string())]), flavor="hive"))
+    flt = None
+    if since:
+        flt = ds.field("day") >= since
+    if until:
+        flt = (ds.field("day") < until) if flt is None else flt & (ds.field("day") < until)
+    return dataset.to_table(filter=flt).to_pandas()
+
+
+# ---------- features ----------
+def write_features(db_path: Path | str, df: pd.DataFrame, version: str, days: int) -> bool:
+    """Store the scored window frame for `version`; False when it couldn't be written."""
+    if not available():
+        return False
+    import pyarrow as pa
+
+    dest = store_dir(db_path) / FEATURES_FILE
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                               b"lineup.version": version.encode(),
+                                               b"lineup.days": str(days).encode(),
+                                               b"lineup.built_at": str(time.time()).encode()})
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = _tmp_for(dest)
+        with pa.OSFile(str(tmp), "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        _replace(tmp, dest)
+    except (OSError, pa.ArrowException, TypeError, ValueError) as e:
+        print(f"[WARN] feature store write failed ({dest}): {type(e).__name__}: {e}")
+        return False
+    return True
+
+
+def stored_version(db_path: Path | str) -> tuple[str, int] | None:
+    """(version, days) tag of features.arrow from its schema alone, or None."""
+    path = store_dir(db_path) / FEATURES_FILE
+    if not path.exists() or not available():
+        return None
+    import pyarrow as pa
+
+    try:
+        with pa.memory_map(str(path), "r") as source:
+            meta = pa.ipc.open_file(source).schema.metadata or {}
+        return meta[b"lineup.version"].decode(), int(meta[b"lineup.days"])
+    except (OSError, KeyError, ValueError, pa.ArrowException):
+        return None
+
+
+def load_features(db_path: Path | str, version: str, days: int,
+                  columns: list[str] | tuple[str, ...] | None = None) -> pd.DataFrame | None:
+    """
+    The stored frame via a memory map when it was built for `version` and `days`,
+    else None. `columns` limits the read to those present in the file; the
+    others are never paged in. Numeric columns without nulls come out as views
+    of the map (split_blocks), the rest are converted column by column while
+    their Arrow buffers are released (self_destruct).
+    """
+    path = store_dir(db_path) / FEATURES_FILE
+    if not path.exists() or not available():
+        return None
+    import pyarrow as pa
+
+    try:
+        with pa.memory_map(str(path), "r") as source:
+            reader = pa.ipc.open_file(source)
+            meta = reader.schema.metadata or {}
+            if meta.get(b"lineup.version") != version.encode() or meta.get(b"lineup.days") != str(days).encode():
+                return None
+            table = reader.read_all()
+            if columns is not None:
+                table = table.select([c for c in columns if c in table.schema.names])
+            return table.to_pandas(split_blocks=True, self_destruct=True)
+    except (OSError, pa.ArrowException) as e:
+        print(f"[WARN] feature store read failed ({path}): {type(e).__name__}: {e}")
+        return None
+
+
+def refresh(db_path: Path | str, full: bool = False, days: int = 30) -> dict:
+    """Export changed plays partitions and rebuild features.arrow if the data moved on."""
+    import lineup_core  # lineup_core imports this module
+
+    db_path = Path(db_path)
+    out = {"db_path": str(db_path), "store": str(store_dir(db_path))}
+    out["plays"] = export_plays(db_path, full=full)
+    version = lineup_core.data_version("current", db_path)
+    if not full and stored_version(db_path) == (version, days):
+        out["features"] = "current"
+        return out
+    with metrics.span("features.build"):
+        df = lineup_core.fetch_current_df(days=days, db_path=db_path, feature_store=False)
+    if df.empty:
+        out["features"] = "empty"
+    else:
+        out["features"] = "written" if write_features(db_path, df, version, days) else "failed"
+        out["feature_rows"] = len(df)
+    return out
+
+
+def _main():
+    import argparse
+    ap = argparse.ArgumentParser(description="export plays and scoring features to Parquet / Arrow")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("refresh", help="incremental export of one or all shards")
+    who = p.add_mutually_exclusive_group()
+    who.add_argument("--uid", help="Spotify user id (selects the shard)")
+    who.add_argument("--db", type=Path, help="explicit database path")
+    who.add_argument("--all", action="store_true", help="data.db and every shard")
+    p.add_argument("--full", action="store_true", help="rewrite every partition and the feature file")
+    p.add_argument("--days", type=int, default=30)
+    args = ap.parse_args()
+    if not available():
+        raise SystemExit("featurestore needs pyarrow: pip install pyarrow")
+
+    if args.all:
+        paths = [storage.LEGACY_DB, *sorted(storage.SHARD_DIR.glob("*.db"))]
+    else:
+        paths = [args.db or storage.db_path_for(args.uid)]
+    results = []
+    for path in paths:
+        if not Path(path).exists():
+            continue
+        try:
+            results.append(refresh(path, full=args.full, days=args.days))
+        except sqlite3.Error as e:
+            results.append({"db_path": str(path), "error": f"{type(e).__name__}: {e}"})
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,316 @@
+# history_store.py — append-only lineup history in SQLite (replaces rewriting history.json)
+#
+# Every snapshot is one INSERT; reads are keyset-paginated on the row id, so
+# both sides cost O(page) instead of O(total history). The legacy
+# history.json is imported once, the first time a database is opened here.
+#
+# Storage is content-addressed per mode:
+#   - a snapshot whose lineup hash (track_id, position, rounded score) equals
+#     the previous row's only bumps that row's last_seen_at / seen_count
+#   - a changed snapshot is stored as a delta against the previous row, with
+#     a full keyframe every KEYFRAME_EVERY rows so rebuilds stay short
+# Reads always return full snapshots.
+from __future__ import annotations
+import copy, hashlib, json, sqlite3, threading
+from datetime import datetime, timezone
+from pathlib import Path
+
+import storage
+
+BASE_DIR = Path(__file__).resolve().parent
+DB = BASE_DIR / "data.db"
+HISTORY_JSON = BASE_DIR / "history.json"
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+KEYFRAME_EVERY = 20     # max delta chain length before a full snapshot is stored
+SCORE_DECIMALS = 3      # score rounding used for the content hash
+
+_initialized: set[str] = set()
+_init_lock = threading.Lock()
+
+
+def init(conn: sqlite3.Connection, legacy_json: Path | None = HISTORY_JSON) -> None:
+    """One-time data steps; the tables themselves come from storage.MIGRATIONS."""
+    storage.migrate(conn)
+    if not conn.execute("SELECT value FROM history_meta WHERE key='compacted'").fetchone():
+        compact(conn)  # re-encode rows written before dedup existed
+    done = conn.execute("SELECT value FROM history_meta WHERE key='json_imported'").fetchone()
+    if not done and legacy_json is not None:
+        n = import_json(conn, legacy_json) if Path(legacy_json).exists() else 0
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO history_meta(key, value) VALUES('json_imported', ?)",
+                         (json.dumps({"path": str(legacy_json), "rows": n,
+                                      "at": datetime.now(timezone.utc).isoformat()}),))
+
+
+def import_json(conn: sqlite3.Connection, path: Path) -> int:
+    """One-time import of a legacy history.json list; returns rows imported."""
+    try:
+        data = json.loads(Path(path).read_text(encoding="utf-8"))
+    except Exception as e:
+        print(f"[WARN] history import skipped ({path}): {e}")
+        return 0
+    snaps = [s for s in data if isinstance(s, dict) and s.get("lineup")]
+    with conn:
+        for snap in snaps:
+            _append(conn, snap)
+    return len(snaps)
+
+
+# ---------- content hash + delta encoding ----------
+def content_hash(snapshot: dict) -> str:
+    key = [(p.get("track_id"), p.get("position"), round(float(p.get("score") or 0.0), SCORE_DECIMALS))
+           for p in snapshot.get("lineup") or []]
+    raw = json.dumps([snapshot.get("mode"), key], separators=(",", ":"))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def make_delta(base: dict, new: dict) -> dict:
+    """
+    Minimal patch turning `base` into `new`:
+      set/unset     top-level keys other than lineup
+      lineup        {index: full entry} when the slot's track changed,
+                    {index: {"~": {field: value}, "-": [fields]}} otherwise
+      lineup_len    length of the new lineup
+    """
+    delta = {
+        "set": {k: v for k, v in new.items() if k != "lineup" and base.get(k, _UNSET) != v},
+        "unset": [k for k in base if k not in new],
+        "lineup": {},
+        "lineup_len": len(new.get("lineup") or []),
+    }
+    old_lineup = base.get("lineup") or []
+    for i, entry in enumerate(new.get("lineup") or []):
+        prev = old_lineup[i] if i < len(old_lineup) else None
+        if prev == entry:
+            continue
+        if not prev or prev.get("track_id") != entry.get("track_id"):
+            delta["lineup"][str(i)] = entry
+        else:
+            delta["lineup"][str(i)] = {
+                "~": {k: v for k, v in entry.items() if prev.get(k, _UNSET) != v},
+                "-": [k for k in prev if k not in entry],
+            }
+    return delta
+
+
+def apply_delta(base: dict, delta: dict) -> dict:
+    out = {k: copy.deepcopy(v) for k, v in base.items() if k not in delta["unset"]}
+    out.update(copy.deepcopy(delta["set"]))
+    lineup = [dict(e) for e in (base.get("lineup") or [])][:delta["lineup_len"]]
+    for idx, patch in delta["lineup"].items():
+        i = int(idx)
+        if "~" in patch and set(patch) <= {"~", "-"}:
+            entry = {k: v for k, v in lineup[i].items() if k not in patch["-"]}
+            entry.update(patch["~"])
+        else:
+            entry = patch
+        if i < len(lineup):
+            lineup[i] = entry
+        else:
+            lineup.append(entry)
+    out["lineup"] = lineup
+    return out
+
+
+_UNSET = object()
+
+# (db path, mode) -> (row id, content hash, full snapshot, depth) of the newest row
+_last_state: dict[tuple[str, str], tuple[int, str, dict, int]] = {}
+
+
+def _db_key(conn: sqlite3.Connection) -> str:
+    return conn.execute("PRAGMA database_list").fetchone()[2]
+
+
+def _materialize(conn: sqlite3.Connection, row_id: int, memo: dict[int, dict] | None = None) -> dict:
+    """Rebuild the full snapshot stored (possibly as a delta chain) at row_id."""
+    memo = {} if memo is None else memo
+    chain = []
+    rid = row_id
+    while rid not in memo:
+        kind, base_id, payload = conn.execute(
+            "SELECT kind, base_id, payload FROM lineup_history WHERE id=?", (rid,)).fetchone()
+        if kind == "full":
+            memo[rid] = json.loads(payload)
+            break
+        chain.append((rid, json.loads(payload)))
+        rid = base_id
+    snap = memo[rid]
+    for cid, delta in reversed(chain):
+        snap = apply_delta(snap, delta)
+        memo[cid] = snap
+    return memo[row_id]
+
+
+def _last_row(conn: sqlite3.Connection, mode: str) -> tuple[int, str, dict, int] | None:
+    key = (_db_key(conn), mode)
+    row = conn.execute("SELECT id, content_hash, depth FROM lineup_history WHERE mode=? ORDER BY id DESC LIMIT 1",
+                       (mode,)).fetchone()
+    if not row:
+        return None
+    cached = _last_state.get(key)
+    if cached and cached[0] == row[0]:
+        return cached  # no other writer appended since; skip the rebuild
+    snap = _materialize(conn, row[0])
+    state = (row[0], row[1] or content_hash(snap), snap, row[2])
+    _last_state[key] = state
+    return state
+
+
+def _append(conn: sqlite3.Connection, snapshot: dict) -> None:
+    """Dedup/delta-encode one snapshot (caller owns the transaction)."""
+    mode = snapshot.get("mode") or "current"
+    taken_at = snapshot.get("date") or datetime.now(timezone.utc).isoformat()
+    h = content_hash(snapshot)
+    prev = _last_row(conn, mode)
+    if prev and prev[1] == h:
+        conn.execute("""UPDATE lineup_history SET last_seen_at=?, seen_count=seen_count+1
+                        WHERE id=?""", (taken_at, prev[0]))
+        return
+    if prev and prev[3] + 1 < KEYFRAME_EVERY:
+        kind, base_id, depth = "delta", prev[0], prev[3] + 1
+        payload = make_delta(prev[2], snapshot)
+    else:
+        kind, base_id, depth = "full", None, 0
+        payload = snapshot
+    cur = conn.execute("""INSERT INTO lineup_history(mode, taken_at, payload, content_hash, kind, base_id,
+                                                     depth, last_seen_at, seen_count)
+                          VALUES(?,?,?,?,?,?,?,?,1)""",
+                       (mode, taken_at, json.dumps(payload, ensure_ascii=False), h, kind, base_id, depth, taken_at))
+    _last_state[(_db_key(conn), mode)] = (cur.lastrowid, h, copy.deepcopy(snapshot), depth)
+
+
+def compact(conn: sqlite3.Connection) -> dict:
+    """Re-encode the whole table with dedup + deltas (one-off migration; rewrites row ids)."""
+    ids = [r[0] for r in conn.execute("SELECT id FROM lineup_history ORDER BY id")]
+    memo: dict[int, dict] = {}
+    snaps = []
+    for rid in ids:
+        snap = _materialize(conn, rid, memo)
+        seen = conn.execute("SELECT seen_count, last_seen_at FROM lineup_history WHERE id=?", (rid,)).fetchone()
+        snaps.append((snap, seen))
+    _last_state.pop((_db_key(conn), "current"), None)
+    _last_state.pop((_db_key(conn), "alltime"), None)
+    with conn:
+        conn.execute("DELETE FROM lineup_history")
+        for snap, (count, last_seen) in snaps:
+            _append(conn, snap)
+            if count > 1 or (last_seen and last_seen != snap.get("date")):
+                conn.execute("""UPDATE lineup_history
+                                SET seen_count=seen_count+?, last_seen_at=MAX(COALESCE(last_seen_at, ''), ?)
+                                WHERE id=(SELECT MAX(id) FROM lineup_history WHERE mode=?)""",
+                             (count - 1, last_seen or "", snap.get("mode") or "current"))
+        conn.execute("INSERT OR REPLACE INTO history_meta(key, value) VALUES('compacted', ?)",
+                     (json.dumps({"rows_before": len(ids), "at": datetime.now(timezone.utc).isoformat()}),))
+    after = conn.execute("SELECT COUNT(*) FROM lineup_history").fetchone()[0]
+    return {"rows_before": len(ids), "rows_after": after}
+
+
+def _connect(db_path: Path | None, readonly: bool = False) -> sqlite3.Connection:
+    """
+    This thread's pooled connection (see storage.connection); not to be closed.
+    readonly=True opens the file mode=ro and skips init: it never creates,
+    migrates or imports into the database.
+    """
+    db_path = Path(db_path or DB)
+    if readonly:
+        return storage.connection(db_path, readonly=True)
+    conn = storage.connection(db_path)
+    key = str(db_path)
+    if key not in _initialized:
+        with _init_lock:
+            if key not in _initialized:
+                init(conn, HISTORY_JSON if Path(db_path) == DB else None)
+                _initialized.add(key)
+    return conn
+
+
+def append(snapshot: dict, db_path: Path | None = None) -> None:
+    if not snapshot or not snapshot.get("lineup"):
+        return
+    conn = _connect(db_path)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")  # serialize read-previous + write across processes
+        _append(conn, snapshot)
+
+
+def query(mode: str | None = None, since: str | None = None, until: str | None = None,
+          limit: int = DEFAULT_LIMIT, cursor: str | None = None, db_path: Path | None = None,
+          readonly: bool = False) -> dict:
+    """
+    Oldest-first page of snapshots seen within [since, until) (ISO strings); `cursor` is the `next_cursor` of the
+    previous page. Returns {"history": [...], "next_cursor": str | None}.
+    Collapsed repeats carry "last_seen" and "seen_count". readonly=True reads
+    a database that doesn't exist (or has no history table yet) as empty.
+    """
+    limit = max(1, min(int(limit or DEFAULT_LIMIT), MAX_LIMIT))
+    where, params = [], []
+    if cursor:
+        where.append("id > ?"); params.append(int(cursor))
+    if mode:
+        where.append("mode = ?"); params.append(mode)
+    if since:  # a collapsed row overlaps the range if it was still being seen at `since`
+        where.append("COALESCE(last_seen_at, taken_at) >= ?"); params.append(since)
+    if until:
+        where.append("taken_at < ?"); params.append(until)
+    sql = "SELECT id, last_seen_at, seen_count FROM lineup_history"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id LIMIT ?"
+    params.append(limit + 1)  # one extra row tells us whether another page exists
+
+    try:
+        conn = _connect(db_path, readonly)
+        rows = conn.execute(sql, params).fetchall()
+    except sqlite3.OperationalError:
+        if not readonly:
+            raise
+        rows = []
+    page = rows[:limit]
+    memo: dict[int, dict] = {}
+    history = []
+    for rid, last_seen, seen_count in page:
+        snap = dict(_materialize(conn, rid, memo))
+        snap["last_seen"] = last_seen or snap.get("date")
+        snap["seen_count"] = seen_count
+        history.append(snap)
+    return {
+        "history": history,
+        "next_cursor": str(page[-1][0]) if len(rows) > limit else None,
+    }
+
+
+def latest(mode: str, db_path: Path | None = None, readonly: bool = False) -> dict | None:
+    """Newest full snapshot for `mode` (with last_seen / seen_count), or None (see query for readonly)."""
+    try:
+        conn = _connect(db_path, readonly)
+        row = conn.execute("""SELECT id, last_seen_at, seen_count FROM lineup_history
+                              WHERE mode=? ORDER BY id DESC LIMIT 1""", (mode,)).fetchone()
+    except sqlite3.OperationalError:
+        if not readonly:
+            raise
+        row = None
+    if not row:
+        return None
+    snap = dict(_materialize(conn, row[0]))
+    snap["last_seen"] = row[1] or snap.get("date")
+    snap["seen_count"] = row[2]
+    return snap
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="lineup history store")
+    ap.add_argument("--import-json", type=Path, default=HISTORY_JSON,
+                    help="legacy history.json to import (once per database)")
+    ap.add_argument("--db", type=Path, default=DB)
+    ap.add_argument("--compact", action="store_true", help="re-encode all rows with dedup + deltas")
+    args = ap.parse_args()
+    with storage.connect(args.db) as c:
+        init(c, legacy_json=args.import_json)
+        if args.compact:
+            print(compact(c))
+        meta = c.execute("SELECT value FROM history_meta WHERE key='json_imported'").fetchone()
+        print(f"json import: {meta[0] if meta else None}")
+        print(f"lineup_history rows: {c.execute('SELECT COUNT(*) FROM lineup_history').fetchone()[0]}")
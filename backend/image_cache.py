@@ -0,0 +1,202 @@
+# image_cache.py — bounded, TTL-aware image URL cache shared by all workers on a host
+#
+# Two tiers:
+#   1) in-process LRU (OrderedDict) capped at IMAGE_CACHE_MAX entries
+#   2) SQLite table in image_cache.db next to data.db, so entries survive
+#      restarts and a fresh uvicorn worker starts warm; capped at
+#      IMAGE_CACHE_DISK_MAX rows, least recently used evicted first. The file
+#      is opened on the first lookup or write, not at import; the cap (and
+#      expiry) is enforced every IMAGE_CACHE_DISK_PRUNE_EVERY written rows, so
+#      a worker can overshoot it by that much in between
+# A url of None is a cached *negative* result (Spotify has no image for that
+# id); it expires after the shorter negative TTL so it gets retried eventually.
+from __future__ import annotations
+import os, sqlite3, threading, time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+CACHE_DB = Path(os.getenv("IMAGE_CACHE_PATH") or BASE_DIR / "image_cache.db")
+MAX_ENTRIES = int(os.getenv("IMAGE_CACHE_MAX", "5000"))                # in-memory LRU size
+DISK_MAX_ENTRIES = int(os.getenv("IMAGE_CACHE_DISK_MAX", "200000"))    # SQLite rows kept
+DISK_PRUNE_EVERY = int(os.getenv("IMAGE_CACHE_DISK_PRUNE_EVERY", "1000"))  # rows written between prunes
+TTL_S = float(os.getenv("IMAGE_CACHE_TTL_S", str(7 * 24 * 3600)))
+NEGATIVE_TTL_S = float(os.getenv("IMAGE_CACHE_NEG_TTL_S", "3600"))
+
+_MISSING = object()
+
+
+class ImageCache:
+    def __init__(self, path: Path | str = CACHE_DB, max_entries: int = MAX_ENTRIES,
+                 ttl_s: float = TTL_S, negative_ttl_s: float = NEGATIVE_TTL_S,
+                 disk_max_entries: int = DISK_MAX_ENTRIES, disk_prune_every: int = DISK_PRUNE_EVERY):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.negative_ttl_s = negative_ttl_s
+        self.disk_max_entries = disk_max_entries
+        self.disk_prune_every = max(1, disk_prune_every)
+        self._mem: OrderedDict[tuple[str, str], tuple[str | None, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(
+            ["hits", "negative_hits", "misses", "disk_hits", "evictions", "writes"], 0)
+        self._db_lock = threading.Lock()
+        self._db_ready = False
+        self._unpruned = self.disk_prune_every  # the first write prunes what earlier runs left
+
+    # ---------- SQLite tier ----------
+    @contextmanager
+    def _connect(self):
+        """One short-lived connection: committed (or rolled back) and always closed."""
+        conn = sqlite3.connect(self.path, timeout=5.0)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _disk_enabled(self) -> bool:
+        """Create the table on first use; False once the disk tier is disabled."""
+        if not self._db_ready:
+            with self._db_lock:
+                if not self._db_ready:
+                    self._init_db()
+                    self._db_ready = True
+        return self.path is not None
+
+    def _init_db(self):
+        try:
+            with self._connect() as conn:
+                conn.execute("""CREATE TABLE IF NOT EXISTS image_cache(
+                    kind       TEXT NOT NULL,   -- 'track' (album cover) | 'artist'
+                    id         TEXT NOT NULL,
+                    url        TEXT,            -- NULL = negative result
+                    expires_at REAL NOT NULL,   -- unix seconds
+                    last_access REAL NOT NULL DEFAULT 0,  -- unix seconds; LRU order of the disk cap
+                    PRIMARY KEY(kind, id)
+                )""")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_image_cache_expires ON image_cache(expires_at)")
+                # tables created before last_access existed
+                if "last_access" not in {r[1] for r in conn.execute("PRAGMA table_info(image_cache)")}:
+                    conn.execute("ALTER TABLE image_cache ADD COLUMN last_access REAL NOT NULL DEFAULT 0")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_image_cache_access ON image_cache(last_access)")
+        except sqlite3.Error as e:
+            print(f"[WARN] image cache disk tier disabled: {e}")
+            self.path = None
+
+    def _disk_get(self, kind: str, ids: list[str], now: float) -> dict[str, tuple[str | None, float]]:
+        if not ids or not self._disk_enabled():
+            return {}
+        out = {}
+        try:
+            with self._connect() as conn:
+                for i in range(0, len(ids), 500):  # stay under SQLite's variable limit
+                    chunk = ids[i:i + 500]
+                    marks = ",".join("?" * len(chunk))
+                    rows = conn.execute(
+                        f"SELECT id, url, expires_at FROM image_cache WHERE kind=? AND id IN ({marks}) AND expires_at > ?",
+                        (kind, *chunk, now)).fetchall()
+                    out.update({r[0]: (r[1], r[2]) for r in rows})
+                if out:
+                    try:
+                        conn.executemany("UPDATE image_cache SET last_access=? WHERE kind=? AND id=?",
+                                         [(now, kind, i) for i in out])
+                    except sqlite3.OperationalError:
+                        pass  # locked: the hits still count, they just age as if unread
+        except sqlite3.Error:
+            return {}
+        return out
+
+    def _disk_put(self, kind: str, rows: list[tuple[str, str | None, float]], now: float):
+        if not rows or not self._disk_enabled():
+            return
+        with self._lock:
+            self._unpruned += len(rows)
+            prune = self._unpruned >= self.disk_prune_every
+            if prune:
+                self._unpruned = 0
+        try:
+            with self._connect() as conn:
+                conn.executemany("""INSERT OR REPLACE INTO image_cache(kind, id, url, expires_at, last_access)
+                                    VALUES(?,?,?,?,?)""",
+                                 [(kind, i, url, exp, now) for i, url, exp in rows])
+                if not prune:
+                    return
+                # COUNT(*) scans the table, so it runs once per disk_prune_every rows
+                conn.execute("DELETE FROM image_cache WHERE expires_at <= ?", (now,))
+                conn.execute("""DELETE FROM image_cache WHERE rowid IN (
+                                  SELECT rowid FROM image_cache ORDER BY last_access
+                                  LIMIT max(0, (SELECT COUNT(*) FROM image_cache) - ?))""",
+                             (self.disk_max_entries,))
+        except sqlite3.Error:
+            pass
+
+    # ---------- memory tier ----------
+    def _mem_put(self, key, url, expires_at):
+        self._mem[key] = (url, expires_at)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    # ---------- public API ----------
+    def get_many(self, kind: str, ids) -> tuple[dict[str, str | None], list[str]]:
+        """
+        Look up ids. Returns (found, missing): `found` maps id -> url, where a
+        value of None is a cached negative; `missing` still needs fetching.
+        """
+        now = time.time()
+        found, pending = {}, []
+        with self._lock:
+            for i in ids:
+                entry = self._mem.get((kind, i), _MISSING)
+                if entry is not _MISSING and entry[1] > now:
+                    self._mem.move_to_end((kind, i))
+                    found[i] = entry[0]
+                else:
+                    pending.append(i)
+        disk = self._disk_get(kind, pending, now)
+        missing = []
+        with self._lock:
+            for i in pending:
+                if i in disk:
+                    url, exp = disk[i]
+                    self._mem_put((kind, i), url, exp)
+                    found[i] = url
+                    self._counters["disk_hits"] += 1
+                else:
+                    missing.append(i)
+            for url in found.values():
+                self._counters["hits" if url else "negative_hits"] += 1
+            self._counters["misses"] += len(missing)
+        return found, missing
+
+    def put_many(self, kind: str, mapping: dict[str, str | None]):
+        """Store results; None values are cached as negatives with the short TTL."""
+        now = time.time()
+        rows = [(i, url, now + (self.ttl_s if url else self.negative_ttl_s)) for i, url in mapping.items()]
+        with self._lock:
+            for i, url, exp in rows:
+                self._mem_put((kind, i), url, exp)
+            self._counters["writes"] += len(rows)
+        self._disk_put(kind, rows, now)
+
+    def clear_memory(self):
+        with self._lock:
+            self._mem.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["negative_hits"] + self._counters["misses"]
+            return {
+                **self._counters,
+                "hit_ratio": round((lookups - self._counters["misses"]) / lookups, 4) if lookups else None,
+                "memory_entries": len(self._mem),
+                "max_entries": self.max_entries,
+                "ttl_s": self.ttl_s,
+                "negative_ttl_s": self.negative_ttl_s,
+                "disk_path": str(self.path) if self.path else None,
+            }
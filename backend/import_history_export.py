@@ -0,0 +1,260 @@
+# import_history_export.py — bulk-load Spotify "Extended streaming history" exports
+#
+#   python import_history_export.py my_spotify_data.zip [--uid UID] [--db PATH]
+#   python import_history_export.py "Spotify Extended Streaming History/" --no-resolve
+#
+# Accepts the export zip, a folder, or individual Streaming_History_Audio_*.json
+# files. Each file is one big JSON array; it is parsed incrementally
+# (raw_decode over fixed-size chunks), so memory stays flat however many years
+# the export covers. Plays go in with batched executemany, one transaction per
+# batch. A play already logged by the recently-played ingest (same track within
+# DEDUP_WINDOW_S) is skipped. Tracks seen only in the export get placeholder rows,
+# then are resolved 50 at a time through the user's Spotify client.
+from __future__ import annotations
+import io, json, time, zipfile
+from dataclasses import dataclass, field, asdict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Iterator
+
+import logger_recent
+import spotify_clients
+import storage
+
+EXPORT_GLOB = "Streaming_History_Audio_*.json"
+MIN_MS_PLAYED = 30_000          # Spotify's own threshold for counting a stream
+DEDUP_WINDOW_S = 120            # export ts vs recently-played played_at drift
+INSERT_BATCH = 50_000            # rows per write transaction (bounded memory, few WAL checkpoints)
+RESOLVE_BATCH = 1000            # track ids per metadata transaction
+CHUNK_CHARS = 1 << 16
+
+
+@dataclass
+class ImportResult:
+    ok: bool = False
+    db_path: str = ""
+    files: list = field(default_factory=list)
+    rows_read: int = 0
+    inserted_plays: int = 0
+    skipped_short: int = 0       # ms_played below the threshold
+    skipped_non_track: int = 0   # podcasts, audiobooks, rows without a track uri
+    skipped_duplicate: int = 0   # already logged by the ingest or earlier in the export
+    tracks_resolved: int = 0
+    tracks_unresolved: int = 0
+    elapsed_s: float = 0.0
+    rows_per_s: float = 0.0
+    error: str | None = None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+# ---------- streaming JSON ----------
+def iter_json_array(fh, chunk_chars: int = CHUNK_CHARS) -> Iterator[dict]:
+    """Yield the elements of a top-level JSON array from a text stream, one at a time."""
+    decoder = json.JSONDecoder()
+    buf, pos, started, eof = "", 0, False, False
+    while True:
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(buf):
+            if eof:
+                if started:
+                    raise ValueError("truncated JSON array")
+                return
+            buf, pos = fh.read(chunk_chars), 0
+            eof = not buf
+            continue
+        if not started:
+            if buf[pos] != "[":
+                raise ValueError("expected a JSON array")
+            started, pos = True, pos + 1
+            continue
+        if buf[pos] == "]":
+            return
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = fh.read(chunk_chars)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0  # keep only the unfinished element
+            continue
+        yield obj
+        pos = end
+
+
+def _open_exports(paths: list[Path]) -> Iterator[tuple[str, io.TextIOBase]]:
+    """(name, text stream) for every audio-history file under the given paths."""
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            for f in sorted(path.rglob(EXPORT_GLOB)):
+                with open(f, encoding="utf-8-sig") as fh:
+                    yield str(f), fh
+        elif zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as zf:
+                names = sorted(n for n in zf.namelist() if Path(n).match(EXPORT_GLOB))
+                for n in names:
+                    with zf.open(n) as raw:
+                        yield f"{path}:{n}", io.TextIOWrapper(raw, encoding="utf-8-sig")
+        else:
+            with open(path, encoding="utf-8-sig") as fh:
+                yield str(path), fh
+
+
+# ---------- plays ----------
+_INSERT_SQL = "INSERT OR IGNORE INTO plays(played_at, track_id, context) VALUES(?, ?, NULL)"
+_INSERT_DEDUP_SQL = """INSERT OR IGNORE INTO plays(played_at, track_id, context)
+                       SELECT ?, ?, NULL
+                       WHERE NOT EXISTS (SELECT 1 FROM plays WHERE track_id=? AND played_at BETWEEN ? AND ?)"""
+
+
+# export plays carry no context, so new rollup rows get '' and existing ones keep theirs
+_ROLLUP_SQL = """INSERT INTO track_daily_plays(track_id, day, plays, contexts)
+                 SELECT track_id, substr(played_at, 1, 10), COUNT(*), ''
+                 FROM plays NOT INDEXED WHERE rowid > ?  -- rowid range, not a full index scan
+                 GROUP BY track_id, substr(played_at, 1, 10)
+                 ON CONFLICT(track_id, day) DO UPDATE SET plays = plays + excluded.plays"""
+
+
+def _flush(conn, plain: list[tuple], dedup: list[tuple], names: dict[str, str]) -> int:
+    """
+    One batch in one write transaction. The per-row rollup trigger (see
+    storage._m3_daily_rollup) is swapped for a single grouped upsert over the
+    batch's new rows; DDL is transactional, so other connections only ever
+    see the trigger in place.
+    """
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        trigger = conn.execute("SELECT sql FROM sqlite_master WHERE type='trigger' "
+                               "AND name='trg_plays_daily_rollup'").fetchone()
+        before = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM plays").fetchone()[0]
+        if trigger:
+            conn.execute("DROP TRIGGER trg_plays_daily_rollup")
+        conn.executemany("INSERT OR IGNORE INTO tracks(id, name) VALUES(?, ?)", names.items())
+        n = max(conn.executemany(_INSERT_SQL, plain).rowcount, 0)
+        n += max(conn.executemany(_INSERT_DEDUP_SQL, dedup).rowcount, 0)
+        if trigger:
+            conn.execute(_ROLLUP_SQL, (before,))
+            conn.execute(trigger[0])
+    return n
+
+
+def load_plays(conn, paths: list[Path], res: ImportResult, min_ms: int = MIN_MS_PLAYED,
+               batch_size: int = INSERT_BATCH) -> None:
+    window = timedelta(seconds=DEDUP_WINDOW_S)
+    # only export rows near already-logged plays need the per-row duplicate probe
+    lo, hi = conn.execute("SELECT MIN(played_at), MAX(played_at) FROM plays").fetchone()
+    lo = datetime.fromisoformat(lo.rstrip("Z")) - window if lo else datetime.max
+    hi = datetime.fromisoformat(hi.rstrip("Z")) + window if hi else datetime.min
+    plain: list[tuple] = []
+    dedup: list[tuple] = []
+    names: dict[str, str] = {}
+
+    def flush():
+        n = _flush(conn, plain, dedup, names)
+        res.inserted_plays += n
+        res.skipped_duplicate += len(plain) + len(dedup) - n
+        plain.clear(); dedup.clear(); names.clear()
+
+    for name, fh in _open_exports(paths):
+        res.files.append(name)
+        for rec in iter_json_array(fh):
+            res.rows_read += 1
+            uri = rec.get("spotify_track_uri") or ""
+            if not uri.startswith("spotify:track:") or not rec.get("ts"):
+                res.skipped_non_track += 1
+                continue
+            if (rec.get("ms_played") or 0) < min_ms:
+                res.skipped_short += 1
+                continue
+            tid = uri.rsplit(":", 1)[1]
+            ts = datetime.fromisoformat(rec["ts"].replace("Z", "+00:00"))
+            ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+            # same key form as the ingest (storage.norm_played_at), so the
+            # OR IGNORE catches a play both sources logged at the same instant
+            key = storage.format_played_at(ts)
+            if lo <= ts <= hi:
+                dedup.append((key, tid, tid, storage.format_played_at(ts - window),
+                              storage.format_played_at(ts + window)))
+            else:
+                plain.append((key, tid))
+            if rec.get("master_metadata_track_name"):
+                names.setdefault(tid, rec["master_metadata_track_name"])
+            if len(plain) + len(dedup) >= batch_size:
+                flush()
+    if plain or dedup:
+        flush()
+
+
+# ---------- metadata ----------
+def _unresolved_ids(conn, after: str, limit: int) -> list[str]:
+    # placeholder rows from load_plays have no album yet
+    return [r[0] for r in conn.execute(
+        "SELECT id FROM tracks WHERE album_id IS NULL AND id > ? ORDER BY id LIMIT ?", (after, limit))]
+
+
+def resolve_metadata(conn, sp, res: ImportResult) -> None:
+    """Fill tracks/albums/artists for placeholder tracks, 50 ids per Spotify call."""
+    after = ""
+    while True:
+        ids = _unresolved_ids(conn, after, RESOLVE_BATCH)
+        if not ids:
+            break
+        after = ids[-1]
+        tracks = []
+        for chunk in logger_recent._chunks(ids):
+            tracks.extend(t for t in (sp.tracks(chunk).get("tracks") or []) if t)
+        batch = logger_recent.collect_track_entities(tracks)
+        artists = logger_recent.fetch_artists(sp, batch["artist_ids"])
+        flag_rows = logger_recent.fetch_saved_flags(sp, list(batch["tracks"]))
+        with conn:
+            logger_recent.upsert_tracks(conn, batch["tracks"].values())
+            logger_recent.upsert_albums(conn, batch["albums"].values())
+            logger_recent.upsert_artists(conn, artists)
+            logger_recent.upsert_track_artists(conn, batch["track_artists"])
+            logger_recent.mark_saved_flags(conn, flag_rows)
+            storage.bump_data_generation(conn)  # cached lineups / ETags scored these as unresolved
+        res.tracks_resolved += len(batch["tracks"])
+
+
+def run_import(paths: list[Path], uid: str | None = None, db_path: Path | None = None, sp=None,
+               resolve: bool = True, min_ms: int = MIN_MS_PLAYED) -> ImportResult:
+    """Import export files into the user's shard. Never raises; see ImportResult.error."""
+    t0 = time.perf_counter()
+    db_path = Path(db_path or storage.db_path_for(uid))
+    res = ImportResult(db_path=str(db_path))
+    try:
+        with storage.connection(db_path) as conn:
+            load_plays(conn, paths, res, min_ms=min_ms)
+            res.rows_per_s = round(res.rows_read / max(time.perf_counter() - t0, 1e-9))
+            if resolve:
+                sp = sp or spotify_clients.get_client(uid)
+                if spotify_clients.has_cached_token(sp):
+                    resolve_metadata(conn, sp, res)
+                else:
+                    print("[WARN] no cached Spotify token; track metadata left unresolved")
+            res.tracks_unresolved = conn.execute(
+                "SELECT COUNT(*) FROM tracks WHERE album_id IS NULL").fetchone()[0]
+        res.ok = True
+    except Exception as e:
+        res.error = f"{type(e).__name__}: {e}"
+    res.elapsed_s = round(time.perf_counter() - t0, 3)
+    return res
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="import Spotify extended streaming history")
+    ap.add_argument("paths", nargs="+", type=Path, help="export zip, folder, or Streaming_History_Audio_*.json")
+    ap.add_argument("--uid", help="Spotify user id (selects the shard and token cache)")
+    ap.add_argument("--db", type=Path, help="explicit database path (overrides --uid routing)")
+    ap.add_argument("--min-ms", type=int, default=MIN_MS_PLAYED, help="skip plays shorter than this")
+    ap.add_argument("--no-resolve", action="store_true", help="don't call Spotify for track metadata")
+    args = ap.parse_args()
+    result = run_import(args.paths, uid=args.uid, db_path=args.db, resolve=not args.no_resolve,
+                        min_ms=args.min_ms)
+    print(json.dumps(result.to_dict(), indent=2))
+    raise SystemExit(0 if result.ok else 1)
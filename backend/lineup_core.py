@@ -3,39 +3,35 @@ import sqlite3
 from pathlib import Path
 from datetime import datetime, timezone
 import json
+import hashlib
+import threading
+import time
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
 import re  # <-- you had this
 
+import featurestore
+import history_store
+import metrics
+import scoring
+import spotify_clients
+import storage
+import top_tracks
+from image_cache import ImageCache
+
 # ---------- Setup ----------
 BASE_DIR = Path(__file__).resolve().parent
 DB = BASE_DIR / "data.db"
-HISTORY_JSON = BASE_DIR / "history.json"
 ENV_PATH = BASE_DIR / ".env"
 load_dotenv(ENV_PATH)
-
-sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
-    client_id=os.getenv("SPOTIPY_CLIENT_ID"),
-    client_secret=os.getenv("SPOTIPY_CLIENT_SECRET"),
-    redirect_uri=os.getenv("SPOTIPY_REDIRECT_URI"),
-    scope=os.getenv("SPOTIPY_SCOPE", "user-top-read"),
-    open_browser=True,
-    cache_path=str(BASE_DIR / ".spotipy-cache"),
-    show_dialog=False,
-    requests_timeout=30,
-))
+# weight profiles (see scoring.py); pin a version to freeze rankings
+CURRENT_PROFILE = os.getenv("SCORING_PROFILE_CURRENT", "hiv2-current")
+ALLTIME_PROFILE = os.getenv("SCORING_PROFILE_ALLTIME", "hiv2-alltime")
 
 # ---------- Helpers ----------
-def z(s: pd.Series) -> pd.Series:
-    s = s.astype(float)
-    mu, sd = s.mean(), s.std()
-    if sd == 0 or np.isnan(sd):
-        sd = 1.0
-    return (s - mu) / sd
-
 def _team_label_from_stats(avg_pop: float | None, avg_followers: float | None) -> str:
     """
     Map lineup 'fame' to a 5-tier label using avg artist popularity (0-100)
@@ -79,67 +75,107 @@ def extract_album_image(track: dict) -> str | None:
     return None
 
 
-# ---------- Album cover cache + Spotify fallback ----------
-_cover_cache = {}
+# ---------- Image cache + bulk Spotify resolver ----------
+# kinds: "track" -> album cover url, "artist" -> profile image url;
+# image_cache.db is only opened on the first lookup, not at import
+image_cache = ImageCache()
 
-def get_album_cover_fallback(track_id: str) -> str | None:
-    """Fetch album cover from Spotify if missing in local DB."""
-    if not track_id:
-        return None
-    if track_id in _cover_cache:
-        return _cover_cache[track_id]
+
+def _image_cache_metrics():
+    st = image_cache.stats()
+    events = ("hits", "negative_hits", "disk_hits", "misses", "evictions", "writes")
+    yield ("image_cache_events_total", "counter", "Image URL cache lookups and writes",
+           [({"event": e}, st[e]) for e in events])
+    yield ("image_cache_memory_entries", "gauge", "Entries in the in-process image cache",
+           [({}, st["memory_entries"])])
+
+
+metrics.register_collector(_image_cache_metrics)
+
+IMAGE_BATCH = 50          # Spotify max ids per /tracks and /artists call
+IMAGE_MAX_IN_FLIGHT = 4   # concurrent batch requests
+
+
+def _first_image(obj: dict | None) -> str | None:
+    images = (obj or {}).get("images") or []
+    return images[0].get("url") if images and isinstance(images[0], dict) else None
+
+
+def _fetch_image_batch(sp, kind: str, ids: list[str]) -> dict[str, str | None] | None:
+    """One Spotify call; ids Spotify answered without an image map to None. None on failure."""
     try:
-        track = sp.track(track_id)
-        images = track.get("album", {}).get("images", [])
-        if images:
-            url = images[0]["url"]
-            _cover_cache[track_id] = url
-            return url
+        if kind == "track":
+            items = sp.tracks(ids).get("tracks") or []
+            found = {t["id"]: extract_album_image(t) for t in items if t}
+        else:
+            items = sp.artists(ids).get("artists") or []
+            found = {a["id"]: _first_image(a) for a in items if a}
     except Exception:
-        return None
-    return None
+        return None  # transient: don't cache as negative
+    return {i: found.get(i) for i in ids}
+
+
+def _resolve_images(sp, kind: str, ids) -> dict[str, str | None]:
+    """
+    Resolve image URLs for a whole column of ids: dedupe, skip cached ids,
+    then fetch in batches of IMAGE_BATCH with at most IMAGE_MAX_IN_FLIGHT
+    requests running at once. Returns {id: url} for every id that resolved.
+    """
+    wanted = list(dict.fromkeys(i for i in ids if isinstance(i, str) and i))
+    found, todo = image_cache.get_many(kind, wanted)
+    if todo:
+        batches = [todo[i:i + IMAGE_BATCH] for i in range(0, len(todo), IMAGE_BATCH)]
+        with ThreadPoolExecutor(max_workers=min(IMAGE_MAX_IN_FLIGHT, len(batches))) as pool:
+            for fetched in pool.map(lambda b: _fetch_image_batch(sp, kind, b), batches):
+                if fetched is not None:
+                    image_cache.put_many(kind, fetched)
+                    found.update(fetched)
+    return {i: url for i, url in found.items() if url}
+
 
+def resolve_album_covers(sp, track_ids) -> dict[str, str | None]:
+    """Bulk album covers keyed by track id (cached)."""
+    return _resolve_images(sp, "track", track_ids)
 
-# ---------- Artist image cache (Spotify fallback) ----------
-_artist_img_cache = {}
 
-def get_artist_image(artist_id: str) -> str | None:
+def resolve_artist_images(sp, artist_ids) -> dict[str, str | None]:
+    """Bulk artist profile images keyed by artist id (cached)."""
+    return _resolve_images(sp, "artist", artist_ids)
+
+
+def get_album_cover_fallback(sp, track_id: str) -> str | None:
+    """Fetch album cover from Spotify if missing in local DB."""
+    return resolve_album_covers(sp, [track_id]).get(track_id) if track_id else None
+
+
+def get_artist_image(sp, artist_id: str) -> str | None:
     """Fetch primary artist profile image URL from Spotify (cached)."""
-    if not artist_id:
-        return None
-    if artist_id in _artist_img_cache:
-        return _artist_img_cache[artist_id]
+    return resolve_artist_images(sp, [artist_id]).get(artist_id) if artist_id else None
+
+
+def _persist_images(db_path: Path, album_urls: list, artist_urls: list) -> None:
+    """Write fallback-resolved image URLs back so later builds need no Spotify calls."""
     try:
-        a = sp.artist(artist_id)
-        images = a.get("images", [])
-        if images:
-            url = images[0]["url"]
-            _artist_img_cache[artist_id] = url
-            return url
-    except Exception:
-        return None
-    return None
+        with storage.connection(db_path) as conn:
+            conn.executemany("UPDATE albums SET image_url=? WHERE id=? AND image_url IS NULL",
+                             [(url, aid) for aid, url in album_urls if aid])
+            conn.executemany("UPDATE artists SET image_url=? WHERE id=? AND image_url IS NULL",
+                             [(url, aid) for aid, url in artist_urls if aid])
+    except sqlite3.OperationalError:
+        pass  # locked past busy_timeout; the next build retries
 
 
 # ---------- NEW: Refresh logger (recently played -> SQLite) ----------
-def refresh_recent_plays(limit: int = 50) -> int:
+def refresh_recent_plays(sp, limit: int = 50, db_path: Path | None = None) -> int:
     """
     Pull the last 'limit' recently-played tracks from Spotify and insert into local DB.
-    Upserts by (played_at, track_id) so reruns are safe. Returns number of rows attempted.
+    Keyed on the normalized played_at like the logger, so reruns are safe. Returns number of rows attempted.
     """
     # 1) Fetch from Spotify
     items = sp.current_user_recently_played(limit=limit).get("items", [])
 
-    # 2) Ensure plays table exists with a uniqueness constraint
-    with sqlite3.connect(DB) as conn:
-        conn.execute("""
-          CREATE TABLE IF NOT EXISTS plays (
-            played_at TEXT NOT NULL,
-            track_id  TEXT NOT NULL,
-            context   TEXT,
-            PRIMARY KEY (played_at, track_id)
-          )
-        """)
+    # 2) Insert into the shard's plays table (schema owned by storage)
+    with storage.connection(db_path or DB) as conn:
         rows = []
         for it in items:
             played_at = it.get("played_at")
@@ -147,7 +183,7 @@ def refresh_recent_plays(limit: int = 50) -> int:
             track_id = track.get("id")
             context = (it.get("context") or {}).get("type")
             if played_at and track_id:
-                rows.append((played_at, track_id, context))
+                rows.append((storage.norm_played_at(played_at), track_id, context))
 
         if rows:
             conn.executemany(
@@ -160,154 +196,208 @@ def refresh_recent_plays(limit: int = 50) -> int:
 
 
 # ---------- ALL-TIME (Receiptify-style) ----------
-def fetch_alltime_df() -> pd.DataFrame:
-    items = sp.current_user_top_tracks(limit=50, time_range="long_term").get("items", [])
+ALLTIME_TITLES = {
+    "long_term": "ALL-TIME (Spotify Long-Term)",
+    "medium_term": "ALL-TIME (Spotify Medium-Term, ~6 Months)",
+    "short_term": "ALL-TIME (Spotify Short-Term, ~4 Weeks)",
+}
+
+
+def fetch_alltime_df(sp, db_path: Path | None = None, time_range: str = top_tracks.DEFAULT_RANGE) -> pd.DataFrame:
+    """Scored frame of the user's Spotify top tracks for `time_range` (cached, see top_tracks.py)."""
+    items, artists = top_tracks.get(sp, db_path or DB, time_range)
     if not items:
         return pd.DataFrame()
 
     rows = []
     for t in items:
-        artists = ", ".join([a["name"] for a in t["artists"]])
-        followers = np.mean([a.get("followers", {}).get("total", 0) for a in t["artists"]])
-        pop = np.mean([a.get("popularity", 0) for a in t["artists"]])
-        album_image_url = extract_album_image(t)
-
-        # NEW: primary artist id + profile image
-        primary_artist_id = t["artists"][0]["id"] if t.get("artists") else None
-        artist_image_url = get_artist_image(primary_artist_id) if primary_artist_id else None
-
+        meta = [artists.get(a["id"]) or {} for a in t["artists"]]
+        primary_artist_id = t["artists"][0]["id"] if t["artists"] else None
         rows.append({
             "track_id": t["id"],
             "track_name": t["name"],
             "popularity": t["popularity"],
-            "artist_name": artists,
-            "artist_pop": pop,
-            "artist_followers": followers,
+            "artist_name": ", ".join(a["name"] for a in t["artists"] if a.get("name")),
+            "artist_pop": np.mean([m.get("popularity", 0) for m in meta]) if meta else 0.0,
+            "artist_followers": np.mean([m.get("followers", 0) for m in meta]) if meta else 0.0,
             "album_name": t["album"]["name"],
             "album_release_date": t["album"]["release_date"],
-            "album_image_url": album_image_url,
-            "artist_image_url": artist_image_url,  # <-- NEW
+            "album_image_url": extract_album_image(t),
+            "primary_artist_id": primary_artist_id,
+            "artist_image_url": (artists.get(primary_artist_id) or {}).get("image_url"),
             "is_saved": 1.0,
         })
 
     df = pd.DataFrame(rows)
-    if df.empty:
-        return df
-
     df["release_dt"] = pd.to_datetime(df["album_release_date"], errors="coerce", utc=True)
     now = pd.Timestamp.now(tz="UTC")
     df["days_since_release"] = (now - df["release_dt"]).dt.days
-    dsr = df["days_since_release"].fillna(df["days_since_release"].median())
-    df["z_recency"] = -(dsr - dsr.mean()) / (dsr.std() or 1.0)
-
-    df["artist_followers_log"] = np.log1p(df["artist_followers"].fillna(0))
-    df["z_popularity"] = z(df["popularity"].fillna(0))
-    df["z_clout"] = 0.5 * z(df["artist_pop"].fillna(0)) + 0.5 * z(df["artist_followers_log"])
-    df["z_affinity"] = z(df["is_saved"].fillna(0))
-
-    w = {"z_popularity": 0.45, "z_clout": 0.25, "z_recency": 0.20, "z_affinity": 0.10}
-    df["HIv2"] = sum(w[k] * df[k] for k in w)
-    return df
+    with metrics.span("alltime.scoring"):
+        return scoring.score_frame(df, ALLTIME_PROFILE)
 
 
 # ---------- CURRENT (30-day, from logger DB) ----------
-def fetch_current_df(days: int = 30) -> pd.DataFrame:
-    if not DB.exists():
+# What build_lineup reads from the current frame (selection, team profile,
+# image fallback): the rest of a stored features.arrow is left unread.
+LINEUP_COLUMNS = ("track_id", "track_name", "artist_name", "HIv2", "popularity",
+                  "album_id", "album_image_url", "primary_artist_id", "artist_image_url",
+                  "artist_pop", "artist_followers")
+
+_WINDOW_SQL = """
+WITH w AS (
+    SELECT track_id,
+           SUM(CASE WHEN day >= :day7 THEN plays ELSE 0 END)                  AS plays_7d,
+           SUM(CASE WHEN day < :day7 AND day >= :day14 THEN plays ELSE 0 END) AS plays_prev7d,
+           SUM(plays)                                                         AS plays_30d,
+           COUNT(*)                                                           AS distinct_days,
+           group_concat(NULLIF(contexts, ''))                                 AS contexts
+    FROM track_daily_plays
+    WHERE day >= :day_from
+    GROUP BY track_id
+)
+SELECT w.*, t.name AS track_name, t.duration_ms, t.popularity, t.album_id, t.is_saved,
+       al.name AS album_name, al.release_date, al.image_url AS album_image_url
+FROM w
+JOIN tracks t ON t.id = w.track_id
+LEFT JOIN albums al ON al.id = t.album_id
+"""
+
+_WINDOW_ARTISTS_SQL = """
+SELECT ta.track_id, ta.artist_id, a.name, a.popularity, a.followers, a.image_url
+FROM track_artists ta
+LEFT JOIN artists a ON a.id = ta.artist_id
+WHERE ta.track_id IN (SELECT DISTINCT track_id FROM track_daily_plays WHERE day >= :day_from)
+ORDER BY ta.rowid
+"""
+
+def _day_str(ts: datetime) -> str:
+    """UTC calendar day in the same YYYY-MM-DD form as track_daily_plays.day."""
+    return ts.astimezone(timezone.utc).strftime("%Y-%m-%d")
+
+
+def fetch_current_df(days: int = 30, db_path: Path | None = None, sp=None,
+                     feature_store: bool | None = None,
+                     columns: list[str] | tuple[str, ...] | None = None) -> pd.DataFrame:
+    """
+    30-day trend frame from the user's DB; `sp` is only used to fill missing images.
+    feature_store (default: FEATURE_STORE=1 with pyarrow installed) reads the
+    already scored frame from the shard's memory-mapped features.arrow while it
+    matches data_version, and writes it back after a query (see featurestore.py).
+    `columns` narrows a store read (e.g. LINEUP_COLUMNS); a query returns all.
+    """
+    db_path = Path(db_path or DB)
+    if not db_path.exists():
         return pd.DataFrame()
 
-    with sqlite3.connect(DB) as conn:
-        plays = pd.read_sql_query("SELECT played_at, track_id, context FROM plays", conn, parse_dates=["played_at"])
-        tracks = pd.read_sql_query("SELECT * FROM tracks", conn)
-        albums = pd.read_sql_query("SELECT * FROM albums", conn)
-        tas = pd.read_sql_query("SELECT * FROM track_artists", conn)
-        artists = pd.read_sql_query("SELECT * FROM artists", conn)
+    version = None
+    use_store = featurestore.enabled() if feature_store is None else feature_store
+    if use_store:
+        version = data_version("current", db_path)
+        with metrics.span("current.store"):
+            df = featurestore.load_features(db_path, version, days, columns)
+        if df is not None:
+            # scored under the same data_version, so only image gaps are left
+            if not df.empty:
+                with metrics.span("current.images"):
+                    _fill_images(df, db_path, sp)
+            return df
+
+    # Windows are the last N UTC calendar days including today, read from the
+    # daily rollup: at most `days` rows per track regardless of raw history size.
+    # Before the rollup they were rolling (now - N days), so a play near a
+    # window edge can count differently. The rollup has day granularity, and
+    # calendar days make data_version (UTC day + newest play) an exact cache
+    # key: a rolling window changes between plays, a calendar one only at midnight.
+    now = datetime.now(timezone.utc)
+    params = {
+        "day_from": _day_str(now - pd.Timedelta(days=days - 1)),
+        "day7": _day_str(now - pd.Timedelta(days=6)),
+        "day14": _day_str(now - pd.Timedelta(days=13)),
+    }
+    with metrics.span("current.sql"), storage.connection(db_path) as conn:
+        df = pd.read_sql_query(_WINDOW_SQL, conn, params=params)
+        if df.empty:
+            return pd.DataFrame()
+        ta = pd.read_sql_query(_WINDOW_ARTISTS_SQL, conn, params=params)
 
-    if plays.empty:
-        return pd.DataFrame()
+    with metrics.span("current.merge"):
+        df = _merge_artists(df, ta)
 
-    tracks.rename(columns={"id": "track_id"}, inplace=True)
-    plays["played_at"] = pd.to_datetime(plays["played_at"], errors="coerce", utc=True)
-    now = pd.Timestamp.utcnow()
-    cutoff = now - pd.Timedelta(days=days)
-    plays_window = plays.loc[plays["played_at"] >= cutoff].copy()
-    if plays_window.empty:
-        return pd.DataFrame()
+    # 🧩 Album cover / artist image: stored at ingest time, Spotify only for gaps
+    with metrics.span("current.images"):
+        _fill_images(df, db_path, sp)
 
-    plays_window["date"] = plays_window["played_at"].dt.floor("D")
-    plays_7d = plays_window[plays_window["played_at"] >= now - pd.Timedelta(days=7)].groupby("track_id").size().rename("plays_7d")
-    plays_prev7d = plays_window[
-        (plays_window["played_at"] < now - pd.Timedelta(days=7))
-        & (plays_window["played_at"] >= now - pd.Timedelta(days=14))
-    ].groupby("track_id").size().rename("plays_prev7d")
-    plays_30d = plays_window.groupby("track_id").size().rename("plays_30d")
-    days_played = plays_window.groupby("track_id")["date"].nunique().rename("distinct_days")
-    diversity = plays_window.groupby("track_id")["context"].nunique().rename("contexts_n").fillna(0)
-
-    df = tracks.merge(albums.rename(columns={"id": "album_id"}), on="album_id", how="left", suffixes=("_track", "_album"))
-    df.rename(columns={"name_track": "track_name", "name_album": "album_name"}, inplace=True)
-
-    if not artists.empty and not tas.empty:
-        art = artists.rename(columns={"id": "artist_id"})
-        ta = tas.merge(art, on="artist_id", how="left")
+    now_utc = pd.Timestamp.now(tz="UTC")
+    df["days_since_release"] = (now_utc - df["release_dt"]).dt.days
+    with metrics.span("current.scoring"):
+        df = scoring.score_frame(df, CURRENT_PROFILE)
+    if version is not None:
+        featurestore.write_features(db_path, df, version, days)
+    return df
+
+
+def _artist_names(ta: pd.DataFrame) -> dict[str, str]:
+    """
+    track_id -> its distinct artist names in credit order, ", "-joined. One
+    pass over the deduplicated rows: a groupby agg calls Python once per
+    track (a lambda there was ~80% of fetch_current_df).
+    """
+    rows = ta.dropna(subset=["name"]).drop_duplicates(["track_id", "name"])
+    joined: dict[str, str] = {}
+    for tid, name in zip(rows["track_id"].tolist(), rows["name"].tolist()):
+        joined[tid] = f"{joined[tid]}, {name}" if tid in joined else name
+    return joined
+
+
+def _merge_artists(df: pd.DataFrame, ta: pd.DataFrame) -> pd.DataFrame:
+    """Per-track artist aggregates + contexts/release columns on the window frame."""
+    if not ta.empty:
         # NEW: keep a primary artist id so we can fetch their profile image
-        agg = ta.groupby("track_id").agg(
+        agg = ta.groupby("track_id", sort=False).agg(
             artist_pop=("popularity", "mean"),
             artist_followers=("followers", "mean"),
-            artist_name=("name", lambda x: ", ".join(x.unique())),
             primary_artist_id=("artist_id", "first"),  # <-- NEW
         ).reset_index()
+        agg.insert(3, "artist_name", agg["track_id"].map(_artist_names(ta)).fillna(""))
+        # image must belong to the primary artist, not the first artist that has one
+        primary = ta.drop_duplicates("track_id").set_index("track_id")["image_url"]
+        agg["artist_image_url"] = agg["track_id"].map(primary)
         df = df.merge(agg, on="track_id", how="left")
     else:
         df["artist_pop"] = np.nan
         df["artist_followers"] = np.nan
         df["artist_name"] = "Unknown"
         df["primary_artist_id"] = None
+        df["artist_image_url"] = None
 
-    for s in [plays_7d, plays_prev7d, plays_30d, days_played, diversity]:
-        df = df.merge(s, left_on="track_id", right_index=True, how="left")
+    df["contexts_n"] = df.pop("contexts").map(lambda c: len(set(c.split(","))) if isinstance(c, str) else 0)
     for c in ["plays_7d", "plays_prev7d", "plays_30d", "distinct_days", "contexts_n"]:
         df[c] = df[c].fillna(0)
 
-    release_col = None
-    for c in ["album_release_date", "release_date", "released_at"]:
-        if c in df.columns:
-            release_col = c
-            break
-    if release_col:
-        df["release_dt"] = pd.to_datetime(df[release_col].astype(str), errors="coerce", utc=True)
-    else:
-        df["release_dt"] = pd.NaT
+    df["release_dt"] = pd.to_datetime(df["release_date"].astype(str), errors="coerce", utc=True)
+    return df
 
-    # 🧩 Fetch album cover for each track
-    df["album_image_url"] = df.apply(lambda r: get_album_cover_fallback(r.get("track_id")), axis=1)
 
-    # 🧩 Fetch artist profile image for the primary artist
-    df["artist_image_url"] = df["primary_artist_id"].apply(get_artist_image)
-
-    df["artist_followers_log"] = np.log1p(df["artist_followers"].fillna(0))
-    df["z_plays30"] = z(df["plays_30d"])
-    df["z_momentum"] = z(df["plays_7d"] - df["plays_prev7d"])
-    df["z_popularity"] = z(df["popularity"].fillna(0))
-    df["z_clout"] = 0.5 * z(df["artist_pop"].fillna(0)) + 0.5 * z(df["artist_followers_log"])
-    df["z_affinity"] = z(df["is_saved"].fillna(0))
-    df["z_diversity"] = 0.5 * z(df["distinct_days"]) + 0.5 * z(df["contexts_n"])
-
-    now_utc = pd.Timestamp.now(tz="UTC")
-    df["days_since_release"] = (now_utc - df["release_dt"]).dt.days
-    dsr = df["days_since_release"].fillna(df["days_since_release"].median())
-    df["z_recency"] = -(dsr - dsr.mean()) / (dsr.std() or 1.0)
-
-    w = {
-        "z_plays30": 0.35,
-        "z_momentum": 0.20,
-        "z_popularity": 0.15,
-        "z_clout": 0.10,
-        "z_recency": 0.10,
-        "z_affinity": 0.07,
-        "z_diversity": 0.03,
-    }
-    df["HIv2"] = sum(w[k] * df[k] for k in w)
-    return df
+def _fill_images(df: pd.DataFrame, db_path: Path, sp) -> None:
+    """Fill missing cover / artist image URLs in place and persist the ones found."""
+    if sp is not None and not spotify_clients.has_cached_token(sp):
+        sp = None  # no token: spotipy would block on its interactive login prompt
+    missing = df["album_image_url"].isna()
+    if sp is not None and missing.any():
+        ids = df.loc[missing, "track_id"]
+        found = ids.map(resolve_album_covers(sp, ids)).dropna()  # all-NaN floats can't go into a str column
+        df.loc[found.index, "album_image_url"] = found
+    missing_art = df["artist_image_url"].isna() & df["primary_artist_id"].notna()
+    if sp is not None and missing_art.any():
+        ids = df.loc[missing_art, "primary_artist_id"]
+        found = ids.map(resolve_artist_images(sp, ids)).dropna()
+        df.loc[found.index, "artist_image_url"] = found
+    if sp is not None and (missing.any() or missing_art.any()):
+        _persist_images(
+            db_path,
+            df.loc[missing & df["album_image_url"].notna(), ["album_id", "album_image_url"]].values.tolist(),
+            df.loc[missing_art & df["artist_image_url"].notna(), ["primary_artist_id", "artist_image_url"]].values.tolist(),
+        )
 
 
 # ---------- Shared helpers ----------
@@ -316,11 +406,13 @@ POSITIONS = ["CF", "SS", "RF", "1B", "2B", "3B", "C", "LF", "P"]
 # NEW: split regex + primary-artist normalizer
 _SPLIT_RE = re.compile(r'\s*(?:,|&| and | x |×| feat\.?| featuring | ft\.?| with )\s*', re.IGNORECASE)
 
+@lru_cache(maxsize=8192)
 def primary_artist_name(name: str) -> str:
     """
     Normalize to a single primary artist key:
     - take the first artist before collab separators
     - collapse whitespace, casefold for case-insensitive match
+    Memoized: a user's tracks share a few hundred artist strings at most.
     """
     if not isinstance(name, str) or not name.strip():
         return ""
@@ -329,59 +421,102 @@ def primary_artist_name(name: str) -> str:
     return key
 
 
-def enforce_unique_artists_and_position(df: pd.DataFrame, top_n: int = 9) -> list[dict]:
-    """Return list of dicts with unique *primary* artists and assigned positions."""
+def _ranked_prefix(key: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices of the k smallest keys in (key, index) order, i.e. exactly the
+    first k of a stable full sort, via argpartition (boundary ties all kept).
+    """
+    n = len(key)
+    if k < n:
+        cut = key[np.argpartition(key, k - 1)[k - 1]]
+        idx = np.flatnonzero(key <= cut)
+    else:
+        idx = np.arange(n)
+    return idx[np.lexsort((idx, key[idx]))]
+
+
+def select_lineup(df: pd.DataFrame, top_n: int = 9, bench_n: int = 0) -> tuple[list[dict], list[dict]]:
+    """
+    Highest-HIv2 track per unique *primary* artist: the first top_n are the
+    lineup (with positions), the next bench_n the bench. Candidates stream in
+    score order from a partial sort that widens only if duplicates exhaust it.
+    """
     if df is None or df.empty:
-        return []
-
-    work = df.copy()
-
-    # Ensure columns exist
-    if "artist_name" not in work.columns:
-        work["artist_name"] = "Unknown"
-    if "HIv2" not in work.columns:
-        work["HIv2"] = 0.0
-
-    # Build normalized primary-artist key
-    work["primary_artist"] = work["artist_name"].map(primary_artist_name)
-
-    # Rank by score, then drop duplicates by primary artist (keep the highest score)
-    ranked = work.sort_values("HIv2", ascending=False, kind="stable").reset_index(drop=True)
-    deduped = ranked.drop_duplicates(subset=["primary_artist"], keep="first").head(top_n)
-
-    lineup = []
-    for _, row in deduped.iterrows():
-        pos = POSITIONS[len(lineup)] if len(lineup) < len(POSITIONS) else "-"
-        cover = row.get("album_image_url") if isinstance(row.get("album_image_url"), str) else None
-        artist_img = row.get("artist_image_url") if isinstance(row.get("artist_image_url"), str) else None
-
-        lineup.append({
-            "track": row.get("track_name") or "",
-            "title": row.get("track_name") or "",
-            "artist": row.get("artist_name") or "",
-            "position": pos,
-            "score": float(row.get("HIv2", 0.0)),
-            "popularity": int(row.get("popularity", 0)) if not pd.isna(row.get("popularity", np.nan)) else 0,
-            "track_id": row.get("track_id"),
-            "album_cover": cover,
-            "artist_image": artist_img,  # <-- NEW (used by frontend)
+        return [], []
+    n, want = len(df), top_n + bench_n
+    scores = df["HIv2"].to_numpy(dtype=float, na_value=np.nan) if "HIv2" in df.columns else np.zeros(n)
+    key = np.where(np.isnan(scores), np.inf, -scores)  # best first, NaN last like sort_values
+    names = df["artist_name"].to_numpy() if "artist_name" in df.columns else np.full(n, "Unknown", dtype=object)
+
+    picked, seen, pos, k = [], set(), 0, min(n, 4 * want)
+    while len(picked) < want and pos < n:
+        order = _ranked_prefix(key, k)
+        for i in order[pos:]:
+            artist = primary_artist_name(names[i])
+            if artist not in seen:
+                seen.add(artist)
+                picked.append(i)
+                if len(picked) >= want:
+                    break
+        pos = len(order)
+        k = min(n, 2 * k)
+
+    def col(name, default=None):
+        return df[name].to_numpy()[picked] if name in df.columns else [default] * len(picked)
+
+    records = []
+    for rank, (name, artist, score, pop, tid, cover, artist_img) in enumerate(zip(
+            col("track_name"), col("artist_name", "Unknown"), scores[picked], col("popularity", 0),
+            col("track_id"), col("album_image_url"), col("artist_image_url"))):
+        position = (POSITIONS[rank] if rank < len(POSITIONS) else "-") if rank < top_n else "BN"
+        records.append({
+            "track": name or "",
+            "title": name or "",
+            "artist": artist or "",
+            "position": position,
+            "score": float(score),
+            "popularity": int(pop) if not pd.isna(pop) else 0,
+            "track_id": tid,
+            "album_cover": cover if isinstance(cover, str) else None,
+            "artist_image": artist_img if isinstance(artist_img, str) else None,  # used by frontend
         })
-        if len(lineup) >= top_n:
-            break
-    return lineup
+    return records[:top_n], records[top_n:]
+
+
+def enforce_unique_artists_and_position(df: pd.DataFrame, top_n: int = 9) -> list[dict]:
+    """Return list of dicts with unique *primary* artists and assigned positions."""
+    return select_lineup(df, top_n)[0]
+
 
+def build_lineup(mode: str = "current", db_path: Path | None = None, sp=None, bench_n: int = 0,
+                 time_range: str = top_tracks.DEFAULT_RANGE) -> dict:
+    """
+    Lineup payload for `mode`; bench_n > 0 adds the next best unique artists
+    as "bench". time_range picks Spotify's top-tracks window for alltime.
+    `sp` must be the shard owner's client: alltime needs it, current only
+    uses it to fill missing images (None skips that).
+    """
+    with metrics.span(f"{mode}.build"):
+        return _build_lineup(mode, db_path, sp, bench_n, time_range)
 
-def build_lineup(mode: str = "current") -> dict:
+
+def _build_lineup(mode: str, db_path: Path | None, sp, bench_n: int, time_range: str) -> dict:
     if mode == "alltime":
-        df = fetch_alltime_df()
-        title = "ALL-TIME (Spotify Long-Term)"
+        if sp is None:
+            raise ValueError("alltime lineups need the shard owner's Spotify client")
+        df = fetch_alltime_df(sp, db_path, time_range)
+        title = ALLTIME_TITLES[time_range]
     else:
-        df = fetch_current_df(days=30)
+        df = fetch_current_df(days=30, db_path=db_path, sp=sp, columns=LINEUP_COLUMNS)
         title = "CURRENT (30-Day Trend)"
     if df.empty:
-        return {"mode": mode, "title": title, "lineup": [], "team_profile": None, "star_player": None, "saved": False}
+        payload = {"mode": mode, "title": title, "lineup": [], "team_profile": None, "star_player": None, "saved": False}
+        if mode == "alltime":
+            payload["time_range"] = time_range
+        return payload
 
-    lineup = enforce_unique_artists_and_position(df, top_n=9)
+    with metrics.span(f"{mode}.select"):
+        lineup, bench = select_lineup(df, top_n=9, bench_n=bench_n)
     star = lineup[1] if len(lineup) > 1 else lineup[0] if lineup else None
 
     # --- NEW: compute 5-tier label from the selected 9
@@ -410,27 +545,134 @@ def build_lineup(mode: str = "current") -> dict:
         "team_profile": team_profile,  # NEW field in the response
         "star_player": star,
     }
+    if mode == "alltime":
+        payload["time_range"] = time_range
+    if bench_n:
+        payload["bench"] = bench
     return payload
 
 
-def save_history(snapshot: dict) -> None:
-    if not snapshot or not snapshot.get("lineup"):
-        return
-    if HISTORY_JSON.exists():
-        try:
-            data = json.loads(HISTORY_JSON.read_text(encoding="utf-8"))
-        except Exception:
-            data = []
-    else:
-        data = []
-    data.append(snapshot)
-    HISTORY_JSON.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+# ---------- Snapshot cache (keyed on a cheap data-version token) ----------
+ALLTIME_TTL_S = int(os.getenv("ALLTIME_SNAPSHOT_TTL_S", "3600"))
+SNAPSHOT_CACHE_MAX = int(os.getenv("SNAPSHOT_CACHE_MAX", "2000"))  # entries; least recently checked evicted
+
+# (db, mode, time_range) -> {"version", "payload", "etag", "computed_at", "checked_at"}
+#   time_range: Spotify top-tracks window for alltime, "" for current
+#   computed_at: when build_lineup produced the payload
+#   checked_at:  when the payload was last confirmed current against data_version
+_snapshot_cache: dict[tuple[str, str, str], dict] = {}
+_snapshot_lock = threading.Lock()
+
 
+def _snapshot_key(db_path: Path, mode: str, time_range: str) -> tuple[str, str, str]:
+    return (str(db_path), mode, time_range if mode == "alltime" else "")
 
-def read_history() -> list[dict]:
-    if not HISTORY_JSON.exists():
-        return []
+
+def _snapshot_put(key: tuple[str, str, str], entry: dict, replace: bool = True) -> dict:
+    """Store an entry (caller holds _snapshot_lock), evicting the stalest once full."""
+    if key not in _snapshot_cache:
+        while len(_snapshot_cache) >= SNAPSHOT_CACHE_MAX:
+            del _snapshot_cache[min(_snapshot_cache, key=lambda k: _snapshot_cache[k]["checked_at"])]
+    elif not replace:
+        return _snapshot_cache[key]
+    _snapshot_cache[key] = entry
+    return entry
+
+
+def data_version(mode: str = "current", db_path: Path | None = None) -> str:
+    """
+    Token that changes whenever build_lineup(mode) could change.
+    current: newest play + newest plays rowid (both index lookups) + the
+             shard's metadata generation (storage.bump_data_generation) +
+             UTC day, since the 7/14/30-day windows roll over at midnight.
+    alltime: Spotify-side data, so a TTL bucket (rebuilds within
+             TOP_TRACKS_TTL_S come from the shard's top-tracks cache).
+    """
+    if mode == "alltime":
+        return f"alltime:{int(time.time() // ALLTIME_TTL_S)}"
+    db_path = Path(db_path or DB)
+    if not db_path.exists():
+        return "empty"
     try:
-        return json.loads(HISTORY_JSON.read_text(encoding="utf-8"))
-    except Exception:
-        return []
+        with storage.connection(db_path) as conn:
+            latest, last_rowid, gen = conn.execute(
+                "SELECT MAX(played_at), MAX(rowid), (SELECT value FROM shard_meta WHERE key='data_gen') FROM plays"
+            ).fetchone()
+    except sqlite3.OperationalError:
+        return "empty"
+    return f"{_day_str(datetime.now(timezone.utc))}|{latest}|{last_rowid}|{gen}"
+
+
+def snapshot_etag(payload: dict) -> str:
+    """Strong ETag over the exact JSON content of the payload."""
+    body = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return '"' + hashlib.sha1(body.encode("utf-8")).hexdigest()[:27] + '"'
+
+
+def get_lineup_snapshot(mode: str = "current", db_path: Path | None = None, sp=None,
+                        time_range: str = top_tracks.DEFAULT_RANGE) -> tuple[dict, str, bool]:
+    """
+    build_lineup(mode), cached per DB (i.e. per user shard) and time range
+    until data_version(mode) changes. Returns (payload, etag, computed)
+    where computed=False means a cache hit.
+    """
+    db_path = Path(db_path or DB)
+    with metrics.span(f"{mode}.version"):
+        version = data_version(mode, db_path)
+    key = _snapshot_key(db_path, mode, time_range)
+    cached = _snapshot_cache.get(key)
+    if cached and cached["version"] == version:
+        cached["checked_at"] = time.time()
+        metrics.SNAPSHOT_CACHE.inc(mode=mode, result="hit")
+        return cached["payload"], cached["etag"], False
+    metrics.SNAPSHOT_CACHE.inc(mode=mode, result="miss")
+    payload = build_lineup(mode, db_path, sp, time_range=time_range)
+    etag = snapshot_etag(payload)
+    now = time.time()
+    with _snapshot_lock:
+        _snapshot_put(key, {"version": version, "payload": payload, "etag": etag,
+                            "computed_at": now, "checked_at": now})
+    return payload, etag, True
+
+
+def peek_snapshot(mode: str = "current", db_path: Path | None = None,
+                  time_range: str = top_tracks.DEFAULT_RANGE) -> dict | None:
+    """
+    Last computed snapshot for this DB/mode without checking freshness or
+    recomputing (for stale-while-revalidate). After a restart it falls back to
+    the newest history entry (history only keeps the default alltime range),
+    read mode=ro so a missing shard is not created. None when nothing has ever
+    been computed.
+    """
+    db_path = Path(db_path or DB)
+    key = _snapshot_key(db_path, mode, time_range)
+    cached = _snapshot_cache.get(key)
+    if cached:
+        return cached
+    if mode == "alltime" and time_range != top_tracks.DEFAULT_RANGE:
+        return None
+    last = history_store.latest(mode, db_path=db_path, readonly=True)
+    if not last:
+        return None
+    try:
+        seen = datetime.fromisoformat(str(last.pop("last_seen")).replace("Z", "+00:00")).timestamp()
+    except (TypeError, ValueError):
+        seen = 0.0
+    last.pop("seen_count", None)
+    entry = {"version": None, "payload": last, "etag": snapshot_etag(last),
+             "computed_at": seen, "checked_at": seen}
+    with _snapshot_lock:
+        return _snapshot_put(key, entry, replace=False)
+
+
+def save_history(snapshot: dict, db_path: Path | None = None) -> None:
+    with metrics.span("history.save"):
+        history_store.append(snapshot, db_path=db_path or DB)
+
+
+def read_history(mode: str | None = None, since: str | None = None, until: str | None = None,
+                 limit: int = history_store.DEFAULT_LIMIT, cursor: str | None = None,
+                 db_path: Path | None = None) -> dict:
+    """One page of lineup history: {"history": [...], "next_cursor": ...}; read-only."""
+    return history_store.query(mode=mode, since=since, until=until, limit=limit, cursor=cursor,
+                               db_path=db_path or DB, readonly=True)
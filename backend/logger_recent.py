@@ -1,165 +1,209 @@
 # logger_recent.py — store recent plays + metadata in SQLite (with diagnostics + heartbeat)
 import os, sqlite3, time, json
+from dataclasses import dataclass, field, asdict
 from pathlib import Path
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 import spotipy
-from spotipy.oauth2 import SpotifyOAuth
+
+import metrics
+import spotify_clients
+import storage
 
 # ---------- ABSOLUTE DB PATH (critical) ----------
 DB = Path(__file__).with_name("data.db").resolve()
+DEFAULT_CACHE_PATH = Path(__file__).with_name(".spotipy-cache")
 env_path = Path(__file__).with_name(".env")
 load_dotenv(env_path)
 
-sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
-    client_id=os.getenv("SPOTIPY_CLIENT_ID"),
-    client_secret=os.getenv("SPOTIPY_CLIENT_SECRET"),
-    redirect_uri=os.getenv("SPOTIPY_REDIRECT_URI"),
-    scope=os.getenv("SPOTIPY_SCOPE", "user-read-recently-played user-library-read user-top-read"),
-    open_browser=True,
-    cache_path=str(Path(__file__).with_name(".spotipy-cache")),
-    show_dialog=False,
-    requests_timeout=30,
-))
+def make_client(cache_path: str | None = None, open_browser: bool = False) -> spotipy.Spotify:
+    """Spotify client bound to one user's token cache file (pooled, reused across runs)."""
+    cache_path = cache_path or os.getenv("SPOTIPY_CACHE_PATH") or str(DEFAULT_CACHE_PATH)
+    return spotify_clients.client_for_cache(cache_path, open_browser=open_browser)
 
 def db_init(conn: sqlite3.Connection):
-    cur = conn.cursor()
-    cur.execute("""CREATE TABLE IF NOT EXISTS plays(
-        played_at TEXT PRIMARY KEY,   -- ISO8601 UTC
-        track_id  TEXT NOT NULL,
-        context   TEXT
-    )""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS tracks(
-        id TEXT PRIMARY KEY,
-        name TEXT,
-        duration_ms INTEGER,
-        popularity INTEGER,
-        album_id TEXT,
-        is_saved INTEGER DEFAULT 0
-    )""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS albums(
-        id TEXT PRIMARY KEY,
-        name TEXT,
-        release_date TEXT
-    )""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS artists(
-        id TEXT PRIMARY KEY,
-        name TEXT,
-        popularity INTEGER,
-        followers INTEGER,
-        genres TEXT
-    )""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS track_artists(
-        track_id TEXT,
-        artist_id TEXT,
-        PRIMARY KEY(track_id, artist_id)
-    )""")
-    # for diagnostic heartbeats
-    cur.execute("""CREATE TABLE IF NOT EXISTS runs(
-        ran_at TEXT PRIMARY KEY,   -- ISO8601 UTC
-        note   TEXT
-    )""")
-    conn.commit()
-
-def upsert_track(conn, t):
-    cur = conn.cursor()
-    cur.execute("""INSERT INTO tracks(id,name,duration_ms,popularity,album_id)
+    """Bring the connection's database to the current schema (see storage.MIGRATIONS)."""
+    storage.migrate(conn)
+
+def backfill_daily_rollup(conn) -> int:
+    """Rebuild track_daily_plays from raw plays; returns rollup rows written."""
+    with conn:
+        return storage.backfill_daily_rollup(conn)
+
+def first_image_url(obj: dict | None) -> str | None:
+    """First (largest) image URL of a Spotify album/artist object."""
+    images = (obj or {}).get("images") or []
+    return images[0].get("url") if images and isinstance(images[0], dict) else None
+
+SPOTIFY_BATCH = 50  # max ids per artists / saved-tracks-contains call
+
+def _chunks(seq, n=SPOTIFY_BATCH):
+    for i in range(0, len(seq), n):
+        yield seq[i:i+n]
+
+def _played_at_ms(played_iso: str) -> int:
+    return int(datetime.fromisoformat(played_iso.replace("Z","+00:00")).timestamp() * 1000)
+
+_norm_played_at = storage.norm_played_at
+
+# ---------- stage 1: gather unique entities from one response ----------
+def collect_entities(items: list[dict]) -> dict:
+    """Dedupe plays/tracks/albums/artists across a whole recently-played page."""
+    plays, tracks = [], []
+    for it in items:
+        t = it.get("track") or {}
+        if not t or not t.get("id"):
+            continue
+        ctx = (it.get("context") or {}).get("type")
+        plays.append((_norm_played_at(it["played_at"]), t["id"], ctx))
+        tracks.append(t)
+    return {"plays": plays, **collect_track_entities(tracks)}
+
+def collect_track_entities(tracks: list[dict]) -> dict:
+    """Dedupe tracks/albums/artist links from full Spotify track objects."""
+    by_id, albums = {}, {}
+    track_artists, artist_ids = {}, {}
+    for t in tracks:
+        if not t or not t.get("id"):
+            continue
+        by_id[t["id"]] = t
+        if (t.get("album") or {}).get("id"):
+            albums[t["album"]["id"]] = t["album"]
+        for a in t.get("artists", []):
+            if a.get("id"):
+                artist_ids.setdefault(a["id"], None)
+                track_artists.setdefault((t["id"], a["id"]), None)  # keeps primary-artist order
+    return {
+        "tracks": by_id,
+        "albums": albums,
+        "track_artists": list(track_artists),
+        "artist_ids": list(artist_ids),
+    }
+
+# ---------- stage 2: resolve metadata in batches of 50 ----------
+def fetch_artists(sp, artist_ids: list[str]) -> list[dict]:
+    out = []
+    for batch in _chunks(artist_ids):
+        out.extend(a for a in (sp.artists(batch).get("artists") or []) if a)
+    return out
+
+def fetch_saved_flags(sp, track_ids: list[str]) -> list[tuple[int, str]]:
+    rows = []
+    for batch in _chunks(track_ids):
+        flags = sp.current_user_saved_tracks_contains(batch)
+        rows.extend((1 if flag else 0, tid) for tid, flag in zip(batch, flags))
+    return rows
+
+# ---------- stage 3: bulk writes (caller owns the transaction) ----------
+def upsert_tracks(conn, tracks):
+    conn.executemany("""INSERT INTO tracks(id,name,duration_ms,popularity,album_id)
                    VALUES(?,?,?,?,?)
                    ON CONFLICT(id) DO UPDATE SET
                      name=excluded.name,
                      duration_ms=excluded.duration_ms,
                      popularity=excluded.popularity,
                      album_id=excluded.album_id
-                """, (t["id"], t["name"], t.get("duration_ms") or 0, t.get("popularity") or 0, t["album"]["id"]))
-    conn.commit()
+                """, [(t["id"], t["name"], t.get("duration_ms") or 0, t.get("popularity") or 0,
+                       (t.get("album") or {}).get("id")) for t in tracks])
 
-def upsert_album(conn, a):
-    cur = conn.cursor()
-    cur.execute("""INSERT INTO albums(id,name,release_date)
-                   VALUES(?,?,?)
+def upsert_albums(conn, albums):
+    conn.executemany("""INSERT INTO albums(id,name,release_date,image_url)
+                   VALUES(?,?,?,?)
                    ON CONFLICT(id) DO UPDATE SET
                      name=excluded.name,
-                     release_date=excluded.release_date
-                """, (a["id"], a["name"], a.get("release_date") or None))
-    conn.commit()
+                     release_date=excluded.release_date,
+                     image_url=COALESCE(excluded.image_url, albums.image_url)
+                """, [(a["id"], a["name"], a.get("release_date") or None, first_image_url(a)) for a in albums])
 
-def upsert_artist(conn, a):
-    cur = conn.cursor()
-    cur.execute("""INSERT INTO artists(id,name,popularity,followers,genres)
-                   VALUES(?,?,?,?,?)
+def upsert_artists(conn, artists):
+    conn.executemany("""INSERT INTO artists(id,name,popularity,followers,genres,image_url)
+                   VALUES(?,?,?,?,?,?)
                    ON CONFLICT(id) DO UPDATE SET
                      name=excluded.name,
                      popularity=excluded.popularity,
                      followers=excluded.followers,
-                     genres=excluded.genres
-                """, (a["id"], a["name"], a.get("popularity") or 0,
-                      (a.get("followers") or {}).get("total") or 0,
-                      json.dumps(a.get("genres") or [])))
-    conn.commit()
-
-def upsert_track_artists(conn, track_id, artist_ids):
-    cur = conn.cursor()
-    for aid in artist_ids:
-        cur.execute("""INSERT OR IGNORE INTO track_artists(track_id, artist_id)
-                       VALUES(?,?)""", (track_id, aid))
-    conn.commit()
-
-def mark_saved_flags(conn, track_ids):
-    if not track_ids: return
-    # Spotify allows up to 50 at a time
-    for i in range(0, len(track_ids), 50):
-        batch = track_ids[i:i+50]
-        flags = sp.current_user_saved_tracks_contains(batch)
-        cur = conn.cursor()
-        for tid, flag in zip(batch, flags):
-            cur.execute("UPDATE tracks SET is_saved=? WHERE id=?", (1 if flag else 0, tid))
-        conn.commit()
+                     genres=excluded.genres,
+                     image_url=COALESCE(excluded.image_url, artists.image_url)
+                """, [(a["id"], a["name"], a.get("popularity") or 0,
+                       (a.get("followers") or {}).get("total") or 0,
+                       json.dumps(a.get("genres") or []), first_image_url(a)) for a in artists])
 
-def log_recently_played(conn):
-    resp = sp.current_user_recently_played(limit=50)
-    items = resp.get("items", []) or []
-    print(f"Fetched {len(items)} recent plays")
+def upsert_track_artists(conn, pairs):
+    conn.executemany("""INSERT OR IGNORE INTO track_artists(track_id, artist_id)
+                       VALUES(?,?)""", pairs)
 
-    new_track_ids = set()
-    inserted_plays = 0
+def insert_plays(conn, plays) -> int:
+    # rowcount, not total_changes: the latter also counts the rollup trigger's writes
+    cur = conn.executemany("INSERT OR IGNORE INTO plays(played_at, track_id, context) VALUES(?,?,?)", plays)
+    return max(cur.rowcount, 0)
 
-    for it in items:
-        played_at = it["played_at"]   # ISO8601
-        # normalize to UTC ISO w/ Z suffix
-        dt = datetime.fromisoformat(played_at.replace("Z","+00:00")).astimezone(timezone.utc)
-        played_iso = dt.replace(tzinfo=timezone.utc).isoformat().replace("+00:00","Z")
+def mark_saved_flags(conn, flag_rows):
+    conn.executemany("UPDATE tracks SET is_saved=? WHERE id=?", flag_rows)
 
-        t = it.get("track") or {}
-        if not t or not t.get("id"):
-            continue
+def get_cursor(conn, uid: str | None) -> int | None:
+    """Stored high-water mark, else derived from the newest play already in the DB."""
+    row = conn.execute("SELECT after_ms FROM ingest_cursor WHERE uid=?", (uid or "",)).fetchone()
+    if row:
+        return row[0]
+    latest = latest_play_ts(conn)
+    return _played_at_ms(latest) if latest else None
 
-        # upsert track/album/artists
-        upsert_track(conn, t)
-        upsert_album(conn, t["album"])
+def set_cursor(conn, uid: str | None, after_ms: int):
+    conn.execute("""INSERT INTO ingest_cursor(uid, after_ms, updated_at) VALUES(?,?,?)
+                    ON CONFLICT(uid) DO UPDATE SET
+                      after_ms=MAX(after_ms, excluded.after_ms),
+                      updated_at=excluded.updated_at""",
+                 (uid or "", after_ms, datetime.now(timezone.utc).isoformat().replace("+00:00","Z")))
 
-        artist_ids = [a["id"] for a in t.get("artists", []) if a.get("id")]
-        if artist_ids:
-            arts = sp.artists(artist_ids)["artists"]
-            for a in arts:
-                upsert_artist(conn, a)
-            upsert_track_artists(conn, t["id"], artist_ids)
+def write_batch(conn, batch: dict, artists: list[dict], flag_rows: list[tuple[int, str]],
+                uid: str | None = None) -> int:
+    """Write one collected batch (and advance the cursor) in a single transaction; returns plays inserted."""
+    with conn:
+        if batch["plays"]:
+            set_cursor(conn, uid, max(_played_at_ms(p[0]) for p in batch["plays"]))
+        upsert_tracks(conn, batch["tracks"].values())
+        upsert_albums(conn, batch["albums"].values())
+        upsert_artists(conn, artists)
+        upsert_track_artists(conn, batch["track_artists"])
+        inserted = insert_plays(conn, batch["plays"])
+        mark_saved_flags(conn, flag_rows)
+        if batch["tracks"] or artists or flag_rows:
+            storage.bump_data_generation(conn)
+    return inserted
 
-        # insert play row if new
-        ctx = (it.get("context") or {}).get("type")
-        try:
-            conn.execute("INSERT INTO plays(played_at, track_id, context) VALUES(?,?,?)",
-                         (played_iso, t["id"], ctx))
-            inserted_plays += 1
-        except sqlite3.IntegrityError:
-            pass  # already logged
+MAX_PAGES = 10  # safety bound when following `next` after a long gap
+
+def fetch_recent_after(sp, after_ms: int | None) -> list[dict]:
+    """Recently-played items strictly newer than `after_ms` (all of the last 50 when None)."""
+    resp = sp.current_user_recently_played(limit=50, after=after_ms)
+    items = list(resp.get("items", []) or [])
+    pages = 1
+    while after_ms is not None and resp.get("next") and (resp.get("cursors") or {}).get("after") and pages < MAX_PAGES:
+        resp = sp.current_user_recently_played(limit=50, after=int(resp["cursors"]["after"]))
+        page = resp.get("items", []) or []
+        if not page:
+            break
+        items.extend(page)
+        pages += 1
+    return items
 
-        new_track_ids.add(t["id"])
+def log_recently_played(conn, sp, uid: str | None = None) -> dict:
+    """Ingest plays newer than the user's cursor; returns {"fetched", "inserted", "cursor"}."""
+    after_ms = get_cursor(conn, uid)
+    with metrics.span("ingest.recent"):
+        items = fetch_recent_after(sp, after_ms)
+    if not items:
+        # common case: nothing new, so no metadata lookups and no writes
+        return {"fetched": 0, "inserted": 0, "cursor": after_ms}
 
-    # mark saved flags for all recent tracks
-    mark_saved_flags(conn, list(new_track_ids))
-    conn.commit()
-    print(f"Inserted plays this run: {inserted_plays}")
-    print("Done.")
+    batch = collect_entities(items)
+    # all network calls happen before the write transaction opens
+    with metrics.span("ingest.metadata"):
+        artists = fetch_artists(sp, batch["artist_ids"])
+        flag_rows = fetch_saved_flags(sp, list(batch["tracks"]))
+    with metrics.span("ingest.write"):
+        inserted_plays = write_batch(conn, batch, artists, flag_rows, uid=uid)
+    return {"fetched": len(items), "inserted": inserted_plays, "cursor": get_cursor(conn, uid)}
 
 # --------- small helpers for diagnostics ----------
 def count_rows(conn, table):
@@ -173,53 +217,106 @@ def latest_play_ts(conn):
     return row[0] if row and row[0] else None
 
 # ---------------- RUN / DIAGNOSTICS ----------------
+TABLES = ("plays", "tracks", "artists", "albums", "track_artists")
+
+def _iso_mtime(p: Path) -> str | None:
+    return datetime.fromtimestamp(p.stat().st_mtime, tz=timezone.utc).isoformat() if p.exists() else None
+
+@dataclass
+class IngestResult:
+    """Outcome of one ingest run (same diagnostics the CLI used to print)."""
+    ok: bool = False
+    db_path: str = ""
+    cache_path: str | None = None
+    fetched: int = 0
+    inserted_plays: int = 0
+    counts_before: dict = field(default_factory=dict)
+    counts_after: dict = field(default_factory=dict)
+    latest_before: str | None = None
+    latest_after: str | None = None
+    mtime_before: str | None = None
+    mtime_after: str | None = None
+    heartbeat: str | None = None
+    cursor_before: int | None = None
+    cursor_after: int | None = None
+    elapsed_s: float = 0.0
+    error: str | None = None
+    retry_after_s: float | None = None  # set when Spotify answered 429
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def report(self) -> str:
+        lines = [
+            f"Fetched {self.fetched} recent plays",
+            f"Inserted plays this run: {self.inserted_plays}",
+            "=== DIAGNOSTIC ===",
+            f"DB path        : {self.db_path}",
+            f"mtime before   : {self.mtime_before}",
+            f"mtime after    : {self.mtime_after}",
+        ]
+        for t in TABLES:
+            b, a = self.counts_before.get(t, 0), self.counts_after.get(t, 0)
+            lines.append(f"{t:<15}: {b} -> {a} (Δ {a - b})")
+        lines.append(f"latest played@ : {self.latest_before} -> {self.latest_after}")
+        lines.append(f"cursor (ms)    : {self.cursor_before} -> {self.cursor_after}")
+        if self.error:
+            lines.append(f"error          : {self.error}")
+        lines.append("==================")
+        return "\n".join(lines)
+
+def run_ingest(cache_path: str | None = None, db_path: Path = DB, sp: spotipy.Spotify | None = None,
+               uid: str | None = None) -> IngestResult:
+    """
+    Ingest recent plays for the user owning `cache_path` into `db_path`.
+    Never raises; failures come back as IngestResult(ok=False, error=...).
+    """
+    t0 = time.perf_counter()
+    db_path = Path(db_path)
+    res = IngestResult(db_path=str(db_path), cache_path=cache_path, mtime_before=_iso_mtime(db_path))
+    try:
+        if sp is None:
+            sp = make_client(cache_path)
+            # never fall into spotipy's interactive auth prompt from a server thread
+            if not spotify_clients.has_cached_token(sp):
+                raise RuntimeError(f"no cached Spotify token at {sp.auth_manager.cache_handler.cache_path}; log in first")
+        with storage.connection(db_path) as conn:
+            res.counts_before = {t: count_rows(conn, t) for t in TABLES}
+            res.latest_before = latest_play_ts(conn)
+            res.cursor_before = get_cursor(conn, uid)
+
+            stats = log_recently_played(conn, sp, uid=uid)
+            res.fetched, res.inserted_plays = stats["fetched"], stats["inserted"]
+            res.cursor_after = stats["cursor"]
+
+            res.counts_after = {t: count_rows(conn, t) for t in TABLES}
+            res.latest_after = latest_play_ts(conn)
+
+            # heartbeat to guarantee mtime bump even if no new plays
+            res.heartbeat = datetime.now(timezone.utc).isoformat().replace("+00:00","Z")
+            conn.execute("INSERT OR REPLACE INTO runs(ran_at, note) VALUES(?, ?)",
+                         (res.heartbeat, "logger_recent heartbeat"))
+            conn.commit()
+        res.ok = True
+    except Exception as e:
+        res.error = f"{type(e).__name__}: {e}"
+        res.retry_after_s = spotify_clients.retry_after_s(e)
+    res.mtime_after = _iso_mtime(db_path)
+    res.elapsed_s = round(time.perf_counter() - t0, 3)
+    metrics.STAGE_SECONDS.observe(res.elapsed_s, stage="ingest")
+    metrics.INGEST_RUNS.inc(result="ok" if res.ok else "rate_limited" if res.retry_after_s is not None else "error")
+    metrics.INGEST_ROWS.inc(res.fetched, kind="fetched")
+    metrics.INGEST_ROWS.inc(res.inserted_plays, kind="inserted")
+    return res
+
 if __name__ == "__main__":
+    import sys
+    from contextlib import closing
     print(f"USING_DB: {DB}")  # This absolute path must match your API's DB path.
-
-    before_mtime = DB.stat().st_mtime if DB.exists() else None
-    before_mtime_iso = (
-        datetime.fromtimestamp(before_mtime, tz=timezone.utc).isoformat() if before_mtime else None
-    )
-
-    with sqlite3.connect(DB) as conn:
-        db_init(conn)
-
-        # before counts
-        b_plays   = count_rows(conn, "plays")
-        b_tracks  = count_rows(conn, "tracks")
-        b_artists = count_rows(conn, "artists")
-        b_albums  = count_rows(conn, "albums")
-        b_map     = count_rows(conn, "track_artists")
-        prev_latest = latest_play_ts(conn)
-
-        # ingest
-        log_recently_played(conn)
-
-        # after counts
-        a_plays   = count_rows(conn, "plays")
-        a_tracks  = count_rows(conn, "tracks")
-        a_artists = count_rows(conn, "artists")
-        a_albums  = count_rows(conn, "albums")
-        a_map     = count_rows(conn, "track_artists")
-        new_latest = latest_play_ts(conn)
-
-        # heartbeat to guarantee mtime bump even if no new plays
-        heartbeat = datetime.now(timezone.utc).isoformat().replace("+00:00","Z")
-        conn.execute("INSERT OR REPLACE INTO runs(ran_at, note) VALUES(?, ?)",
-                     (heartbeat, "logger_recent heartbeat"))
-        conn.commit()
-
-    after_mtime = DB.stat().st_mtime
-    after_mtime_iso = datetime.fromtimestamp(after_mtime, tz=timezone.utc).isoformat()
-
-    print("=== DIAGNOSTIC ===")
-    print(f"DB path        : {DB}")
-    print(f"mtime before   : {before_mtime_iso}")
-    print(f"mtime after    : {after_mtime_iso}")
-    print(f"plays          : {b_plays} -> {a_plays} (Δ {a_plays - b_plays})")
-    print(f"tracks         : {b_tracks} -> {a_tracks} (Δ {a_tracks - b_tracks})")
-    print(f"artists        : {b_artists} -> {a_artists} (Δ {a_artists - b_artists})")
-    print(f"albums         : {b_albums} -> {a_albums} (Δ {a_albums - b_albums})")
-    print(f"track_artists  : {b_map} -> {a_map} (Δ {a_map - b_map})")
-    print(f"latest played@ : {prev_latest} -> {new_latest}")
-    print("==================")
+    if "--backfill-rollup" in sys.argv[1:]:
+        with closing(storage.connect(DB)) as conn:
+            print(f"track_daily_plays rows: {backfill_daily_rollup(conn)}")
+        raise SystemExit(0)
+    result = run_ingest(sp=make_client(open_browser=True))  # CLI may prompt for first login
+    print(result.report())
+    raise SystemExit(0 if result.ok else 1)
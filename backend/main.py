@@ -1,12 +1,26 @@
 # backend/main.py
+#
+# Import budget: this module must stay importable without pandas, numpy,
+# spotipy or requests (bench/bench_startup.py checks it), so /health answers
+# as soon as uvicorn is up. lineup_core / logger_recent load on first use or
+# in the background warm-up started at startup; /healthz reports when it is done.
+from __future__ import annotations
 from fastapi import FastAPI, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse, Response
 from pathlib import Path
-import subprocess, sys, os, shutil, json
+import os, shutil, json, hmac, threading, time
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import TYPE_CHECKING
 from dotenv import load_dotenv
-from spotipy.oauth2 import SpotifyOAuth
-from spotipy import Spotify  # ✅ NEW
+import metrics
+import storage
+import spotify_clients
+from spotify_clients import cache_path_for
+
+if TYPE_CHECKING:
+    from spotipy.oauth2 import SpotifyOAuth
 
 # ---------------- App & env ----------------
 app = FastAPI(title="Spotify Sabermetrics API", version="0.1.0")
@@ -27,30 +41,62 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# ---------------- Helpers (per-user cache) ----------------
-def cache_path_for(uid: str | None) -> str | None:
-    if not uid:
-        # fallback to env (optional) or default file
-        return os.getenv("SPOTIPY_CACHE_PATH") or str(BASE_DIR / ".spotipy-cache")
-    return str(BASE_DIR / f".spotipy-cache-{uid}")
+# ---------------- Metrics / Server-Timing ----------------
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"  # per-stage timings on every response
 
-# ---------------- Startup debug ----------------
-@app.on_event("startup")
-def _startup_debug():
-    here = BASE_DIR
-    print(f"[DEBUG] CWD={Path.cwd()}")
-    print(f"[DEBUG] __file__ dir={here}")
+@app.middleware("http")
+async def _request_metrics(request: Request, call_next):
+    token = metrics.begin_request()
+    t0 = time.perf_counter()
     try:
-        listing = sorted(p.name for p in here.iterdir())
-        print(f"[DEBUG] here list={listing}")
-    except Exception as e:
-        print(f"[DEBUG] list(dir) failed: {e}")
+        response = await call_next(request)
+    finally:
+        timings = metrics.end_request(token)
+    dt = time.perf_counter() - t0
+    route = getattr(request.scope.get("route"), "path", "unmatched")  # template, not the raw URL
+    metrics.HTTP_SECONDS.observe(dt, route=route, method=request.method, status=str(response.status_code))
+    if SERVER_TIMING:
+        response.headers["Server-Timing"] = metrics.server_timing(timings + [("total", dt)])
+        response.headers["Timing-Allow-Origin"] = FRONTEND_URL
+    return response
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Prometheus text exposition of stage timings, Spotify calls, caches and ingest."""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# ---------------- Warm-up ----------------
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "1") == "1"
+_warmup = {"ready": False, "started_at": None, "seconds": None, "error": None}
+
+def _warm():
+    """Load the heavy modules and touch their lazy paths once, off the request path."""
+    t0 = time.perf_counter()
+    _warmup["started_at"] = datetime.now(timezone.utc).isoformat()
     try:
-        import importlib
-        importlib.import_module("lineup_core")
-        print("[DEBUG] lineup_core import OK")
+        with metrics.span("warmup"):
+            import sqlite3
+            import pandas as pd
+            import logger_recent  # noqa: F401  (spotipy)
+            lc = _lc()
+            if storage.LEGACY_DB.exists():  # history reads are mode=ro: run the one-time init/import here
+                lc.history_store.latest("current", db_path=storage.LEGACY_DB)
+            spotify_clients.shared_session()
+            pd.read_sql_query("SELECT 1 AS x", sqlite3.connect(":memory:"))  # pandas.io.sql
+            lc.scoring.score_frame(pd.DataFrame({"plays_30d": [1, 2], "artist_followers": [0, 1]}),
+                                   lc.CURRENT_PROFILE)
+        _warmup["seconds"] = round(time.perf_counter() - t0, 3)
+        _warmup["ready"] = True
+        print(f"[INFO] warm-up done in {_warmup['seconds']:.2f}s")
     except Exception as e:
-        print(f"[DEBUG] lineup_core import FAILED: {type(e).__name__}: {e}")
+        _warmup["seconds"] = round(time.perf_counter() - t0, 3)
+        _warmup["error"] = f"{type(e).__name__}: {e}"
+        print(f"[WARN] warm-up failed: {_warmup['error']}")
+
+@app.on_event("startup")
+def _start_warmup():
+    if WARMUP_ON_STARTUP:
+        threading.Thread(target=_warm, name="warmup", daemon=True).start()
 
 # ---------------- Health ----------------
 @app.get("/health")
@@ -58,50 +104,93 @@ def health():
     return {"ok": True}
 
 @app.get("/healthz")
-def healthz():
-    return {"ok": True}
+def healthz(ready: bool = Query(False, description="503 until the warm-up has finished")):
+    body = {"ok": True, "ready": _warmup["ready"], "warmup_s": _warmup["seconds"], "warmup_error": _warmup["error"]}
+    if ready and not _warmup["ready"]:
+        return JSONResponse(body, status_code=503)
+    return body
 
 # ---------------- OAuth helpers ----------------
 def get_oauth(uid: str | None = None) -> SpotifyOAuth:
-    return SpotifyOAuth(
-        client_id=os.getenv("SPOTIPY_CLIENT_ID"),
-        client_secret=os.getenv("SPOTIPY_CLIENT_SECRET"),
-        redirect_uri=os.getenv("SPOTIPY_REDIRECT_URI", "http://localhost:8000/callback"),
-        scope=os.getenv(
-            "SPOTIPY_SCOPE",
-            "user-read-recently-played user-library-read user-top-read",
-        ),
-        open_browser=False,
-        cache_path=cache_path_for(uid),  # ✅ per-user cache
-        show_dialog=False,
-        requests_timeout=30,
-    )
+    return spotify_clients.oauth_for_cache(cache_path_for(uid))  # ✅ per-user cache, pooled session
 
 # ---------------- Logger runner ----------------
-LOGGER = BASE_DIR / "logger_recent.py"
 RUN_LOGGER_ON_LINEUP = True  # set False to disable auto-logger
+LOGGER_TIMEOUT_S = 180
+# lineup loads skip the ingest when the user's last one finished this recently, so a
+# repeat load is a snapshot/ETag check instead of a Spotify round trip (/refresh always runs)
+LOGGER_MIN_INTERVAL_S = float(os.getenv("LOGGER_MIN_INTERVAL_S", "60"))
+_ingest_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ingest")
+_last_ingest: dict[str, float] = {}  # shard path -> monotonic time of the last successful ingest
+
+def _ingest_due(uid: str | None) -> bool:
+    last = _last_ingest.get(str(storage.db_path_for(uid)))
+    return last is None or time.monotonic() - last >= LOGGER_MIN_INTERVAL_S
+
+def _ingest_for(uid: str | None):
+    import featurestore, logger_recent
+    db_path = storage.db_path_for(uid)
+    with storage.user_lock(uid):  # same user serializes, different users run in parallel
+        result = logger_recent.run_ingest(cache_path_for(uid), db_path=db_path, uid=uid)
+        if result.ok:
+            _last_ingest[str(db_path)] = time.monotonic()
+        if result.ok and result.inserted_plays and featurestore.enabled():
+            try:  # new days' Parquet partitions + features.arrow for the next build to map
+                featurestore.refresh(db_path)
+            except Exception as e:
+                print(f"[WARN] feature store refresh failed ({uid}): {type(e).__name__}: {e}")
+        return result
 
 def run_logger(uid: str | None):
-    """Run logger_recent.py with per-user cache path via env."""
-    if not LOGGER.exists():
-        return {"ok": False, "note": f"{LOGGER.name} not found", "stdout": "", "stderr": ""}
+    """Run the recent-plays ingest in-process (worker pool) into the user's shard."""
+    fut = _ingest_pool.submit(_ingest_for, uid)
     try:
-        env = os.environ.copy()
-        env["SPOTIPY_CACHE_PATH"] = cache_path_for(uid) or ""
-        proc = subprocess.run(
-            [sys.executable, str(LOGGER)],
-            cwd=str(BASE_DIR),
-            capture_output=True,
-            text=True,
-            timeout=180,
-            check=True,
-            env=env,  # ✅ pass per-user cache path
-        )
-        return {"ok": True, "stdout": proc.stdout, "stderr": proc.stderr}
-    except subprocess.CalledProcessError as e:
-        return {"ok": False, "stdout": e.stdout, "stderr": e.stderr}
-    except subprocess.TimeoutExpired as e:
-        return {"ok": False, "stdout": e.stdout or "", "stderr": f"Timeout: {e}"}
+        result = fut.result(timeout=LOGGER_TIMEOUT_S)
+    except FutureTimeout:
+        return {"ok": False, "error": f"Timeout after {LOGGER_TIMEOUT_S}s", "cache_path": cache_path_for(uid)}
+    return result.to_dict()
+
+# ---------------- Background ingest scheduler ----------------
+INGEST_SCHEDULER = os.getenv("INGEST_SCHEDULER", "0") == "1"
+_scheduler = None
+
+@app.on_event("startup")
+def _start_scheduler():
+    global _scheduler
+    if INGEST_SCHEDULER:
+        import scheduler
+        _scheduler = scheduler.IngestScheduler(_ingest_for)
+        _scheduler.start()
+        metrics.register_collector(_scheduler_metrics)
+        print(f"[INFO] ingest scheduler started (every {_scheduler.interval_s:.0f}s)")
+
+@app.on_event("shutdown")
+def _stop_scheduler():
+    if _scheduler is not None:
+        _scheduler.stop(wait=False)
+
+def _scheduler_metrics():
+    st = _scheduler.stats()
+    for key, help in (("queue_depth", "Users due for an ingest and not yet started"),
+                      ("max_lag_s", "Longest time a due user has waited"),
+                      ("in_flight", "Ingest runs in progress"),
+                      ("active_users", "Connected users on the normal interval")):
+        yield (f"ingest_scheduler_{key}", "gauge", help, [({}, st[key])])
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # unset: per-user diagnostics are never served
+
+def _is_admin(request: Request) -> bool:
+    got = request.headers.get("authorization", "").removeprefix("Bearer ").strip()
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(got, ADMIN_TOKEN)
+
+@app.get("/scheduler/stats")
+def scheduler_stats(request: Request, detail: bool = Query(False)):
+    """Aggregate scheduler state; ?detail=1 with `Authorization: Bearer $ADMIN_TOKEN` adds per-user rows."""
+    if _scheduler is None:
+        return {"running": False, "enabled": INGEST_SCHEDULER}
+    if detail and not _is_admin(request):
+        return JSONResponse({"detail": "admin token required"}, status_code=403)
+    return _scheduler.stats(per_user=detail)
 
 # ---------------- OAuth routes ----------------
 @app.get("/login")
@@ -127,7 +216,8 @@ def callback(request: Request, code: str = Query(...)):
         return RedirectResponse(f"{FRONTEND_URL}?spotify_error=1")
 
     # Step 2: find the user's Spotify id
-    sp = Spotify(auth=token_info["access_token"])
+    from spotipy import Spotify
+    sp = Spotify(auth=token_info["access_token"], requests_session=spotify_clients.shared_session())
     me = sp.me()
     uid = me.get("id")
 
@@ -138,6 +228,7 @@ def callback(request: Request, code: str = Query(...)):
         if src.exists():
             dst.write_text(src.read_text())
             src.unlink(missing_ok=True)
+        spotify_clients.drop_client(uid)
     except Exception as e:
         print(f"[WARN] cache move failed: {e}")
 
@@ -155,7 +246,7 @@ def debug_oauth(request: Request):
         "client_id_prefix": (os.getenv("SPOTIPY_CLIENT_ID") or "")[:8],
         "redirect_uri_env": os.getenv("SPOTIPY_REDIRECT_URI"),
         "redirect_uri_used": oauth.redirect_uri,
-        "cache_path": oauth.cache_path,
+        "cache_path": oauth.cache_handler.cache_path,
         "auth_url": oauth.get_authorize_url(),
         "uid_cookie": uid,
     }
@@ -166,44 +257,195 @@ def login_dry(request: Request):
     return {"auth_url": get_oauth(uid).get_authorize_url()}
 
 # ---------------- Lazy import core ----------------
+_lineup_core = None
+
 def _lc():
-    import importlib
-    return importlib.import_module("lineup_core")
+    """lineup_core (pandas, numpy, scoring), imported on first use."""
+    global _lineup_core
+    if _lineup_core is None:
+        import lineup_core
+        _lineup_core = lineup_core
+    return _lineup_core
 
 # ---------------- Core API ----------------
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+# ---------------- Stale-while-revalidate ----------------
+LINEUP_SWR = os.getenv("LINEUP_SWR", "0") == "1"              # default for lineup GETs; ?swr= overrides
+LINEUP_FRESH_S = float(os.getenv("LINEUP_FRESH_SECONDS", "300"))  # older snapshots trigger a background refresh
+_refreshing: set[tuple[str, str, str]] = set()
+_refreshing_lock = threading.Lock()
+DEFAULT_RANGE = "long_term"  # Spotify top-tracks window for alltime (top_tracks.DEFAULT_RANGE)
+
+def _refresh_key(uid: str | None, mode: str, time_range: str) -> tuple[str, str, str]:
+    return (str(storage.db_path_for(uid)), mode, time_range if mode == "alltime" else "")
+
+def _is_refreshing(uid: str | None, mode: str, time_range: str = DEFAULT_RANGE) -> bool:
+    return _refresh_key(uid, mode, time_range) in _refreshing
+
+def _save_history(lc, snap: dict, db_path, time_range: str) -> None:
+    """History is one series per mode; alltime keeps Spotify's default long-term window only."""
+    if snap.get("lineup") and (snap.get("mode") != "alltime" or time_range == DEFAULT_RANGE):
+        lc.save_history(snap, db_path)
+
+def _schedule_refresh(uid: str | None, mode: str, time_range: str = DEFAULT_RANGE) -> bool:
+    """Queue ingest + recompute for one user/mode unless one is already in flight."""
+    key = _refresh_key(uid, mode, time_range)
+    with _refreshing_lock:
+        if key in _refreshing:
+            return False
+        _refreshing.add(key)
+
+    def job():
+        try:
+            if RUN_LOGGER_ON_LINEUP and mode == "current" and _ingest_due(uid):
+                _ingest_for(uid)
+            lc = _lc()
+            db_path = storage.db_path_for(uid)
+            snap, _etag, computed = lc.get_lineup_snapshot(mode, db_path, spotify_clients.get_client(uid),
+                                                           time_range)
+            if computed:
+                _save_history(lc, snap, db_path, time_range)
+        except Exception as e:
+            print(f"[WARN] background refresh failed ({uid}, {mode}): {type(e).__name__}: {e}")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    _ingest_pool.submit(job)
+    return True
+
+def _snapshot_age(entry: dict) -> float:
+    return max(0.0, time.time() - entry["checked_at"])
+
+def _known_db_path(uid: str | None) -> Path | None:
+    """
+    The uid's database when its shard already exists or the uid has a token
+    cache to ingest with; None for any other `uid` cookie, so requests never
+    create (or track) a shard for a made-up uid.
+    """
+    if not uid:
+        return storage.db_path_for(None)
+    path = storage.existing_db_path(uid)
+    if path is None and spotify_clients.has_token_for(uid):
+        path = storage.db_path_for(uid)
+    return path
+
+def _unknown_user() -> JSONResponse:
+    return JSONResponse({"detail": "unknown user; sign in again via /login"}, status_code=401)
+
+def _lineup_response(request: Request, lc, mode: str, uid: str | None, swr: bool = False,
+                     time_range: str = DEFAULT_RANGE):
+    """
+    Serve the lineup with a strong ETag; 304 when the client already has it.
+    swr=True answers immediately from the last snapshot (Age header) and
+    refreshes in the background once it is older than LINEUP_FRESH_SECONDS.
+    The blocking path ingests first only when _ingest_due(uid).
+    """
+    db_path = _known_db_path(uid)
+    if db_path is None:
+        return _unknown_user()
+    if swr:
+        entry = lc.peek_snapshot(mode, db_path, time_range)
+        if entry is not None:
+            age = _snapshot_age(entry)
+            if age > LINEUP_FRESH_S:
+                _schedule_refresh(uid, mode, time_range)
+            headers = {
+                "ETag": entry["etag"],
+                "Cache-Control": "private, no-cache",
+                "Age": str(int(age)),
+                "X-Snapshot-Refreshing": "1" if _is_refreshing(uid, mode, time_range) else "0",
+            }
+            if _etag_matches(request.headers.get("if-none-match"), entry["etag"]):
+                return Response(status_code=304, headers=headers)
+            return JSONResponse(entry["payload"], headers=headers)
+        # nothing computed yet for this user: fall through to the blocking path once
+
+    if RUN_LOGGER_ON_LINEUP and mode == "current" and _ingest_due(uid):  # alltime doesn't read plays
+        with metrics.span("logger"):
+            _ = run_logger(uid)
+    snap, etag, computed = lc.get_lineup_snapshot(mode, db_path, spotify_clients.get_client(uid), time_range)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    if computed:
+        _save_history(lc, snap, db_path, time_range)
+    return JSONResponse(snap, headers=headers)
+
 @app.post("/refresh")
 def refresh(request: Request):
     uid = request.cookies.get("uid")
+    db_path = _known_db_path(uid)
+    if db_path is None:
+        return _unknown_user()
     lc = _lc()
     result = run_logger(uid)
-    snap = lc.build_lineup(mode="current")
-    if snap.get("lineup"):
-        lc.save_history(snap)
+    snap, _etag, computed = lc.get_lineup_snapshot("current", db_path, spotify_clients.get_client(uid))
+    if computed and snap.get("lineup"):
+        lc.save_history(snap, db_path)
     return JSONResponse({"refresh": result, "snapshot": snap})
 
 @app.get("/lineup/current")
-def lineup_current(request: Request):
+def lineup_current(request: Request, swr: bool | None = Query(None)):
     uid = request.cookies.get("uid")
     lc = _lc()
-    if RUN_LOGGER_ON_LINEUP:
-        _ = run_logger(uid)
-    snap = lc.build_lineup(mode="current")
-    if snap.get("lineup"):
-        lc.save_history(snap)
-    return snap
+    return _lineup_response(request, lc, "current", uid, LINEUP_SWR if swr is None else swr)
 
 @app.get("/lineup/alltime")
-def lineup_alltime(request: Request):
+def lineup_alltime(
+    request: Request,
+    swr: bool | None = Query(None),
+    time_range: str = Query(DEFAULT_RANGE, alias="range", pattern="^(short_term|medium_term|long_term)$"),
+):
     uid = request.cookies.get("uid")
     lc = _lc()
-    if RUN_LOGGER_ON_LINEUP:
-        _ = run_logger(uid)
-    snap = lc.build_lineup(mode="alltime")
-    if snap.get("lineup"):
-        lc.save_history(snap)
-    return snap
+    return _lineup_response(request, lc, "alltime", uid, LINEUP_SWR if swr is None else swr, time_range)
+
+@app.get("/lineup/status")
+def lineup_status(
+    request: Request,
+    mode: str = Query("current", pattern="^(current|alltime)$"),
+    time_range: str = Query(DEFAULT_RANGE, alias="range", pattern="^(short_term|medium_term|long_term)$"),
+):
+    """Cheap poll: compare `etag` with the one you hold to know a newer snapshot is ready."""
+    uid = request.cookies.get("uid")
+    db_path = _known_db_path(uid)
+    if db_path is None:
+        return {"mode": mode, "ready": False, "refreshing": False}
+    entry = _lc().peek_snapshot(mode, db_path, time_range)
+    refreshing = _is_refreshing(uid, mode, time_range)
+    if entry is None:
+        return {"mode": mode, "ready": False, "refreshing": refreshing}
+    age = _snapshot_age(entry)
+    return {
+        "mode": mode,
+        "ready": True,
+        "etag": entry["etag"],
+        "computed_at": datetime.fromtimestamp(entry["computed_at"], tz=timezone.utc).isoformat(),
+        "age_s": round(age, 1),
+        "stale": age > LINEUP_FRESH_S,
+        "refreshing": refreshing,
+    }
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {"image_cache": _lc().image_cache.stats()}
 
 @app.get("/history")
-def history(request: Request):
-    lc = _lc()
-    return {"history": lc.read_history()}
+def history(
+    request: Request,
+    mode: str | None = Query(None, pattern="^(current|alltime)$"),
+    since: str | None = Query(None, description="ISO8601, inclusive"),
+    until: str | None = Query(None, description="ISO8601, exclusive"),
+    limit: int = Query(100, ge=1, le=500),
+    cursor: str | None = Query(None, pattern=r"^\d+$", description="next_cursor from the previous page"),
+):
+    db_path = _known_db_path(request.cookies.get("uid"))
+    if db_path is None:
+        return {"history": [], "next_cursor": None}
+    return _lc().read_history(mode=mode, since=since, until=until, limit=limit, cursor=cursor, db_path=db_path)
@@ -0,0 +1,167 @@
+# metrics.py — in-process counters, stage timings and Prometheus text exposition
+#
+#   with metrics.span("current.sql"):      # times a stage
+#       ...
+#   metrics.SPOTIFY_REQUESTS.inc(endpoint="/v1/artists", status="200")
+#   metrics.render()                       # text/plain; version=0.0.4 for GET /metrics
+#
+# No client library: a handful of counters and histograms behind one lock,
+# rendered on demand. Every span lands in the lineup_stage_seconds histogram
+# and, while a request is being served (see begin_request), in that request's
+# timing list, which main.py turns into a Server-Timing header. Values that
+# other modules already track (image cache counters, scheduler lag) are read
+# at scrape time through register_collector() instead of being duplicated.
+from __future__ import annotations
+import contextvars, threading, time
+from contextlib import contextmanager
+from typing import Callable, Iterable
+
+BUCKETS_S = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+_metrics: list["_Metric"] = []
+_collectors: list[Callable[[], Iterable[tuple]]] = []
+_request_timings: contextvars.ContextVar[list | None] = contextvars.ContextVar("request_timings", default=None)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labelnames = name, help, tuple(labels)
+        self._values: dict[tuple, object] = {}
+        with _lock:
+            _metrics.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_labels(self.labelnames, k)} {_num(v)}" for k, v in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = BUCKETS_S):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            state = self._values.get(key)
+            if state is None:  # [cumulative bucket counts, sum, count]
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, le in enumerate(self.buckets):
+                if value <= le:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self) -> list[str]:
+        out = []
+        for key, (counts, total, n) in sorted(self._values.items()):
+            for le, c in zip(self.buckets + (float("inf"),), counts + [n]):
+                bound = 'le="%s"' % ("+Inf" if le == float("inf") else _num(le))
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, key, bound)} {c}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_num(round(total, 6))}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, key)} {n}")
+        return out
+
+
+# ---------- the app's metrics ----------
+STAGE_SECONDS = Histogram("lineup_stage_seconds", "Time spent per pipeline stage", ("stage",))
+HTTP_SECONDS = Histogram("http_request_seconds", "API request latency", ("route", "method", "status"))
+SPOTIFY_REQUESTS = Counter("spotify_requests_total", "Spotify Web API responses", ("endpoint", "status"))
+SPOTIFY_SECONDS = Histogram("spotify_request_seconds", "Spotify Web API latency", ("endpoint",))
+SNAPSHOT_CACHE = Counter("lineup_snapshot_cache_total", "Lineup snapshot cache lookups", ("mode", "result"))
+INGEST_RUNS = Counter("ingest_runs_total", "Recently-played ingest runs", ("result",))
+INGEST_ROWS = Counter("ingest_rows_total", "Rows fetched / inserted by the ingest", ("kind",))
+
+
+# ---------- spans ----------
+@contextmanager
+def span(stage: str):
+    """Time a block as `stage`; also recorded for the current request's Server-Timing."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        STAGE_SECONDS.observe(dt, stage=stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, dt))
+
+
+def begin_request() -> contextvars.Token:
+    """Start collecting spans for the request being handled in this context."""
+    return _request_timings.set([])
+
+
+def end_request(token: contextvars.Token) -> list[tuple[str, float]]:
+    timings = _request_timings.get() or []
+    _request_timings.reset(token)
+    return timings
+
+
+def server_timing(timings: list[tuple[str, float]]) -> str:
+    """Server-Timing header value; repeated stages are summed, in first-seen order."""
+    total: dict[str, float] = {}
+    for stage, dt in timings:
+        total[stage] = total.get(stage, 0.0) + dt
+    return ", ".join(f"{stage};dur={dt * 1000:.1f}" for stage, dt in total.items())
+
+
+# ---------- exposition ----------
+def register_collector(fn: Callable[[], Iterable[tuple]]) -> None:
+    """fn() yields (name, kind, help, [(labels_dict, value), ...]) at scrape time."""
+    with _lock:
+        _collectors.append(fn)
+
+
+def render() -> str:
+    lines = []
+    with _lock:
+        metrics, collectors = list(_metrics), list(_collectors)
+        blocks = [(m.name, m.kind, m.help, m.samples()) for m in metrics]
+    for fn in collectors:
+        try:
+            for name, kind, help, samples in fn():
+                names = tuple(sorted({k for labels, _ in samples for k in labels}))
+                blocks.append((name, kind, help, [
+                    f"{name}{_labels(names, tuple(labels.get(k, '') for k in names))} {_num(v)}"
+                    for labels, v in samples if v is not None]))
+        except Exception as e:
+            print(f"[WARN] metrics collector failed: {type(e).__name__}: {e}")
+    for name, kind, help, samples in blocks:
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}", *samples]
+    return "\n".join(lines) + "\n"
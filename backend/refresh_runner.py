@@ -1,12 +1,12 @@
 # backend/refresh_runner.py
 from __future__ import annotations
-import sys, subprocess, sqlite3, os
 from pathlib import Path
 from datetime import datetime, timezone
 
-HERE = Path(__file__).resolve().parent
-DB_PATH = (HERE / "data.db").resolve()
-LOGGER_PATH = (HERE / "logger_recent.py").resolve()
+import featurestore
+import logger_recent
+import spotify_clients
+import storage
 
 def _iso_mtime(p: Path):
     return datetime.fromtimestamp(p.stat().st_mtime, tz=timezone.utc).isoformat() if p.exists() else None
@@ -17,39 +17,48 @@ def _count(conn, table):
     except Exception:
         return -1
 
-def run():
-    before_mtime = _iso_mtime(DB_PATH)
-    if DB_PATH.exists():
-        with sqlite3.connect(DB_PATH) as c:
+def run(uid: str | None = None, cache_path: str | None = None):
+    if uid and not cache_path:
+        cache_path = spotify_clients.cache_path_for(uid)  # uid's own token, never the default cache
+    db_path = storage.db_path_for(uid)
+    before_mtime = _iso_mtime(db_path)
+    if db_path.exists():
+        with storage.connection(db_path) as c:
             before_plays = _count(c, "plays")
     else:
         before_plays = -1
 
-    if not LOGGER_PATH.exists():
-        return {"ok": False, "error": f"logger_recent.py not found at {LOGGER_PATH}", "db_path": str(DB_PATH)}
+    # Ingest in-process (no interpreter/pandas/spotipy startup per run)
+    result = logger_recent.run_ingest(cache_path=cache_path, db_path=db_path, uid=uid)
 
-    # Run the logger with the SAME Python/venv as FastAPI
-    cmd = [sys.executable, str(LOGGER_PATH)]
-    proc = subprocess.run(cmd, cwd=str(HERE), capture_output=True, text=True, env=os.environ.copy())
-
-    after_mtime = _iso_mtime(DB_PATH)
-    if DB_PATH.exists():
-        with sqlite3.connect(DB_PATH) as c:
+    after_mtime = _iso_mtime(db_path)
+    if db_path.exists():
+        with storage.connection(db_path) as c:
             after_plays = _count(c, "plays")
     else:
         after_plays = -1
 
+    # keep the columnar copy (featurestore.py) in step with the shard
+    features = None
+    if result.ok and result.inserted_plays and featurestore.enabled():
+        try:
+            features = featurestore.refresh(db_path)
+        except Exception as e:
+            features = {"error": f"{type(e).__name__}: {e}"}
+
     return {
-        "ok": proc.returncode == 0,
-        "returncode": proc.returncode,
-        "db_path": str(DB_PATH),
-        "logger_path": str(LOGGER_PATH),
+        "ok": result.ok,
+        "db_path": str(db_path),
         "db_before": {"mtime_iso": before_mtime, "plays": before_plays},
         "db_after":  {"mtime_iso": after_mtime,  "plays": after_plays},
-        "stdout": proc.stdout[-6000:],  # trimmed
-        "stderr": proc.stderr[-6000:],
+        "ingest": result.to_dict(),
+        "features": features,
+        "stdout": result.report()[-6000:],  # trimmed
+        "stderr": result.error or "",
     }
 
 if __name__ == "__main__":
-    import json
-    print(json.dumps(run(), indent=2))
+    import json, sys
+    uid = sys.argv[1] if len(sys.argv) > 1 else None
+    cache = spotify_clients.cache_path_for(uid) if uid else None
+    print(json.dumps(run(uid, cache), indent=2))
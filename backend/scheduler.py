@@ -0,0 +1,259 @@
+# scheduler.py — periodic background ingest for every connected user
+#
+# recently-played only returns the last 50 plays, so logging on page visits
+# loses plays for anyone who listens a lot between visits. This scheduler
+# finds connected users from their .spotipy-cache-<uid> token files and
+# ingests each one every INGEST_INTERVAL_S.
+#   - one global token bucket spaces runs out (Spotify rate limits per app)
+#   - a 429 pauses the whole bucket for Retry-After seconds
+#   - failing users back off exponentially, independent of everyone else
+#   - users whose cursor shows no recent plays drop to INGEST_IDLE_INTERVAL_S
+# stats() reports queue depth and lag, for sizing the interval against the user count.
+from __future__ import annotations
+import os, random, sqlite3, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Callable
+
+import spotify_clients
+import storage
+
+INTERVAL_S = float(os.getenv("INGEST_INTERVAL_S", "900"))                 # active users
+IDLE_AFTER_S = float(os.getenv("INGEST_IDLE_AFTER_S", str(3 * 24 * 3600)))  # no plays for this long = idle
+IDLE_INTERVAL_S = float(os.getenv("INGEST_IDLE_INTERVAL_S", str(6 * 3600)))
+RATE_PER_S = float(os.getenv("INGEST_RATE_PER_S", "1.0"))                # bucket refill (runs/sec)
+BURST = int(os.getenv("INGEST_BURST", "5"))                              # bucket capacity
+WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+BACKOFF_BASE_S = 60.0
+BACKOFF_MAX_S = 3600.0
+DISCOVER_EVERY_S = 60.0
+TICK_S = 1.0
+CACHE_PREFIX = ".spotipy-cache-"
+
+
+class TokenBucket:
+    """Classic token bucket; pause() freezes it after a 429."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.paused_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        if now > self._updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.paused_until or self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def pause(self, seconds: float):
+        with self._lock:
+            now = time.monotonic()
+            self.paused_until = max(self.paused_until, now + seconds)
+            self.tokens = 0.0
+            self._updated = self.paused_until  # no refill while paused
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                "tokens": round(self.tokens, 2),
+                "rate_per_s": self.rate,
+                "capacity": self.capacity,
+                "paused_for_s": round(max(0.0, self.paused_until - now), 1),
+            }
+
+
+@dataclass
+class UserState:
+    uid: str
+    next_due: float            # monotonic
+    idle: bool = False
+    in_flight: bool = False
+    failures: int = 0
+    runs: int = 0
+    inserted: int = 0
+    last_run_at: float | None = None    # wall clock
+    last_ok_at: float | None = None
+    last_error: str | None = None
+    last_lag_s: float = 0.0
+
+
+def discover_uids(base_dir: Path = spotify_clients.CACHE_DIR) -> list[str]:
+    """uids with a token cache file in the cache directory."""
+    return sorted(p.name[len(CACHE_PREFIX):] for p in base_dir.glob(CACHE_PREFIX + "*")
+                  if p.is_file() and len(p.name) > len(CACHE_PREFIX))
+
+
+def last_activity_ms(uid: str) -> int | None:
+    """The user's ingest cursor (ms of their newest logged play), if any."""
+    db_path = storage.db_path_for(uid)
+    if not db_path.exists():
+        return None
+    try:
+        with storage.connection(db_path) as conn:
+            row = conn.execute("SELECT after_ms FROM ingest_cursor WHERE uid=?", (uid,)).fetchone()
+        return row[0] if row else None
+    except sqlite3.Error:
+        return None
+
+
+class IngestScheduler:
+    def __init__(self, ingest: Callable, interval_s: float = INTERVAL_S,
+                 idle_after_s: float = IDLE_AFTER_S, idle_interval_s: float = IDLE_INTERVAL_S,
+                 rate_per_s: float = RATE_PER_S, burst: int = BURST, workers: int = WORKERS,
+                 discover: Callable[[], list[str]] = discover_uids):
+        self.ingest = ingest  # uid -> IngestResult
+        self.interval_s = interval_s
+        self.idle_after_s = idle_after_s
+        self.idle_interval_s = idle_interval_s
+        self.discover = discover
+        self.bucket = TokenBucket(rate_per_s, burst)
+        self.workers = workers
+        self._users: dict[str, UserState] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._pool: ThreadPoolExecutor | None = None
+        self._last_discover = float("-inf")
+        self._counters = dict.fromkeys(["runs", "ok", "errors", "rate_limited", "inserted"], 0)
+
+    # ---------- lifecycle ----------
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="sched-ingest")
+        self._thread = threading.Thread(target=self._loop, name="ingest-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, wait: bool = True):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        if self._pool:
+            self._pool.shutdown(wait=wait)
+
+    # ---------- scheduling ----------
+    def _is_idle(self, uid: str) -> bool:
+        ms = last_activity_ms(uid)
+        return ms is not None and time.time() - ms / 1000 > self.idle_after_s
+
+    def _sync_users(self, now: float):
+        uids = set(self.discover())
+        with self._lock:
+            for uid in uids - self._users.keys():
+                idle = self._is_idle(uid)
+                # active users are due now (the bucket spaces them); idle ones spread over one interval
+                due = now + random.uniform(0, self.interval_s) if idle else now
+                self._users[uid] = UserState(uid=uid, next_due=due, idle=idle)
+            for uid in self._users.keys() - uids:
+                if not self._users[uid].in_flight:
+                    del self._users[uid]
+        self._last_discover = now
+
+    def _due(self, now: float) -> list[UserState]:
+        with self._lock:
+            due = [u for u in self._users.values() if not u.in_flight and u.next_due <= now]
+        return sorted(due, key=lambda u: u.next_due)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            try:
+                if now - self._last_discover >= DISCOVER_EVERY_S:
+                    self._sync_users(now)
+                for user in self._due(now):
+                    if not self.bucket.try_acquire():
+                        break  # rest stay queued; their lag shows up in stats()
+                    with self._lock:
+                        user.in_flight = True
+                        user.last_lag_s = now - user.next_due
+                    self._pool.submit(self._run_one, user)
+            except Exception as e:
+                print(f"[WARN] ingest scheduler tick failed: {type(e).__name__}: {e}")
+            self._stop.wait(TICK_S)
+
+    def _run_one(self, user: UserState):
+        try:
+            res = self.ingest(user.uid)
+        except Exception as e:  # ingest is meant to never raise; be defensive anyway
+            res = None
+            error, retry_after = f"{type(e).__name__}: {e}", spotify_clients.retry_after_s(e)
+        else:
+            error, retry_after = res.error, res.retry_after_s
+        now = time.monotonic()
+        with self._lock:
+            user.in_flight = False
+            user.runs += 1
+            user.last_run_at = time.time()
+            self._counters["runs"] += 1
+            if res is not None and res.ok:
+                user.failures = 0
+                user.last_ok_at = user.last_run_at
+                user.last_error = None
+                user.inserted += res.inserted_plays
+                self._counters["ok"] += 1
+                self._counters["inserted"] += res.inserted_plays
+                cursor = res.cursor_after
+                user.idle = res.inserted_plays == 0 and (
+                    cursor is None or time.time() - cursor / 1000 > self.idle_after_s)
+                period = self.idle_interval_s if user.idle else self.interval_s
+                user.next_due = now + period
+                return
+            user.failures += 1
+            user.last_error = error
+            self._counters["errors"] += 1
+            backoff = min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2 ** (user.failures - 1))
+            if retry_after is not None:
+                self._counters["rate_limited"] += 1
+                backoff = max(backoff, retry_after)
+            user.next_due = now + backoff * random.uniform(1.0, 1.2)
+        if retry_after is not None:
+            self.bucket.pause(retry_after)  # rate limits are per app, not per user
+
+    # ---------- metrics ----------
+    def stats(self, per_user: bool = False) -> dict:
+        """Aggregate counters; per_user adds every uid's state and last error (admin only)."""
+        now = time.monotonic()
+        with self._lock:
+            users = list(self._users.values())
+            counters = dict(self._counters)
+            due = [u for u in users if not u.in_flight and u.next_due <= now]
+            lags = [now - u.next_due for u in due]
+            users_detail = [{
+                **{k: v for k, v in asdict(u).items() if k not in ("next_due", "last_lag_s")},
+                "due_in_s": round(u.next_due - now, 1),
+                "last_lag_s": round(u.last_lag_s, 1),
+            } for u in sorted(users, key=lambda u: u.next_due)]
+        active = sum(1 for u in users if not u.idle)
+        return {
+            "running": bool(self._thread and self._thread.is_alive()),
+            "users": len(users),
+            "active_users": active,
+            "idle_users": len(users) - active,
+            "in_flight": sum(1 for u in users if u.in_flight),
+            "queue_depth": len(due),
+            "max_lag_s": round(max(lags), 1) if lags else 0.0,
+            "avg_lag_s": round(sum(lags) / len(lags), 1) if lags else 0.0,
+            "interval_s": self.interval_s,
+            "idle_interval_s": self.idle_interval_s,
+            # runs the bucket can afford per interval vs. runs the user base needs
+            "capacity_per_interval": round(self.bucket.rate * self.interval_s),
+            "demand_per_interval": round(active + (len(users) - active) * self.interval_s / self.idle_interval_s, 1),
+            "bucket": self.bucket.snapshot(),
+            **counters,
+            **({"per_user": users_detail} if per_user else {}),
+        }
@@ -0,0 +1,179 @@
+# scoring.py — HIv2 as one vectorized pass over a float feature matrix
+#
+#   raw columns (n × r) --z-score--> Zr --@ COMPOSE (r × f)--> features Z (n × f)
+#   scores = Zr @ (COMPOSE @ W) with W (f × p), one column per weight profile
+#
+# Composite features (clout, diversity, recency) are linear in the z-scores of
+# their raw inputs, so the whole pipeline is two small matmuls. Scoring several
+# users at once stacks their rows and z-scores per user with segment sums, and
+# several profiles are extra columns of W, so a batch costs about one call.
+#
+# Weights live in named, versioned profiles ("hiv2-current@1"). A bare name
+# resolves to its highest version. SCORING_PROFILES_PATH may point to a JSON
+# file of {"name@version": {feature: weight}} that adds or overrides profiles.
+from __future__ import annotations
+import json, os
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+FEATURES = ("plays30", "momentum", "popularity", "clout", "recency", "affinity", "diversity")
+
+# raw inputs, in matrix column order
+RAW = ("plays_30d", "momentum", "popularity", "artist_pop", "artist_followers_log",
+       "days_since_release", "is_saved", "distinct_days", "contexts_n")
+
+# how each feature combines z-scored raw columns
+_COMPOSITION = {
+    "plays30": {"plays_30d": 1.0},
+    "momentum": {"momentum": 1.0},
+    "popularity": {"popularity": 1.0},
+    "clout": {"artist_pop": 0.5, "artist_followers_log": 0.5},
+    "recency": {"days_since_release": -1.0},   # newer release = higher
+    "affinity": {"is_saved": 1.0},
+    "diversity": {"distinct_days": 0.5, "contexts_n": 0.5},
+}
+COMPOSE = np.zeros((len(RAW), len(FEATURES)))
+for _j, _f in enumerate(FEATURES):
+    for _col, _coef in _COMPOSITION[_f].items():
+        COMPOSE[RAW.index(_col), _j] = _coef
+
+BUILTIN_PROFILES = {
+    "hiv2-current@1": {"plays30": 0.35, "momentum": 0.20, "popularity": 0.15, "clout": 0.10,
+                       "recency": 0.10, "affinity": 0.07, "diversity": 0.03},
+    "hiv2-alltime@1": {"popularity": 0.45, "clout": 0.25, "recency": 0.20, "affinity": 0.10},
+}
+PROFILES_PATH = os.getenv("SCORING_PROFILES_PATH")
+
+
+@dataclass(frozen=True)
+class Profile:
+    name: str
+    version: int
+    weights: np.ndarray  # (len(FEATURES),)
+
+    @property
+    def id(self) -> str:
+        return f"{self.name}@{self.version}"
+
+
+def _load_profiles() -> dict[str, Profile]:
+    specs = dict(BUILTIN_PROFILES)
+    if PROFILES_PATH and Path(PROFILES_PATH).exists():
+        try:
+            specs.update(json.loads(Path(PROFILES_PATH).read_text(encoding="utf-8")))
+        except Exception as e:
+            print(f"[WARN] scoring profiles file ignored ({PROFILES_PATH}): {e}")
+    out = {}
+    for key, weights in specs.items():
+        name, _, version = key.partition("@")
+        unknown = set(weights) - set(FEATURES)
+        if unknown:
+            raise ValueError(f"profile {key}: unknown features {sorted(unknown)}")
+        w = np.array([float(weights.get(f, 0.0)) for f in FEATURES])
+        out[key] = Profile(name, int(version or 1), w)
+    return out
+
+
+PROFILES = _load_profiles()
+
+
+def get_profile(ref: str) -> Profile:
+    """'name@version', or a bare 'name' for its latest version."""
+    if ref in PROFILES:
+        return PROFILES[ref]
+    versions = [p for p in PROFILES.values() if p.name == ref]
+    if not versions:
+        raise KeyError(f"unknown scoring profile: {ref}")
+    return max(versions, key=lambda p: p.version)
+
+
+# ---------- feature matrix ----------
+_INPUTS = ["plays_30d", "plays_7d", "plays_prev7d", "popularity", "artist_pop", "artist_followers",
+           "days_since_release", "is_saved", "distinct_days", "contexts_n"]
+
+
+def raw_matrix(df: pd.DataFrame) -> np.ndarray:
+    """(n, len(RAW)) contiguous float64 matrix; absent inputs are zeros."""
+    m = df.reindex(columns=_INPUTS).to_numpy(dtype=float, na_value=np.nan)
+    dsr = m[:, 6].copy()
+    m = np.nan_to_num(m)
+    if "days_since_release" in df.columns and np.isnan(dsr).any():
+        # unknown release dates take the median; with none known (e.g. imported
+        # plays not yet resolved) recency is neutral instead of NaN-ing every score
+        dsr[np.isnan(dsr)] = 0.0 if np.isnan(dsr).all() else np.nanmedian(dsr)
+    elif "days_since_release" not in df.columns:
+        dsr = np.zeros(len(df))
+    raw = np.empty((len(df), len(RAW)))
+    raw[:, 0] = m[:, 0]
+    raw[:, 1] = m[:, 1] - m[:, 2]
+    raw[:, 2] = m[:, 3]
+    raw[:, 3] = m[:, 4]
+    raw[:, 4] = np.log1p(m[:, 5])
+    raw[:, 5] = dsr
+    raw[:, 6:9] = m[:, 7:10]
+    return raw
+
+
+def zscore(raw: np.ndarray, starts: np.ndarray | None = None) -> np.ndarray:
+    """
+    Column z-scores (sample std, like pandas); a zero/undefined std counts as 1.
+    `starts` are the first row of each group when several users are stacked.
+    """
+    n = raw.shape[0]
+    if n == 0:
+        return raw.copy()
+    if starts is None:
+        starts = np.zeros(1, dtype=np.intp)
+    counts = np.diff(np.append(starts, n))
+    group = np.repeat(np.arange(len(starts)), counts)
+    mean = np.add.reduceat(raw, starts, axis=0) / counts[:, None]
+    dev = raw - mean[group]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sd = np.sqrt(np.add.reduceat(dev * dev, starts, axis=0) / (counts[:, None] - 1))
+    sd[~np.isfinite(sd) | (sd == 0)] = 1.0
+    return dev / sd[group]
+
+
+def weight_matrix(profiles) -> np.ndarray:
+    """(len(FEATURES), p) weights for the given profile refs."""
+    return np.column_stack([get_profile(p).weights for p in profiles])
+
+
+# ---------- public API ----------
+def score_matrices(raws: list[np.ndarray], profiles: list[str]) -> list[np.ndarray]:
+    """
+    Score stacked raw matrices (one per user, z-scored within itself) under every
+    profile in a single pass. Returns one (n_i, len(profiles)) array per matrix.
+    """
+    sizes = [len(r) for r in raws]
+    if not sum(sizes):
+        return [np.zeros((0, len(profiles))) for _ in raws]
+    raw = np.concatenate([r for r in raws if len(r)])
+    starts = np.cumsum([0] + [n for n in sizes if n][:-1], dtype=np.intp)
+    scores = zscore(raw, starts) @ (COMPOSE @ weight_matrix(profiles))
+    return np.split(scores, np.cumsum(sizes)[:-1])
+
+
+def score_many(frames: list[pd.DataFrame], profiles: list[str]) -> list[np.ndarray]:
+    """score_matrices() over fetch_*_df frames."""
+    return score_matrices([raw_matrix(df) for df in frames], profiles)
+
+
+def features(df: pd.DataFrame) -> np.ndarray:
+    """(n, len(FEATURES)) z-scored feature matrix for one user."""
+    return zscore(raw_matrix(df)) @ COMPOSE
+
+
+def score_frame(df: pd.DataFrame, profile: str) -> pd.DataFrame:
+    """Add z_<feature> columns and HIv2 under `profile` to df (in place) and return it."""
+    if df.empty:
+        df["HIv2"] = pd.Series(dtype=float)
+        return df
+    feats = features(df)
+    df["artist_followers_log"] = np.log1p(df["artist_followers"].fillna(0)) if "artist_followers" in df else 0.0
+    df[[f"z_{f}" for f in FEATURES]] = feats
+    df["HIv2"] = feats @ get_profile(profile).weights
+    return df
@@ -0,0 +1,168 @@
+# spotify_clients.py — lazy, per-user Spotify clients sharing one pooled HTTP session
+#
+# Nothing is built at import time. get_client(uid) creates the client for a
+# uid on first use (bound to that user's .spotipy-cache-<uid> token file) and
+# reuses it afterwards. All clients send requests through one keep-alive
+# requests.Session, so concurrent users share TCP/TLS connections to
+# api.spotify.com while each request still carries its own user's token.
+# spotipy and requests are imported on first use, not at import time, so
+# the API process can answer health checks before they are loaded.
+from __future__ import annotations
+import os, re, threading
+from pathlib import Path
+from typing import TYPE_CHECKING
+from urllib.parse import urlsplit
+
+from dotenv import load_dotenv
+
+import metrics
+
+if TYPE_CHECKING:
+    import requests
+    import spotipy
+    from spotipy.oauth2 import SpotifyOAuth
+
+BASE_DIR = Path(__file__).resolve().parent
+load_dotenv(BASE_DIR / ".env")
+DEFAULT_SCOPE = "user-read-recently-played user-library-read user-top-read"
+POOL_CONNECTIONS = int(os.getenv("SPOTIFY_POOL_CONNECTIONS", "4"))   # distinct hosts kept
+POOL_MAXSIZE = int(os.getenv("SPOTIFY_POOL_MAXSIZE", "32"))          # keep-alive sockets per host
+REQUESTS_TIMEOUT = int(os.getenv("SPOTIFY_REQUESTS_TIMEOUT", "30"))
+RATE_LIMIT_DEFAULT_WAIT_S = 30.0  # 429 without a usable Retry-After header
+CACHE_DIR = Path(os.getenv("SPOTIPY_CACHE_DIR") or BASE_DIR)  # where .spotipy-cache-<uid> files live
+MAX_CLIENTS = int(os.getenv("SPOTIFY_MAX_CLIENTS", "1000"))  # cached clients; oldest dropped first
+FAKE_SPOTIFY = os.getenv("FAKE_SPOTIFY", "0") == "1"  # answer Spotify calls locally (see fake_spotify.py)
+if FAKE_SPOTIFY:  # the fake accepts any client credentials
+    os.environ.setdefault("SPOTIPY_CLIENT_ID", "fake-client-id")
+    os.environ.setdefault("SPOTIPY_CLIENT_SECRET", "fake-client-secret")
+
+_clients: dict[str, spotipy.Spotify] = {}
+_clients_lock = threading.Lock()
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+
+
+def cache_path_for(uid: str | None) -> str:
+    if not uid:
+        # fallback to env (optional) or default file
+        return os.getenv("SPOTIPY_CACHE_PATH") or str(CACHE_DIR / ".spotipy-cache")
+    return str(CACHE_DIR / f".spotipy-cache-{uid}")
+
+
+def has_token_for(uid: str | None) -> bool:
+    """A token cache file exists for `uid` (checked without building a client)."""
+    return os.path.isfile(cache_path_for(uid))
+
+
+_ID_SEGMENT = re.compile(r"/[A-Za-z0-9]{22}(?=/|$)")  # /v1/tracks/<id> -> /v1/tracks/{id}
+_USER_SEGMENT = re.compile(r"(/v1/users/)[^/]+")      # user ids are free-form: never a metric label
+
+
+def _record_response(resp, *args, **kwargs):
+    """Session response hook: Spotify calls by endpoint and status, with latency."""
+    path = _USER_SEGMENT.sub(r"\1{user_id}", urlsplit(resp.url).path.rstrip("/"))
+    endpoint = _ID_SEGMENT.sub("/{id}", path) or "/"
+    metrics.SPOTIFY_REQUESTS.inc(endpoint=endpoint, status=str(resp.status_code))
+    metrics.SPOTIFY_SECONDS.observe(resp.elapsed.total_seconds(), endpoint=endpoint)
+
+
+def _new_shared_session() -> requests.Session:
+    import requests
+
+    class _SharedSession(requests.Session):
+        """spotipy closes its session in __del__; a shared pool must outlive any one client."""
+
+        def close(self):
+            pass
+
+    return _SharedSession()
+
+
+def shared_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+                s = _new_shared_session()
+                retry = Retry(  # spotipy's defaults minus 429: rate limits surface with Retry-After
+                    total=3, connect=None, read=False,
+                    allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+                    status=3, backoff_factor=0.3,
+                    status_forcelist=(500, 502, 503, 504),
+                )
+                adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                                      max_retries=retry, pool_block=False)
+                s.mount("https://", adapter)
+                s.mount("http://", adapter)
+                s.hooks["response"].append(_record_response)
+                if FAKE_SPOTIFY:
+                    import fake_spotify  # load tests / offline dev only
+                    fake_spotify.install(s)
+                _session = s
+    return _session
+
+
+def oauth_for_cache(cache_path: str, open_browser: bool = False) -> SpotifyOAuth:
+    from spotipy.oauth2 import SpotifyOAuth
+    return SpotifyOAuth(
+        client_id=os.getenv("SPOTIPY_CLIENT_ID"),
+        client_secret=os.getenv("SPOTIPY_CLIENT_SECRET"),
+        redirect_uri=os.getenv("SPOTIPY_REDIRECT_URI", "http://localhost:8000/callback"),
+        scope=os.getenv("SPOTIPY_SCOPE", DEFAULT_SCOPE),
+        open_browser=open_browser,
+        cache_path=cache_path,
+        show_dialog=False,
+        requests_timeout=REQUESTS_TIMEOUT,
+        requests_session=shared_session(),
+    )
+
+
+def client_for_cache(cache_path: str, open_browser: bool = False) -> spotipy.Spotify:
+    """Cached client for one token cache file (built on first use)."""
+    client = _clients.get(cache_path)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(cache_path)
+            if client is None:
+                import spotipy
+                client = spotipy.Spotify(
+                    auth_manager=oauth_for_cache(cache_path, open_browser),
+                    requests_session=shared_session(),
+                    requests_timeout=REQUESTS_TIMEOUT,
+                )
+                while len(_clients) >= MAX_CLIENTS:  # rebuilt on next use; no state beyond the file
+                    _clients.pop(next(iter(_clients)))
+                _clients[cache_path] = client
+    return client
+
+
+def get_client(uid: str | None = None) -> spotipy.Spotify:
+    """The Spotify client for `uid` (default cache when None)."""
+    return client_for_cache(cache_path_for(uid))
+
+
+def has_cached_token(sp) -> bool:
+    """False when using `sp` would fall into spotipy's interactive login prompt."""
+    auth = getattr(sp, "auth_manager", None)
+    if auth is None or not hasattr(auth, "cache_handler"):
+        return True  # stubs / bearer-token clients
+    return bool(auth.cache_handler.get_cached_token())
+
+
+def retry_after_s(exc: BaseException) -> float | None:
+    """Seconds Spotify asked us to wait if `exc` is a 429, else None."""
+    import spotipy
+    if not isinstance(exc, spotipy.SpotifyException) or exc.http_status != 429:
+        return None
+    try:
+        return max(0.0, float((exc.headers or {}).get("Retry-After", RATE_LIMIT_DEFAULT_WAIT_S)))
+    except (TypeError, ValueError):
+        return RATE_LIMIT_DEFAULT_WAIT_S
+
+
+def drop_client(uid: str | None) -> None:
+    """Forget a uid's client (e.g. after its token file was replaced)."""
+    with _clients_lock:
+        _clients.pop(cache_path_for(uid), None)
@@ -0,0 +1,393 @@
+# storage.py — per-user SQLite shards, their schema, and pooled connections
+#
+# Each Spotify uid gets its own database file under shards/, so one user's
+# plays never mix with another's and ingest runs for different users don't
+# contend for the same SQLite write lock. The original data.db stays the
+# shard for requests without a uid cookie (and, optionally, for the demo
+# owner via LEGACY_DB_UID).
+#
+# This module also owns every table in a shard. MIGRATIONS is an ordered
+# list applied once per file and tracked in PRAGMA user_version. Each step
+# is idempotent, so databases created before versioning upgrade in place.
+# connection() hands out one WAL-mode connection per thread per shard:
+# readers keep reading from their snapshot while the ingest writer commits.
+from __future__ import annotations
+import hashlib, os, re, sqlite3, threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+LEGACY_DB = BASE_DIR / "data.db"
+SHARD_DIR = Path(os.getenv("DATA_SHARD_DIR") or BASE_DIR / "shards")
+BUSY_TIMEOUT_S = float(os.getenv("SQLITE_BUSY_TIMEOUT_S", "10"))
+CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_KB", "16384"))         # page cache per connection
+MMAP_SIZE = int(os.getenv("SQLITE_MMAP_BYTES", str(128 * 1024 * 1024)))
+MAX_CONNS_PER_THREAD = int(os.getenv("SQLITE_CONNS_PER_THREAD", "8"))  # LRU over shards
+MAX_TRACKED_SHARDS = int(os.getenv("MAX_TRACKED_SHARDS", "10000"))     # cap on per-uid paths and locks
+
+_UID_RE = re.compile(r"[^A-Za-z0-9._-]")
+_locks: dict[str, threading.Lock] = {}
+_locks_guard = threading.Lock()
+_shard_paths: dict[str, Path] = {}  # uid -> resolved shard file (old name adopted); oldest evicted
+_shard_dir_ready = False
+
+
+def shard_name(uid: str) -> str:
+    """
+    Filesystem-safe, collision-free shard name for a Spotify uid: a readable
+    sanitized prefix plus a sha256 prefix of the exact uid (sanitizing and
+    truncating alone maps e.g. "a.b" and "a_b" to the same file).
+    """
+    safe = _UID_RE.sub("_", uid)[:48] or "_"
+    return f"{safe}-{hashlib.sha256(uid.encode('utf-8')).hexdigest()[:16]}"
+
+
+def _legacy_shard_path(uid: str) -> Path | None:
+    """Pre-hash shard file of a uid that sanitizing left unchanged (it can only be this uid's)."""
+    if _UID_RE.search(uid) or len(uid) > 64:
+        return None
+    return SHARD_DIR / f"{uid}.db"
+
+
+def db_path_for(uid: str | None) -> Path:
+    """Database file that owns `uid`'s plays, lineup history and ingest cursor."""
+    if not uid or uid == os.getenv("LEGACY_DB_UID"):
+        return LEGACY_DB
+    path = _shard_paths.get(uid)
+    if path is not None:
+        return path
+    global _shard_dir_ready
+    with _locks_guard:
+        if not _shard_dir_ready:
+            SHARD_DIR.mkdir(parents=True, exist_ok=True)
+            _shard_dir_ready = True
+        path = SHARD_DIR / f"{shard_name(uid)}.db"
+        old = _legacy_shard_path(uid)
+        if old is not None and not path.exists() and old.exists():
+            for suffix in ("", "-wal", "-shm"):  # adopt the old name's file (and its WAL)
+                src = Path(f"{old}{suffix}")
+                if src.exists():
+                    os.replace(src, f"{path}{suffix}")
+        while len(_shard_paths) >= MAX_TRACKED_SHARDS:
+            _shard_paths.pop(next(iter(_shard_paths)))
+        _shard_paths[uid] = path
+    return path
+
+
+def existing_db_path(uid: str | None) -> Path | None:
+    """db_path_for(uid) if that database file already exists, else None; creates nothing."""
+    if not uid or uid == os.getenv("LEGACY_DB_UID"):
+        return LEGACY_DB if LEGACY_DB.exists() else None
+    path = _shard_paths.get(uid) or SHARD_DIR / f"{shard_name(uid)}.db"
+    if path.exists():
+        return path
+    old = _legacy_shard_path(uid)
+    return db_path_for(uid) if old is not None and old.exists() else None
+
+
+def user_lock(uid: str | None) -> threading.Lock:
+    """Per-shard lock: one ingest at a time per user, users run in parallel."""
+    key = str(db_path_for(uid))
+    with _locks_guard:
+        lock = _locks.get(key)
+        if lock is None:
+            if len(_locks) >= MAX_TRACKED_SHARDS:  # forget the idle ones
+                for k in [k for k, v in _locks.items() if not v.locked()]:
+                    del _locks[k]
+            lock = _locks[key] = threading.Lock()
+        return lock
+
+
+# ---------- schema ----------
+def _ensure_column(conn, table, column, decl):
+    cols = {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in cols:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def format_played_at(dt: datetime) -> str:
+    """Aware or naive-UTC datetime -> the plays key (fraction only when non-zero)."""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.isoformat() + "Z"
+
+
+def norm_played_at(played_at: str) -> str:
+    """Spotify played_at -> canonical UTC ISO with a Z suffix (the plays key)."""
+    return format_played_at(datetime.fromisoformat(played_at.replace("Z", "+00:00")))
+
+
+def _m1_core_tables(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS plays(
+        played_at TEXT PRIMARY KEY,   -- ISO8601 UTC
+        track_id  TEXT NOT NULL,
+        context   TEXT
+    )""")
+    # lineup_core.refresh_recent_plays used to create plays keyed on
+    # (played_at, track_id) with raw Spotify timestamps; fold such tables
+    # into the canonical one-row-per-instant form
+    pk = [r[1] for r in sorted(conn.execute("PRAGMA table_info(plays)"), key=lambda r: r[5]) if r[5]]
+    if pk != ["played_at"]:
+        rows = conn.execute("SELECT played_at, track_id, context FROM plays ORDER BY rowid").fetchall()
+        conn.execute("DROP TABLE plays")
+        conn.execute("""CREATE TABLE plays(
+            played_at TEXT PRIMARY KEY,
+            track_id  TEXT NOT NULL,
+            context   TEXT
+        )""")
+        conn.executemany("INSERT OR IGNORE INTO plays(played_at, track_id, context) VALUES(?,?,?)",
+                         [(norm_played_at(p), t, c) for p, t, c in rows])
+    conn.execute("""CREATE TABLE IF NOT EXISTS tracks(
+        id TEXT PRIMARY KEY,
+        name TEXT,
+        duration_ms INTEGER,
+        popularity INTEGER,
+        album_id TEXT,
+        is_saved INTEGER DEFAULT 0
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS albums(
+        id TEXT PRIMARY KEY,
+        name TEXT,
+        release_date TEXT,
+        image_url TEXT
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS artists(
+        id TEXT PRIMARY KEY,
+        name TEXT,
+        popularity INTEGER,
+        followers INTEGER,
+        genres TEXT,
+        image_url TEXT
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS track_artists(
+        track_id TEXT,
+        artist_id TEXT,
+        PRIMARY KEY(track_id, artist_id)
+    )""")
+    # for diagnostic heartbeats
+    conn.execute("""CREATE TABLE IF NOT EXISTS runs(
+        ran_at TEXT PRIMARY KEY,   -- ISO8601 UTC
+        note   TEXT
+    )""")
+    # data.db files created before the image columns existed
+    _ensure_column(conn, "albums", "image_url", "TEXT")
+    _ensure_column(conn, "artists", "image_url", "TEXT")
+
+
+def _m2_ingest_cursor(conn):
+    # per-user high-water mark for the recently-played `after` cursor
+    conn.execute("""CREATE TABLE IF NOT EXISTS ingest_cursor(
+        uid        TEXT PRIMARY KEY,   -- '' for the default cache
+        after_ms   INTEGER NOT NULL,   -- newest played_at seen, unix ms
+        updated_at TEXT
+    )""")
+    # covering index for played_at window scans
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_plays_window ON plays(played_at, track_id, context)")
+
+
+def _m3_daily_rollup(conn):
+    # daily rollup kept in sync by a trigger, i.e. inside the same transaction as each play insert
+    conn.execute("""CREATE TABLE IF NOT EXISTS track_daily_plays(
+        track_id TEXT NOT NULL,
+        day      TEXT NOT NULL,            -- YYYY-MM-DD (UTC, prefix of played_at)
+        plays    INTEGER NOT NULL DEFAULT 0,
+        contexts TEXT NOT NULL DEFAULT '', -- comma-joined distinct context types that day
+        PRIMARY KEY(track_id, day)
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_track_daily_plays_day ON track_daily_plays(day, track_id)")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS trg_plays_daily_rollup AFTER INSERT ON plays BEGIN
+        INSERT INTO track_daily_plays(track_id, day, plays, contexts)
+        VALUES (NEW.track_id, substr(NEW.played_at, 1, 10), 1, COALESCE(NEW.context, ''))
+        ON CONFLICT(track_id, day) DO UPDATE SET
+          plays = plays + 1,
+          contexts = CASE
+            WHEN NEW.context IS NULL
+              OR instr(',' || contexts || ',', ',' || NEW.context || ',') > 0 THEN contexts
+            WHEN contexts = '' THEN NEW.context
+            ELSE contexts || ',' || NEW.context
+          END;
+    END""")
+    backfill_daily_rollup(conn)
+
+
+def _m4_lookup_indexes(conn):
+    # per-track play lookups and artist -> tracks joins
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_plays_track ON plays(track_id, played_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_track_artists_artist ON track_artists(artist_id, track_id)")
+
+
+def _m5_lineup_history(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS lineup_history(
+        id       INTEGER PRIMARY KEY AUTOINCREMENT,
+        mode     TEXT NOT NULL,
+        taken_at TEXT NOT NULL,   -- snapshot["date"] of the first occurrence, ISO8601 UTC
+        payload  TEXT NOT NULL    -- full snapshot JSON, or a delta (see history_store.make_delta)
+    )""")
+    # content-addressed dedup / delta columns (ALTERs migrate pre-dedup tables)
+    for col, decl in (("content_hash", "TEXT"), ("kind", "TEXT NOT NULL DEFAULT 'full'"),
+                      ("base_id", "INTEGER"), ("depth", "INTEGER NOT NULL DEFAULT 0"),
+                      ("last_seen_at", "TEXT"), ("seen_count", "INTEGER NOT NULL DEFAULT 1")):
+        _ensure_column(conn, "lineup_history", col, decl)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_lineup_history_mode ON lineup_history(mode, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_lineup_history_taken ON lineup_history(taken_at)")
+    conn.execute("""CREATE TABLE IF NOT EXISTS history_meta(
+        key   TEXT PRIMARY KEY,
+        value TEXT
+    )""")
+
+
+def _m6_top_tracks_cache(conn):
+    # Spotify top tracks per time range, slimmed JSON list (see top_tracks.py)
+    conn.execute("""CREATE TABLE IF NOT EXISTS top_tracks_cache(
+        time_range TEXT PRIMARY KEY,   -- short_term | medium_term | long_term
+        items      TEXT NOT NULL,
+        fetched_at REAL NOT NULL       -- unix seconds
+    )""")
+
+
+def _m7_data_generation(conn):
+    # bumped by every metadata writer (bump_data_generation); part of lineup_core.data_version
+    conn.execute("""CREATE TABLE IF NOT EXISTS shard_meta(
+        key   TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )""")
+    conn.execute("INSERT OR IGNORE INTO shard_meta(key, value) VALUES('data_gen', 0)")
+
+
+def _m8_artist_lookup_misses(conn):
+    # artist ids /v1/artists returned null for; not asked again for TOP_TRACKS_TTL_S (see top_tracks.py)
+    conn.execute("""CREATE TABLE IF NOT EXISTS artist_lookup_misses(
+        id         TEXT PRIMARY KEY,
+        checked_at REAL NOT NULL       -- unix seconds
+    )""")
+
+
+# append only: user_version N means MIGRATIONS[:N] have been applied
+MIGRATIONS = [
+    _m1_core_tables,
+    _m2_ingest_cursor,
+    _m3_daily_rollup,
+    _m4_lookup_indexes,
+    _m5_lineup_history,
+    _m6_top_tracks_cache,
+    _m7_data_generation,
+    _m8_artist_lookup_misses,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def backfill_daily_rollup(conn) -> int:
+    """Rebuild track_daily_plays from raw plays; returns rollup rows written."""
+    conn.execute("DELETE FROM track_daily_plays")
+    conn.execute("""INSERT INTO track_daily_plays(track_id, day, plays, contexts)
+                    SELECT track_id, substr(played_at, 1, 10), COUNT(*),
+                           COALESCE(group_concat(DISTINCT context), '')
+                    FROM plays
+                    GROUP BY track_id, substr(played_at, 1, 10)""")
+    return conn.execute("SELECT COUNT(*) FROM track_daily_plays").fetchone()[0]
+
+
+def bump_data_generation(conn) -> None:
+    """
+    Mark the shard's tracks/albums/artists as changed. Plays move data_version
+    on their own; writers of metadata only (saved flags, resolved imports,
+    artist refreshes) call this inside their transaction.
+    """
+    conn.execute("UPDATE shard_meta SET value = value + 1 WHERE key = 'data_gen'")
+
+
+def schema_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Apply pending migrations, one transaction each; returns the resulting version."""
+    version = schema_version(conn)
+    while version < SCHEMA_VERSION:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            version = schema_version(conn)  # another process may have got here first
+            if version >= SCHEMA_VERSION:
+                break
+            MIGRATIONS[version](conn)
+            version += 1
+            conn.execute(f"PRAGMA user_version = {version}")
+    return version
+
+
+# ---------- connections ----------
+def _configure(conn: sqlite3.Connection) -> sqlite3.Connection:
+    conn.execute("PRAGMA journal_mode=WAL")       # readers don't block the writer (persists in the file)
+    conn.execute("PRAGMA synchronous=NORMAL")     # durable at checkpoints; safe with WAL
+    conn.execute(f"PRAGMA busy_timeout={int(BUSY_TIMEOUT_S * 1000)}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+_migrated: set[str] = set()
+_migrate_lock = threading.Lock()
+_local = threading.local()
+
+
+def connect(db_path: Path | str) -> sqlite3.Connection:
+    """New tuned connection with the schema migrated; the caller closes it."""
+    db_path = Path(db_path)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = _configure(sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_S))
+    key = str(db_path)
+    if key not in _migrated:
+        with _migrate_lock:
+            if key not in _migrated:
+                migrate(conn)
+                _migrated.add(key)
+    return conn
+
+
+def connect_readonly(db_path: Path | str) -> sqlite3.Connection:
+    """
+    New tuned read-only connection (URI mode=ro): never creates, migrates or
+    writes the file, so a missing database raises sqlite3.OperationalError.
+    """
+    conn = sqlite3.connect(f"{Path(db_path).resolve().as_uri()}?mode=ro", uri=True, timeout=BUSY_TIMEOUT_S)
+    conn.execute(f"PRAGMA busy_timeout={int(BUSY_TIMEOUT_S * 1000)}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def connection(db_path: Path | str, readonly: bool = False) -> sqlite3.Connection:
+    """
+    This thread's pooled connection to `db_path` (opened on first use).
+    Don't close it; `with connection(p) as conn:` commits or rolls back.
+    readonly=True gives a separate mode=ro connection for read paths.
+    """
+    path = str(db_path)
+    key = f"{path}?mode=ro" if readonly else path
+    pool: OrderedDict[str, sqlite3.Connection] | None = getattr(_local, "conns", None)
+    if pool is None:
+        pool = _local.conns = OrderedDict()
+    conn = pool.get(key)
+    if conn is not None and not Path(path).exists():
+        conn.close()  # file was deleted/replaced under us
+        pool.pop(key)
+        _migrated.discard(path)
+        conn = None
+    if conn is None:
+        conn = pool[key] = connect_readonly(path) if readonly else connect(path)
+        while len(pool) > MAX_CONNS_PER_THREAD:
+            _, old = pool.popitem(last=False)
+            old.close()
+    pool.move_to_end(key)
+    return conn
+
+
+def close_thread_connections() -> None:
+    """Close this thread's pooled connections (worker shutdown, tests)."""
+    pool = getattr(_local, "conns", None) or {}
+    for conn in pool.values():
+        conn.close()
+    pool.clear()
@@ -0,0 +1,16 @@
+# Tests import the backend modules the way main.py does: flat, from backend/.
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import storage  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """A fresh shard file; this thread's pooled connections are closed afterwards."""
+    yield tmp_path / "shard.db"
+    storage.close_thread_connections()
@@ -0,0 +1,84 @@
+import history_store
+import storage
+
+
+def snapshot(i: int, mode: str = "current") -> dict:
+    """Lineup whose leadoff track and scores move with `i`, like consecutive refreshes."""
+    return {
+        "mode": mode,
+        "date": f"2026-01-01T00:{i // 60:02d}:{i % 60:02d}+00:00",
+        "lineup": [{"position": pos, "track_id": f"t{(n + i) % 12}", "score": round(1.0 - n * 0.05 + i * 0.001, 4)}
+                   for n, pos in enumerate(["CF", "SS", "LF", "2B", "RF", "3B", "1B", "C", "P"])],
+        "star": f"t{i % 12}",
+    }
+
+
+def strip(snap: dict) -> dict:
+    return {k: v for k, v in snap.items() if k not in ("last_seen", "seen_count")}
+
+
+def test_paging_matches_single_page(db_path):
+    snaps = [snapshot(i) for i in range(7)]
+    for s in snaps:
+        history_store.append(s, db_path=db_path)
+    seen, cursor = [], None
+    while True:
+        page = history_store.query(mode="current", limit=3, cursor=cursor, db_path=db_path)
+        seen += [strip(s) for s in page["history"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == snaps
+
+
+def test_time_range(db_path):
+    snaps = [snapshot(i) for i in range(6)]
+    for s in snaps:
+        history_store.append(s, db_path=db_path)
+    page = history_store.query(since=snaps[2]["date"], until=snaps[4]["date"], db_path=db_path)
+    assert [s["date"] for s in page["history"]] == [snaps[2]["date"], snaps[3]["date"]]
+
+
+def test_modes_are_separate_chains(db_path):
+    history_store.append(snapshot(0, "current"), db_path=db_path)
+    history_store.append(snapshot(0, "alltime"), db_path=db_path)
+    assert history_store.latest("alltime", db_path=db_path)["mode"] == "alltime"
+    assert len(history_store.query(mode="current", db_path=db_path)["history"]) == 1
+    assert history_store.latest("current", db_path=db_path)["lineup"] == snapshot(0)["lineup"]
+
+
+def test_round_trip_across_keyframes(db_path):
+    snaps = [snapshot(i) for i in range(history_store.KEYFRAME_EVERY * 2 + 5)]
+    for s in snaps:
+        history_store.append(s, db_path=db_path)
+
+    page = history_store.query(mode="current", limit=history_store.MAX_LIMIT, db_path=db_path)
+    assert [strip(s) for s in page["history"]] == snaps
+    assert history_store.latest("current", db_path=db_path)["lineup"] == snaps[-1]["lineup"]
+    with storage.connection(db_path) as conn:
+        kinds = [k for (k,) in conn.execute("SELECT kind FROM lineup_history ORDER BY id")]
+    assert kinds.count("full") == 3  # one keyframe per KEYFRAME_EVERY rows
+    assert kinds.count("delta") == len(snaps) - 3
+
+
+def test_identical_payloads_collapse(db_path):
+    first = snapshot(0)
+    history_store.append(first, db_path=db_path)
+    for minute in range(1, 4):
+        history_store.append({**first, "date": f"2026-01-01T01:{minute:02d}:00+00:00"}, db_path=db_path)
+    history_store.append(snapshot(1), db_path=db_path)
+
+    with storage.connection(db_path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM lineup_history").fetchone()[0] == 2
+    hist = history_store.query(mode="current", db_path=db_path)["history"]
+    assert [s["seen_count"] for s in hist] == [4, 1]
+    assert hist[0]["date"] == first["date"]
+    assert hist[0]["last_seen"] == "2026-01-01T01:03:00+00:00"
+
+
+def test_delta_round_trip():
+    base, new = snapshot(0), snapshot(1)
+    new["extra"] = 1
+    del new["star"]
+    new["lineup"] = new["lineup"][:7]
+    assert history_store.apply_delta(base, history_store.make_delta(base, new)) == new
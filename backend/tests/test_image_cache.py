@@ -0,0 +1,29 @@
+from image_cache import ImageCache
+
+
+def disk_rows(cache: ImageCache) -> int:
+    with cache._connect() as conn:
+        return conn.execute("SELECT COUNT(*) FROM image_cache").fetchone()[0]
+
+
+def test_disk_file_is_created_on_first_use(tmp_path):
+    path = tmp_path / "image_cache.db"
+    cache = ImageCache(path)
+    assert cache.stats()["writes"] == 0 and not path.exists()
+    assert cache.get_many("track", ["t1"]) == ({}, ["t1"])
+    assert path.exists()
+
+
+def test_disk_cap_is_enforced_every_n_rows(tmp_path):
+    cache = ImageCache(tmp_path / "image_cache.db", disk_max_entries=10, disk_prune_every=20)
+    cache.put_many("track", {f"a{i}": f"u{i}" for i in range(15)})   # first write prunes
+    assert disk_rows(cache) == 10
+    cache.put_many("track", {f"b{i}": f"u{i}" for i in range(15)})   # 15 rows since the prune
+    assert disk_rows(cache) == 25
+    cache.put_many("track", {"c0": "u0", "c1": None, "c2": "u2", "c3": "u3", "c4": "u4"})
+    assert disk_rows(cache) == 10
+
+    fresh = ImageCache(cache.path)
+    fresh.clear_memory()
+    found, missing = fresh.get_many("track", ["c0", "c1", "a0"])
+    assert found == {"c0": "u0", "c1": None} and missing == ["a0"]
@@ -0,0 +1,135 @@
+from datetime import datetime, time, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import lineup_core
+import logger_recent
+import storage
+
+
+def legacy_select(df: pd.DataFrame, want: int) -> list[dict]:
+    """The sort_values + drop_duplicates + iterrows selection select_lineup replaced."""
+    work = df.copy()
+    work["primary_artist"] = work["artist_name"].map(lineup_core.primary_artist_name)
+    ranked = work.sort_values("HIv2", ascending=False, kind="stable").reset_index(drop=True)
+    deduped = ranked.drop_duplicates(subset=["primary_artist"], keep="first").head(want)
+    out = []
+    for _, row in deduped.iterrows():
+        out.append({
+            "track": row.get("track_name") or "",
+            "title": row.get("track_name") or "",
+            "artist": row.get("artist_name") or "",
+            "score": float(row.get("HIv2", 0.0)),
+            "popularity": int(row.get("popularity", 0)) if not pd.isna(row.get("popularity", np.nan)) else 0,
+            "track_id": row.get("track_id"),
+            "album_cover": row.get("album_image_url") if isinstance(row.get("album_image_url"), str) else None,
+            "artist_image": row.get("artist_image_url") if isinstance(row.get("artist_image_url"), str) else None,
+        })
+    return out
+
+
+def tracks(artists: list[str], scores) -> pd.DataFrame:
+    n = len(artists)
+    return pd.DataFrame({
+        "track_id": [f"t{i}" for i in range(n)],
+        "track_name": [f"Track {i}" for i in range(n)],
+        "artist_name": artists,
+        "HIv2": np.asarray(scores, dtype=float),
+        "popularity": [float(i % 100) if i % 7 else np.nan for i in range(n)],
+        "album_image_url": [f"https://i/{i}" if i % 3 else None for i in range(n)],
+        "artist_image_url": [None] * n,
+    })
+
+
+def check(df: pd.DataFrame, top_n: int = 9, bench_n: int = 0):
+    lineup, bench = lineup_core.select_lineup(df, top_n=top_n, bench_n=bench_n)
+    expected = legacy_select(df, top_n + bench_n)
+    got = [{k: v for k, v in r.items() if k != "position"} for r in lineup + bench]
+    assert got == expected
+    assert [r["position"] for r in lineup] == lineup_core.POSITIONS[:len(lineup)]
+    assert all(r["position"] == "BN" for r in bench)
+    return lineup, bench
+
+
+@pytest.mark.parametrize("bench_n", [0, 3])
+def test_duplicate_artists_widen_the_prefix(bench_n):
+    # the 100 best tracks are all one artist (some as "A feat. X"), far past the first 4 * want candidates
+    rng = np.random.default_rng(0)
+    artists = ["Artist A" if i % 2 else "artist a feat. Someone" for i in range(100)]
+    artists += [f"Artist {j}" for j in range(20) for _ in range(3)]
+    scores = np.concatenate([rng.uniform(10, 20, 100), rng.uniform(0, 9, 60)])
+    lineup, bench = check(tracks(artists, scores), bench_n=bench_n)
+    assert len(lineup) == 9 and len(bench) == bench_n
+
+
+def test_fewer_unique_artists_than_slots():
+    rng = np.random.default_rng(1)
+    artists = [f"Artist {i % 5}" for i in range(30)]
+    lineup, bench = check(tracks(artists, rng.normal(size=30)), bench_n=2)
+    assert len(lineup) == 5 and bench == []
+
+
+def test_ties_keep_frame_order():
+    # equal scores straddle every prefix boundary; NaN scores rank last
+    artists = [f"Artist {i % 25}" for i in range(200)]
+    scores = np.repeat([3.0, 2.0, np.nan, 1.0], 50)
+    check(tracks(artists, scores))
+    check(tracks(artists, scores), top_n=9, bench_n=20)
+    check(tracks(artists, np.zeros(200)))
+
+
+def test_missing_columns_and_empty_frame():
+    assert lineup_core.select_lineup(pd.DataFrame()) == ([], [])
+    df = tracks([f"Artist {i}" for i in range(12)], np.arange(12)).drop(columns=["album_image_url"])
+    check(df)
+
+
+def test_artist_names_in_credit_order():
+    ta = pd.DataFrame({"track_id": ["t1", "t1", "t2", "t1", "t2", "t3"],
+                       "name": ["B", "A", None, "B", "C", None]})
+    assert lineup_core._artist_names(ta) == {"t1": "B, A", "t2": "C"}
+
+
+def test_windows_are_utc_calendar_days(db_path):
+    today = datetime.now(timezone.utc).date()
+
+    def at(days_ago: int, hh: int, mm: int = 0) -> str:
+        dt = datetime.combine(today - timedelta(days=days_ago), time(hh, mm), tzinfo=timezone.utc)
+        return dt.isoformat().replace("+00:00", "Z")
+
+    with storage.connection(db_path) as conn:
+        conn.execute("INSERT INTO tracks(id, name) VALUES('t1', 'One')")
+        logger_recent.insert_plays(conn, [
+            (at(0, 0, 1), "t1", None),
+            (at(6, 0, 1), "t1", None),     # > 6 * 24 h ago, still inside the 7 calendar days
+            (at(7, 23, 59), "t1", None),   # < 7 * 24 h + 1 day ago, previous week
+            (at(13, 0, 0), "t1", None),
+            (at(29, 0, 0), "t1", None),
+            (at(30, 23, 59), "t1", None),  # outside the 30 days
+        ])
+    row = lineup_core.fetch_current_df(db_path=db_path, feature_store=False).iloc[0]
+    assert (row["plays_7d"], row["plays_prev7d"], row["plays_30d"], row["distinct_days"]) == (2, 2, 5, 5)
+
+
+def test_stored_features_are_not_rescored(db_path, monkeypatch):
+    with storage.connection(db_path) as conn:
+        conn.execute("INSERT INTO tracks(id, name) VALUES('t1', 'One')")
+    stored = tracks(["A", "B"], [0.9, 0.4]).assign(
+        album_id=["al0", "al1"], primary_artist_id=["ar0", "ar1"],
+        album_image_url=["a0", "a1"], artist_image_url=["i0", "i1"])
+    reads = []
+
+    def load_features(path, version, days, columns=None):
+        reads.append((version, days, columns))
+        return stored
+
+    def score_frame(*args, **kwargs):
+        raise AssertionError("stored frame was rescored")
+
+    monkeypatch.setattr(lineup_core.featurestore, "load_features", load_features)
+    monkeypatch.setattr(lineup_core.scoring, "score_frame", score_frame)
+    df = lineup_core.fetch_current_df(db_path=db_path, feature_store=True, columns=lineup_core.LINEUP_COLUMNS)
+    assert df is stored
+    assert reads == [(lineup_core.data_version("current", db_path), 30, lineup_core.LINEUP_COLUMNS)]
@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import scoring
+
+CURRENT_W = {"z_plays30": 0.35, "z_momentum": 0.20, "z_popularity": 0.15, "z_clout": 0.10,
+             "z_recency": 0.10, "z_affinity": 0.07, "z_diversity": 0.03}
+ALLTIME_W = {"z_popularity": 0.45, "z_clout": 0.25, "z_recency": 0.20, "z_affinity": 0.10}
+
+
+def frame(n: int = 60, seed: int = 7) -> pd.DataFrame:
+    """fetch_current_df-shaped inputs with ties, a few unknown release dates and missing stats."""
+    rng = np.random.default_rng(seed)
+    plays_7d = rng.poisson(2, n)
+    plays_prev7d = rng.poisson(2, n)
+    dsr = rng.integers(1, 8000, n).astype(float)
+    dsr[::9] = np.nan
+    pop = rng.integers(0, 100, n).astype(float)
+    pop[::11] = np.nan
+    return pd.DataFrame({
+        "plays_7d": plays_7d,
+        "plays_prev7d": plays_prev7d,
+        "plays_30d": plays_7d + plays_prev7d + rng.poisson(3, n),
+        "distinct_days": rng.integers(1, 30, n),
+        "contexts_n": rng.integers(0, 4, n),
+        "popularity": pop,
+        "artist_pop": rng.uniform(0, 100, n),
+        "artist_followers": np.where(np.arange(n) % 13 == 0, np.nan, rng.lognormal(12, 2, n)),
+        "is_saved": rng.integers(0, 2, n).astype(float),
+        "days_since_release": dsr,
+    })
+
+
+def _z(s: pd.Series) -> pd.Series:
+    s = s.astype(float)
+    mu, sd = s.mean(), s.std()
+    if sd == 0 or np.isnan(sd):
+        sd = 1.0
+    return (s - mu) / sd
+
+
+def legacy_hiv2(df: pd.DataFrame, weights: dict[str, float]) -> pd.Series:
+    """HIv2 exactly as fetch_current_df / fetch_alltime_df computed it column by column."""
+    z = {}
+    z["z_plays30"] = _z(df["plays_30d"])
+    z["z_momentum"] = _z(df["plays_7d"] - df["plays_prev7d"])
+    z["z_popularity"] = _z(df["popularity"].fillna(0))
+    z["z_clout"] = 0.5 * _z(df["artist_pop"].fillna(0)) + 0.5 * _z(np.log1p(df["artist_followers"].fillna(0)))
+    z["z_affinity"] = _z(df["is_saved"].fillna(0))
+    z["z_diversity"] = 0.5 * _z(df["distinct_days"]) + 0.5 * _z(df["contexts_n"])
+    dsr = df["days_since_release"].fillna(df["days_since_release"].median())
+    z["z_recency"] = -(dsr - dsr.mean()) / (dsr.std() or 1.0)
+    return sum(w * z[k] for k, w in weights.items())
+
+
+@pytest.mark.parametrize("profile,weights", [("hiv2-current@1", CURRENT_W), ("hiv2-alltime@1", ALLTIME_W)])
+def test_score_frame_matches_legacy(profile, weights):
+    df = frame()
+    got = scoring.score_frame(df.copy(), profile)["HIv2"].to_numpy()
+    np.testing.assert_allclose(got, legacy_hiv2(df, weights).to_numpy(), rtol=0, atol=1e-9)
+
+
+def test_score_matrices_matches_legacy_per_user():
+    frames = [frame(n, seed) for n, seed in [(60, 1), (9, 2), (2, 3), (120, 4)]]
+    batch = scoring.score_many(frames, ["hiv2-current@1", "hiv2-alltime@1"])
+    for df, scores in zip(frames, batch):
+        np.testing.assert_allclose(scores[:, 0], legacy_hiv2(df, CURRENT_W).to_numpy(), rtol=0, atol=1e-9)
+        np.testing.assert_allclose(scores[:, 1], legacy_hiv2(df, ALLTIME_W).to_numpy(), rtol=0, atol=1e-9)
+
+
+def test_no_known_release_dates_make_recency_neutral():
+    # legacy HIv2 turned every score into NaN here (median of nothing); recency now contributes 0
+    df = frame()
+    df["days_since_release"] = np.nan
+    assert legacy_hiv2(df, CURRENT_W).isna().all()
+    scored = scoring.score_frame(df.copy(), "hiv2-current@1")
+    assert (scored["z_recency"] == 0).all()
+    without_recency = {k: w for k, w in CURRENT_W.items() if k != "z_recency"}
+    np.testing.assert_allclose(scored["HIv2"].to_numpy(), legacy_hiv2(df, without_recency).to_numpy(),
+                               rtol=0, atol=1e-9)
+
+
+def test_constant_columns_score_zero():
+    df = frame(10)
+    df["is_saved"] = 1.0
+    scored = scoring.score_frame(df.copy(), "hiv2-current@1")
+    assert (scored["z_affinity"] == 0).all()
+    np.testing.assert_allclose(scored["HIv2"].to_numpy(), legacy_hiv2(df, CURRENT_W).to_numpy(), rtol=0, atol=1e-9)
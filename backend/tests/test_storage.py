@@ -0,0 +1,108 @@
+import sqlite3
+
+import pytest
+
+import logger_recent
+import storage
+
+
+def rollup_total(conn) -> int:
+    return conn.execute("SELECT COALESCE(SUM(plays), 0) FROM track_daily_plays").fetchone()[0]
+
+
+def play_count(conn) -> int:
+    return conn.execute("SELECT COUNT(*) FROM plays").fetchone()[0]
+
+
+def test_rollup_tracks_ingest_inserts(db_path):
+    plays = [(f"2025-05-0{d}T1{h}:00:00.000000Z", f"t{h % 3}", "playlist" if h % 2 else "album")
+             for d in range(1, 4) for h in range(5)]
+    with storage.connection(db_path) as conn:
+        assert logger_recent.insert_plays(conn, plays) == len(plays)
+    with storage.connection(db_path) as conn:
+        assert logger_recent.insert_plays(conn, plays[:4]) == 0  # already logged
+        assert rollup_total(conn) == play_count(conn) == len(plays)
+        contexts = conn.execute("SELECT contexts FROM track_daily_plays WHERE track_id='t1' AND day='2025-05-01'")
+        assert set(contexts.fetchone()[0].split(",")) == {"playlist", "album"}
+
+
+def test_backfill_matches_trigger(db_path):
+    plays = [(f"2025-05-01T0{h}:00:00Z", "t1", ctx) for h, ctx in enumerate(["album", None, "playlist", "album"])]
+    with storage.connection(db_path) as conn:
+        logger_recent.insert_plays(conn, plays)
+    with storage.connection(db_path) as conn:
+        by_trigger = conn.execute("SELECT track_id, day, plays FROM track_daily_plays ORDER BY 1, 2").fetchall()
+        storage.backfill_daily_rollup(conn)
+        assert conn.execute("SELECT track_id, day, plays FROM track_daily_plays ORDER BY 1, 2").fetchall() == by_trigger
+        assert by_trigger == [("t1", "2025-05-01", 4)]
+
+
+def make_baseline_db(path):
+    """Schema as the first release left it: no user_version, plays keyed on (played_at, track_id)."""
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE plays(played_at TEXT NOT NULL, track_id TEXT NOT NULL, context TEXT,
+                           PRIMARY KEY (played_at, track_id));
+        CREATE TABLE tracks(id TEXT PRIMARY KEY, name TEXT, duration_ms INTEGER, popularity INTEGER,
+                            album_id TEXT, is_saved INTEGER DEFAULT 0);
+        CREATE TABLE albums(id TEXT PRIMARY KEY, name TEXT, release_date TEXT);
+        CREATE TABLE artists(id TEXT PRIMARY KEY, name TEXT, popularity INTEGER, followers INTEGER, genres TEXT);
+        CREATE TABLE track_artists(track_id TEXT, artist_id TEXT, PRIMARY KEY(track_id, artist_id));
+        CREATE TABLE runs(ran_at TEXT PRIMARY KEY, note TEXT);
+    """)
+    conn.executemany("INSERT INTO plays VALUES(?,?,?)", [
+        ("2025-03-01T10:00:00.000Z", "a", "playlist"),
+        ("2025-03-01T10:04:00.000Z", "b", "album"),
+        ("2025-03-01T10:04:00Z", "b", "album"),  # same instant in the raw Spotify form
+        ("2025-03-02T09:00:00.123456Z", "a", None),
+    ])
+    conn.execute("INSERT INTO tracks(id, name, album_id) VALUES('a', 'A', 'x')")
+    conn.execute("INSERT INTO albums VALUES('x', 'X', '2020-01-01')")
+    conn.commit()
+    conn.close()
+
+
+def test_baseline_schema_migrates_forward(tmp_path):
+    path = tmp_path / "data.db"
+    make_baseline_db(path)
+    conn = storage.connect(path)
+    try:
+        assert storage.schema_version(conn) == storage.SCHEMA_VERSION
+        pk = [r[1] for r in conn.execute("PRAGMA table_info(plays)") if r[5]]
+        assert pk == ["played_at"]
+        assert play_count(conn) == 3  # the two spellings of one instant fold into one row
+        assert [p for (p,) in conn.execute("SELECT played_at FROM plays ORDER BY played_at")] == [
+            "2025-03-01T10:00:00Z", "2025-03-01T10:04:00Z", "2025-03-02T09:00:00.123456Z"]
+        for table, column in [("albums", "image_url"), ("artists", "image_url")]:
+            assert column in {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+        for table in ["ingest_cursor", "track_daily_plays", "lineup_history", "top_tracks_cache", "shard_meta",
+                      "artist_lookup_misses"]:
+            assert conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()
+        assert rollup_total(conn) == play_count(conn)
+        assert conn.execute("SELECT name FROM tracks WHERE id='a'").fetchone() == ("A",)
+        assert storage.migrate(conn) == storage.SCHEMA_VERSION  # idempotent
+    finally:
+        conn.close()
+
+
+def test_read_paths_create_nothing(tmp_path, monkeypatch):
+    import history_store
+
+    monkeypatch.setattr(storage, "SHARD_DIR", tmp_path / "shards")
+    for uid in ["made-up", "a/../b", "x" * 300]:
+        assert storage.existing_db_path(uid) is None
+        path = tmp_path / "shards" / f"{storage.shard_name(uid)}.db"
+        assert history_store.query(db_path=path, readonly=True) == {"history": [], "next_cursor": None}
+        assert history_store.latest("current", db_path=path, readonly=True) is None
+    assert not (tmp_path / "shards").exists()
+    storage.close_thread_connections()
+
+
+def test_readonly_connection_does_not_write(db_path):
+    with storage.connection(db_path) as conn:
+        logger_recent.insert_plays(conn, [("2025-05-01T00:00:00Z", "t1", None)])
+    ro = storage.connection(db_path, readonly=True)
+    assert ro is not storage.connection(db_path)
+    assert play_count(ro) == 1
+    with pytest.raises(sqlite3.OperationalError, match="readonly"):
+        ro.execute("DELETE FROM plays")
@@ -0,0 +1,51 @@
+import storage
+import top_tracks
+
+
+class StubSpotify:
+    """Top tracks credit a known and an unknown artist; /v1/artists answers null for the unknown one."""
+
+    def __init__(self):
+        self.top_calls = self.artist_calls = 0
+
+    def current_user_top_tracks(self, limit, time_range):
+        self.top_calls += 1
+        return {"items": [{"id": "t1", "name": "One", "popularity": 50,
+                           "album": {"name": "A", "release_date": "2020-01-01", "images": []},
+                           "artists": [{"id": "known", "name": "Known"}, {"id": "gone", "name": "Gone"}]}]}
+
+    def artists(self, ids):
+        self.artist_calls += 1
+        return {"artists": [{"id": i, "name": "Known", "popularity": 70, "followers": {"total": 5}, "images": []}
+                            if i == "known" else None for i in ids]}
+
+
+def test_unresolvable_artists_are_not_refetched_within_ttl(db_path):
+    sp = StubSpotify()
+    items, artists = top_tracks.get(sp, db_path, "long_term")
+    assert [t["id"] for t in items] == ["t1"]
+    assert set(artists) == {"known"}
+    assert (sp.top_calls, sp.artist_calls) == (3, 1)
+
+    top_tracks.get(sp, db_path, "long_term")
+    top_tracks.get(sp, db_path, "short_term")
+    assert (sp.top_calls, sp.artist_calls) == (3, 1)  # inside the TTL: no Spotify calls at all
+
+    with storage.connection(db_path) as conn:
+        conn.execute("UPDATE artist_lookup_misses SET checked_at = checked_at - ?", (top_tracks.TTL_S + 1,))
+    top_tracks.get(sp, db_path, "long_term")
+    assert (sp.top_calls, sp.artist_calls) == (3, 2)  # the miss expired: asked once more
+
+
+def test_failed_artist_batches_are_retried(db_path):
+    sp = StubSpotify()
+
+    def down(ids):
+        sp.artist_calls += 1
+        raise RuntimeError("503")
+    sp.artists = down
+    top_tracks.get(sp, db_path, "long_term")
+    top_tracks.get(sp, db_path, "long_term")
+    assert sp.artist_calls == 2
+    with storage.connection(db_path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM artist_lookup_misses").fetchone()[0] == 0
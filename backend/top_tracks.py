@@ -0,0 +1,193 @@
+# top_tracks.py — per-user cache of Spotify's top tracks (all three time ranges)
+#
+#   items, artists = top_tracks.get(sp, db_path, "long_term")
+#
+# Spotify recomputes a user's top tracks roughly once a day, so the ranked
+# lists are kept in the user's shard (top_tracks_cache, see storage._m6) for
+# TOP_TRACKS_TTL_S. A miss on any range refetches all three ranges at once
+# (they are usually wanted together and cost one round trip in parallel),
+# then refreshes artist metadata for every artist on those lists through
+# /v1/artists in batches of 50 -- the top-tracks payload only carries
+# simplified artists, without popularity, followers or images. Artist rows
+# go into the shard's artists table shared with the logger; a hit only asks
+# Spotify for artists that table has never seen. Ids Spotify answers null
+# for are recorded in artist_lookup_misses and not asked again within the
+# TTL, so repeat requests inside it make no API calls.
+from __future__ import annotations
+import json, os, sqlite3, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import logger_recent
+import metrics
+import spotify_clients
+import storage
+
+TIME_RANGES = ("short_term", "medium_term", "long_term")
+DEFAULT_RANGE = "long_term"
+TTL_S = float(os.getenv("TOP_TRACKS_TTL_S", str(6 * 3600)))
+LIMIT = 50                # Spotify max per top-tracks page
+ARTIST_MAX_IN_FLIGHT = 4  # concurrent /v1/artists batch requests
+
+_locks: dict[str, threading.Lock] = {}
+_locks_guard = threading.Lock()
+
+
+def _lock_for(db_path: Path) -> threading.Lock:
+    """One refetch per shard at a time; concurrent misses wait and then read the cache."""
+    key = str(db_path)
+    with _locks_guard:
+        return _locks.setdefault(key, threading.Lock())
+
+
+def _slim(track: dict) -> dict:
+    """The fields fetch_alltime_df uses; full track objects carry ~180 market codes each."""
+    album = track.get("album") or {}
+    return {
+        "id": track["id"],
+        "name": track.get("name"),
+        "popularity": track.get("popularity") or 0,
+        "album": {"name": album.get("name"), "release_date": album.get("release_date"),
+                  "images": (album.get("images") or [])[:1]},
+        "artists": [{"id": a.get("id"), "name": a.get("name")} for a in track.get("artists") or []],
+    }
+
+
+# ---------- shard cache ----------
+def _read(conn, time_range: str) -> tuple[list[dict], float] | None:
+    row = conn.execute("SELECT items, fetched_at FROM top_tracks_cache WHERE time_range=?",
+                       (time_range,)).fetchone()
+    return (json.loads(row[0]), row[1]) if row else None
+
+
+def _write(conn, fetched: dict[str, list[dict]], now: float) -> None:
+    conn.executemany("""INSERT INTO top_tracks_cache(time_range, items, fetched_at) VALUES(?,?,?)
+                        ON CONFLICT(time_range) DO UPDATE SET items=excluded.items, fetched_at=excluded.fetched_at""",
+                     [(r, json.dumps(items, separators=(",", ":")), now) for r, items in fetched.items()])
+
+
+def _recent_misses(conn, ids: list[str], now: float) -> set[str]:
+    if not ids:
+        return set()
+    marks = ",".join("?" * len(ids))
+    rows = conn.execute(f"SELECT id FROM artist_lookup_misses WHERE id IN ({marks}) AND checked_at > ?",
+                        (*ids, now - TTL_S))
+    return {r[0] for r in rows}
+
+
+def _write_misses(conn, ids: list[str], now: float) -> None:
+    conn.executemany("""INSERT INTO artist_lookup_misses(id, checked_at) VALUES(?,?)
+                        ON CONFLICT(id) DO UPDATE SET checked_at=excluded.checked_at""",
+                     [(i, now) for i in ids])
+
+
+def _artist_rows(conn, ids: list[str]) -> dict[str, dict]:
+    if not ids:
+        return {}
+    marks = ",".join("?" * len(ids))
+    rows = conn.execute(f"SELECT id, popularity, followers, image_url FROM artists WHERE id IN ({marks})", ids)
+    return {i: {"popularity": p or 0, "followers": f or 0, "image_url": url} for i, p, f, url in rows}
+
+
+# ---------- Spotify ----------
+def _fetch_ranges(sp) -> dict[str, list[dict]]:
+    """All time ranges concurrently; a range that fails is left out (and keeps its old cache row)."""
+    def one(time_range):
+        try:
+            return time_range, [_slim(t) for t in sp.current_user_top_tracks(limit=LIMIT, time_range=time_range)
+                                .get("items", []) if t and t.get("id")]
+        except Exception as e:
+            print(f"[WARN] top tracks {time_range} failed: {type(e).__name__}: {e}")
+            return time_range, None
+    with ThreadPoolExecutor(max_workers=len(TIME_RANGES)) as pool:
+        return {r: items for r, items in pool.map(one, TIME_RANGES) if items is not None}
+
+
+def _fetch_artists(sp, ids: list[str]) -> tuple[list[dict], list[str]]:
+    """
+    (full artist objects, ids Spotify answered null for), SPOTIFY_BATCH ids
+    per call with a few calls in flight.
+    """
+    batches = list(logger_recent._chunks(ids))
+    if not batches:
+        return [], []
+
+    def one(batch):
+        try:
+            found = [a for a in (sp.artists(batch).get("artists") or []) if a]
+        except Exception as e:
+            print(f"[WARN] artist batch failed: {type(e).__name__}: {e}")
+            return [], []  # retried on the next request: not recorded as a miss
+        got = {a.get("id") for a in found}
+        return found, [i for i in batch if i not in got]
+    with ThreadPoolExecutor(max_workers=min(ARTIST_MAX_IN_FLIGHT, len(batches))) as pool:
+        results = list(pool.map(one, batches))
+    return [a for found, _ in results for a in found], [i for _, missed in results for i in missed]
+
+
+def _artist_ids(items: list[dict]) -> list[str]:
+    return list(dict.fromkeys(a["id"] for t in items for a in t["artists"] if a.get("id")))
+
+
+def get(sp, db_path: Path, time_range: str = DEFAULT_RANGE) -> tuple[list[dict], dict[str, dict]]:
+    """
+    (tracks, artists) for one time range: the ranked top tracks (slimmed
+    Spotify objects) and {artist_id: {popularity, followers, image_url}}
+    for every artist on them that Spotify could resolve. Without a cached
+    token for `sp` only what the shard already holds is returned (possibly
+    nothing): spotipy would otherwise block on its interactive login prompt.
+    """
+    if time_range not in TIME_RANGES:
+        raise ValueError(f"unknown time_range {time_range!r}")
+    db_path = Path(db_path)
+    online = spotify_clients.has_cached_token(sp)
+    refreshed: list[str] = []
+    with storage.connection(db_path) as conn:
+        cached = _read(conn, time_range)
+    if cached is None and not online:
+        return [], {}
+    if online and (cached is None or time.time() - cached[1] > TTL_S):
+        with _lock_for(db_path):
+            with storage.connection(db_path) as conn:
+                cached = _read(conn, time_range)
+            if cached is None or time.time() - cached[1] > TTL_S:
+                with metrics.span("alltime.spotify"):
+                    fetched = _fetch_ranges(sp)
+                if fetched:
+                    now = time.time()
+                    try:
+                        with storage.connection(db_path) as conn:
+                            _write(conn, fetched, now)
+                    except sqlite3.OperationalError:
+                        pass  # locked past busy_timeout; served uncached this time
+                    refreshed = _artist_ids([t for items in fetched.values() for t in items])
+                    if time_range in fetched:
+                        cached = (fetched[time_range], now)
+                if cached is None:
+                    raise RuntimeError(f"top tracks {time_range} unavailable")
+
+    items = cached[0]
+    wanted = _artist_ids(items)
+    now = time.time()
+    with storage.connection(db_path) as conn:
+        artists = _artist_rows(conn, wanted)
+        unknown = [i for i in wanted if i not in artists]
+        skip = _recent_misses(conn, unknown, now)
+    todo = list(dict.fromkeys(refreshed + [i for i in unknown if i not in skip]))
+    if todo and online:
+        with metrics.span("alltime.artists"):
+            found, missed = _fetch_artists(sp, todo)
+        if found or missed:
+            try:
+                with storage.connection(db_path) as conn:
+                    if found:
+                        logger_recent.upsert_artists(conn, found)
+                        storage.bump_data_generation(conn)  # current lineups use these artist stats too
+                    _write_misses(conn, missed, now)
+            except sqlite3.OperationalError:
+                pass
+            for a in found:
+                artists[a["id"]] = {"popularity": a.get("popularity") or 0,
+                                    "followers": (a.get("followers") or {}).get("total") or 0,
+                                    "image_url": logger_recent.first_image_url(a)}
+    return items, {i: artists[i] for i in wanted if i in artists}
@@ -22,7 +22,8 @@ React.useEffect(() => {
 }, []);
 
 async function fetchLineup(mode: Mode) {
-  const res = await fetch(`${API_BASE}/lineup/${mode}`, { cache: "no-store" });
+  // no-cache: the browser revalidates with If-None-Match and gets a 304 when unchanged
+  const res = await fetch(`${API_BASE}/lineup/${mode}`, { cache: "no-cache" });
   if (!res.ok) throw new Error(`Failed to load lineup: ${res.status}`);
   return res.json();
 }
@@ -6,7 +6,7 @@ export type Mode = "current" | "alltime";
 
 export async function getLineup(mode: Mode) {
   const res = await fetch(`${API_BASE}/lineup/${mode}`, {
-    cache: "no-store",
+    cache: "no-cache", // revalidate with If-None-Match; backend answers 304 when unchanged
   });
   if (!res.ok) throw new Error(`Failed to load lineup: ${res.status}`);
   return res.json() as Promise<{